@@ -1,94 +1,442 @@
-from openai import OpenAI
-from treeQA_Config import model_name, aliApiKey, deepseekApiKey
+import asyncio
+import threading
+import time
+import weakref
 
+import httpx
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
+
+from LLMs.rateLimiter import TokenBucketLimiter, estimate_tokens, backoff_delay
+from LLMs.responseCache import ResponseCache, make_cache_key
+from LLMs.singleFlight import SingleFlight
+from treeQA.ioCassette import cassette_call, cassette_call_async, CassetteMiss
+from treeQA.tracing import span, set_attributes
+from treeQA_Config import model_name as default_model_name, aliApiKey, deepseekApiKey, openaiApiKey, \
+    llm_timeout, llm_connect_timeout, llm_max_connections, llm_max_keepalive_connections, llm_keepalive_expiry, \
+    llm_max_retries, llm_cache_enabled, llm_cache_path, llm_cache_max_entries, llm_cache_ttl, llm_cache_report_tokens, \
+    llm_async_concurrency, llm_rate_limits, llm_rate_limit_max_retries, llm_backoff_base, llm_backoff_max, \
+    llm_expected_completion_tokens, llm_single_flight, stage_models
+
+# 每个服务商的接入信息，同一 provider/base_url 只创建一个长连接客户端
+PROVIDERS = {
+    "deepseek": {"api_key": deepseekApiKey, "base_url": "https://api.deepseek.com"},
+    "dashscope": {"api_key": aliApiKey, "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1"},
+    # api_key 为 None 时 OpenAI SDK 会读取环境变量 OPENAI_API_KEY
+    "openai": {"api_key": openaiApiKey or None, "base_url": None},
+}
+
+# 进程内共享的限流器，按 provider 统计 RPM/TPM
+_rate_limiters = {
+    provider: TokenBucketLimiter(rpm=limits.get("rpm"), tpm=limits.get("tpm"))
+    for provider, limits in llm_rate_limits.items()
+    if limits.get("rpm") or limits.get("tpm")
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _http_limits():
+    return httpx.Limits(
+        max_connections=llm_max_connections,
+        max_keepalive_connections=llm_max_keepalive_connections,
+        keepalive_expiry=llm_keepalive_expiry,
+    )
+
+
+def _http_timeout():
+    return httpx.Timeout(llm_timeout, connect=llm_connect_timeout)
+
+
+def get_client(provider):
+    """
+    返回 provider 对应的共享 OpenAI 客户端，首次使用时创建。
+    OpenAI/httpx 客户端本身是线程安全的，可在 inference.py 的线程池中复用连接池。
+    """
+    config = PROVIDERS.get(provider)
+    if config is None:
+        raise ValueError(f"Invalid provider: {provider}")
+    key = (provider, config["base_url"])
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = OpenAI(
+                    api_key=config["api_key"],
+                    base_url=config["base_url"],
+                    timeout=_http_timeout(),
+                    # 429 和其他重试都由 _limited_completion 经过限流器完成，SDK 自身不再重试
+                    max_retries=0,
+                    http_client=httpx.Client(limits=_http_limits(), timeout=_http_timeout()),
+                )
+                _clients[key] = client
+    return client
+
+
+# AsyncOpenAI 客户端和信号量都绑定在具体的事件循环上，按循环分别保存
+_async_state = weakref.WeakKeyDictionary()
+_async_state_lock = threading.Lock()
+
+
+def _get_async_state(provider):
+    loop = asyncio.get_running_loop()
+    with _async_state_lock:
+        loop_state = _async_state.setdefault(loop, {})
+        state = loop_state.get(provider)
+        if state is None:
+            config = PROVIDERS.get(provider)
+            if config is None:
+                raise ValueError(f"Invalid provider: {provider}")
+            client = AsyncOpenAI(
+                api_key=config["api_key"],
+                base_url=config["base_url"],
+                timeout=_http_timeout(),
+                max_retries=0,
+                http_client=httpx.AsyncClient(limits=_http_limits(), timeout=_http_timeout()),
+            )
+            semaphore = asyncio.Semaphore(llm_async_concurrency.get(provider, llm_async_concurrency["default"]))
+            state = loop_state[provider] = (client, semaphore)
+    return state
+
+
+def get_async_client(provider):
+    """返回当前事件循环上 provider 对应的共享 AsyncOpenAI 客户端。"""
+    return _get_async_state(provider)[0]
+
+
+def close_clients():
+    """关闭所有共享客户端（进程退出前调用，可选）。"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def _chat_completion(provider, model, prompt, query, timeout=None, **params):
+    client = get_client(provider)
+    if timeout is not None:
+        params["timeout"] = timeout
+    completion = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": query},
+        ],
+        stream=False,
+        **params
+    )
+    usage = {
+        "prompt_tokens": completion.usage.prompt_tokens,
+        "completion_tokens": completion.usage.completion_tokens,
+        "total_tokens": completion.usage.total_tokens,
+    }
+    return completion.choices[0].message.content, usage
+
+
+def _stream_completion(provider, model, prompt, query, on_delta, timeout=None, **params):
+    """以 stream=True 请求，每收到一段文本就回调 on_delta，结束后返回完整文本和 usage。"""
+    client = get_client(provider)
+    if timeout is not None:
+        params["timeout"] = timeout
+    stream = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": query},
+        ],
+        stream=True,
+        stream_options={"include_usage": True},
+        **params
+    )
+    parts = []
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    for chunk in stream:
+        if chunk.usage:
+            usage = {
+                "prompt_tokens": chunk.usage.prompt_tokens,
+                "completion_tokens": chunk.usage.completion_tokens,
+                "total_tokens": chunk.usage.total_tokens,
+            }
+        if chunk.choices:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+    return "".join(parts), usage
+
+
+def _is_rate_limited(error):
+    return isinstance(error, RateLimitError) or getattr(error, "status_code", None) == 429
+
+
+def _retry_delay(provider, error, retries):
+    """
+    失败的请求是否重试：429 最多 llm_rate_limit_max_retries 次，连接错误、超时和 5xx 最多 llm_max_retries 次。
+    retries 为 {"rate_limited": n, "transient": n}，需要重试时计数加一并返回等待秒数，否则返回 None。
+    """
+    if _is_rate_limited(error):
+        kind, limit = "rate_limited", llm_rate_limit_max_retries
+    elif isinstance(error, (APIConnectionError, InternalServerError)):
+        kind, limit = "transient", llm_max_retries
+    else:
+        return None
+    if retries[kind] >= limit:
+        return None
+    delay = backoff_delay(error, retries[kind], llm_backoff_base, llm_backoff_max)
+    retries[kind] += 1
+    reason = "Rate limited by" if kind == "rate_limited" else f"Request failed ({type(error).__name__}) at"
+    print(f"{reason} {provider}, retrying in {delay:.1f}s ({retries[kind]}/{limit})...")
+    set_attributes({"llm.retries": sum(retries.values())})
+    return delay
+
+
+def _limited_completion(provider, model, prompt, query, params, on_delta=None, timeout=None):
+    """
+    经过限流器发起请求：先按预估 token 数排队，遇到 429 时遵守 Retry-After 或带抖动退避后重试，
+    同时让同一 provider 的其他调用方一起暂停。连接错误、超时和 5xx 也在这里重试（SDK 客户端 max_retries=0），
+    每次重试都重新经过限流器；流式请求已输出内容后不再重试。
+    """
+    limiter = _rate_limiters.get(provider)
+    estimated = estimate_tokens(prompt, query, llm_expected_completion_tokens)
+    retries = {"rate_limited": 0, "transient": 0}
+    streamed = []
+
+    def on_stream_delta(delta):
+        streamed.append(True)
+        on_delta(delta)
+
+    while True:
+        if limiter is not None:
+            delay = limiter.reserve(estimated)
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            if on_delta is None:
+                text, usage = _chat_completion(provider, model, prompt, query, timeout=timeout, **params)
+            else:
+                text, usage = _stream_completion(provider, model, prompt, query, on_stream_delta, timeout=timeout,
+                                                 **params)
+        except Exception as e:
+            if limiter is not None:
+                limiter.reconcile(estimated, 0)
+            delay = None if streamed else _retry_delay(provider, e, retries)
+            if delay is None:
+                raise
+            if limiter is not None and _is_rate_limited(e):
+                limiter.pause(delay)
+            time.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.reconcile(estimated, usage["total_tokens"])
+        return text, usage
+
+
+# model_name -> 服务商、实际模型名和采样参数；采样参数同时参与缓存键
+MODELS = {
+    "deepseekV3-chat": {
+        "provider": "deepseek", "model": "deepseek-chat",
+        "params": {"max_tokens": 2048, "temperature": 0.0},
+        # 调用失败时返回的兜底回答（不写入缓存）
+        "fallback": "There is no answer for this question.",
+    },
+    "qwen2.5-instruct-14b": {
+        "provider": "dashscope", "model": "qwen2.5-14b-instruct",
+        "params": {"max_tokens": 4096},
+    },
+    "deepseekV3_ali": {
+        "provider": "dashscope", "model": "deepseek-v3",
+        "params": {"max_tokens": 4096},
+    },
+    "gpt3.5-turbo": {
+        "provider": "openai", "model": "gpt-3.5-turbo",
+        "params": {"temperature": 0.01},
+    },
+}
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+# 合并同时在途的相同请求
+_single_flight = SingleFlight()
+
+
+def get_response_cache():
+    """llm_cache_enabled 打开时返回进程内共享的 ResponseCache，否则返回 None。"""
+    global _response_cache
+    if not llm_cache_enabled:
+        return None
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache(llm_cache_path, max_entries=llm_cache_max_entries,
+                                                ttl=llm_cache_ttl, report_tokens=llm_cache_report_tokens)
+    return _response_cache
 
-def get_DeepSeek_Response(prompt,query):
 
-    client = OpenAI(api_key=deepseekApiKey, base_url="https://api.deepseek.com")
+def _fetch_model(config, key, prompt, query, params, on_delta=None, timeout=None):
+    """真正请求上游（经过录制/回放层和限流器），成功后写入响应缓存。"""
+    request = {"model": config["model"], "system": prompt, "user": query, "params": params}
     try:
-        response = client.chat.completions.create(
-            model="deepseek-chat",
+        text, usage = cassette_call(
+            "llm", request,
+            lambda: _limited_completion(config["provider"], config["model"], prompt, query, params,
+                                        on_delta=on_delta, timeout=timeout),
+            # 回放时整段文本一次性交给流式回调
+            on_replay=(lambda response: on_delta(response[0])) if on_delta is not None else None,
+        )
+    except CassetteMiss:
+        # 回放缺少录制时直接失败，不能用兜底回答掩盖
+        raise
+    except Exception as e:
+        if "fallback" not in config:
+            raise
+        print(e)
+        return config["fallback"], {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    cache = get_response_cache()
+    if cache is not None:
+        cache.put(key, config["model"], text, usage)
+    return text, usage
+
+
+def _request_params(config, max_tokens):
+    params = dict(config["params"])
+    if max_tokens is not None:
+        params["max_tokens"] = max_tokens
+    return params
+
+
+def _call_model(model_name, prompt, query, on_delta=None, max_tokens=None, timeout=None):
+    """
+    调用模型并返回 (text, usage_dict)，结果可缓存时写入响应缓存。
+    传入 on_delta 时使用流式输出；缓存命中时整段文本一次性回调。
+    同一时刻相同键的非流式调用只请求一次上游，其余调用方共享结果和 token 数。
+    max_tokens 覆盖模型默认的生成上限（参与缓存键），timeout 覆盖本次请求的超时时间。
+    """
+    config = MODELS.get(model_name)
+    if config is None:
+        raise ValueError(f"Invalid model name: {model_name}")
+    params = _request_params(config, max_tokens)
+    key = make_cache_key(model_name, config["model"], prompt, query, params)
+    cache = get_response_cache()
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            if on_delta is not None:
+                on_delta(cached[0])
+            return cached[0], dict(cached[1], cached=True)
+    if on_delta is not None or not llm_single_flight:
+        return _fetch_model(config, key, prompt, query, params, on_delta, timeout)
+    return _single_flight.do(key, lambda: _fetch_model(config, key, prompt, query, params, timeout=timeout))
+
+
+async def _chat_completion_async(provider, model, prompt, query, timeout=None, **params):
+    client, semaphore = _get_async_state(provider)
+    if timeout is not None:
+        params["timeout"] = timeout
+    # 每个 provider 同时在途的请求数由信号量限制
+    async with semaphore:
+        completion = await client.chat.completions.create(
+            model=model,
             messages=[
                 {"role": "system", "content": prompt},
                 {"role": "user", "content": query},
             ],
             stream=False,
-            max_tokens=2048,
-            temperature=0.0
+            **params
         )
+    usage = {
+        "prompt_tokens": completion.usage.prompt_tokens,
+        "completion_tokens": completion.usage.completion_tokens,
+        "total_tokens": completion.usage.total_tokens,
+    }
+    return completion.choices[0].message.content, usage
+
+
+async def _limited_completion_async(provider, model, prompt, query, params, timeout=None):
+    """_limited_completion 的异步版本，与线程调用方共用同一个限流器。"""
+    limiter = _rate_limiters.get(provider)
+    estimated = estimate_tokens(prompt, query, llm_expected_completion_tokens)
+    retries = {"rate_limited": 0, "transient": 0}
+    while True:
+        if limiter is not None:
+            delay = limiter.reserve(estimated)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        try:
+            text, usage = await _chat_completion_async(provider, model, prompt, query, timeout=timeout, **params)
+        except Exception as e:
+            if limiter is not None:
+                limiter.reconcile(estimated, 0)
+            delay = _retry_delay(provider, e, retries)
+            if delay is None:
+                raise
+            if limiter is not None and _is_rate_limited(e):
+                limiter.pause(delay)
+            await asyncio.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.reconcile(estimated, usage["total_tokens"])
+        return text, usage
+
 
-        # 计算当前查询的 token 数量
-        currentTokenCount = response.usage.total_tokens
-        return response.choices[0].message.content,currentTokenCount
+async def _fetch_model_async(config, key, prompt, query, params, timeout=None):
+    request = {"model": config["model"], "system": prompt, "user": query, "params": params}
+    try:
+        text, usage = await cassette_call_async(
+            "llm", request,
+            lambda: _limited_completion_async(config["provider"], config["model"], prompt, query, params,
+                                              timeout=timeout),
+        )
+    except CassetteMiss:
+        # 回放缺少录制时直接失败，不能用兜底回答掩盖
+        raise
     except Exception as e:
+        if "fallback" not in config:
+            raise
         print(e)
-        return "There is no answer for this question."
+        return config["fallback"], {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    cache = get_response_cache()
+    if cache is not None:
+        await asyncio.to_thread(cache.put, key, config["model"], text, usage)
+    return text, usage
 
-def get_deepseekV3(prompt, query):
-    api_key = aliApiKey
-    client = OpenAI(
-        # 若没有配置环境变量，请用百炼API Key将下行替换为：api_key="sk-xxx",
-        api_key=api_key,  # 如何获取API Key：https://help.aliyun.com/zh/model-studio/developer-reference/get-api-key
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-    )
 
-    completion = client.chat.completions.create(
-        model="deepseek-v3",  # 此处以 deepseek-r1 为例，可按需更换模型名称。
-        messages=[
-            {'role': 'system', 'content': prompt},
-            {'role': 'user', 'content': query}
-        ],
-        max_tokens=4096
-    )
-    # 计算当前查询的 token 数量
-    currentTokenCount = completion.usage.total_tokens
+async def _call_model_async(model_name, prompt, query, max_tokens=None, timeout=None):
+    """_call_model 的异步版本，共用同一个响应缓存和请求合并。"""
+    config = MODELS.get(model_name)
+    if config is None:
+        raise ValueError(f"Invalid model name: {model_name}")
+    params = _request_params(config, max_tokens)
+    key = make_cache_key(model_name, config["model"], prompt, query, params)
+    cache = get_response_cache()
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return cached[0], dict(cached[1], cached=True)
+    if not llm_single_flight:
+        return await _fetch_model_async(config, key, prompt, query, params, timeout)
+    return await _single_flight.do_async(key, lambda: _fetch_model_async(config, key, prompt, query, params,
+                                                                         timeout))
 
-    # 打印当前消耗和总消耗
-    
-    return completion.choices[0].message.content,currentTokenCount
-def get_qwen14b_ali(prompt, query):
-    api_key = aliApiKey
-    client = OpenAI(
-        # 若没有配置环境变量，请用百炼API Key将下行替换为：api_key="sk-xxx",
-        api_key=api_key,  # 如何获取API Key：https://help.aliyun.com/zh/model-studio/developer-reference/get-api-key
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-    )
 
-    completion = client.chat.completions.create(
-        model="qwen2.5-14b-instruct",  
-        messages=[
-            {'role': 'system', 'content': prompt},
-            {'role': 'user', 'content': query}
-        ],
-        max_tokens=4096
-    )
-    # 计算当前查询的 token 数量
-    currentTokenCount = completion.usage.total_tokens
+def get_DeepSeek_Response(prompt,query):
+    text, usage = _call_model("deepseekV3-chat", prompt, query)
+    return text, usage["total_tokens"]
 
-    # 打印当前消耗和总消耗
-    
-    return completion.choices[0].message.content,currentTokenCount
 
+def get_deepseekV3(prompt, query):
+    text, usage = _call_model("deepseekV3_ali", prompt, query)
+    return text, usage["total_tokens"]
 
-def get_gpt_response(prompt,query):
-    client = OpenAI()
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": prompt},
-            {
-                "role": "user",
-                "content": query
-            }
-        ],
-        temperature=0.01
-    )
-    # 计算当前查询的 token 数量
-    currentTokenCount = completion.usage.total_tokens
 
-    # 打印当前消耗和总消耗
-    
-    return completion.choices[0].message.content,currentTokenCount
+def get_qwen14b_ali(prompt, query):
+    text, usage = _call_model("qwen2.5-instruct-14b", prompt, query)
+    return text, usage["total_tokens"]
+
+
+def get_gpt_response(prompt,query):
+    text, usage = _call_model("gpt3.5-turbo", prompt, query)
+    return text, usage["total_tokens"]
 
 model_functions = {
     "deepseekV3-chat": get_DeepSeek_Response,
@@ -96,12 +444,77 @@ model_functions = {
     "deepseekV3_ali": get_deepseekV3,
     "gpt3.5-turbo":get_gpt_response
 }
-def getModelResponse(prompt, query, model_name=model_name):
-    response_function = model_functions.get(model_name)
-    if response_function:
-        return response_function(prompt, query)
+def _llm_span(stage, model_name):
+    return span("llm.call", {"llm.stage": stage or "default", "llm.model": model_name})
+
+
+def _record_usage(usage):
+    set_attributes({
+        "llm.prompt_tokens": usage.get("prompt_tokens", 0),
+        "llm.completion_tokens": usage.get("completion_tokens", 0),
+        "llm.total_tokens": usage.get("total_tokens", 0),
+        "llm.cache_hit": bool(usage.get("cached")),
+    })
+
+
+def resolve_stage(stage, model_name=None):
+    """
+    按 stage_models 路由表确定某个阶段使用的模型、max_tokens 和 timeout。
+    显式传入的 model_name 优先，其次是路由表，最后是全局 model_name。
+    """
+    if stage is None:
+        route = {}
+    elif stage in stage_models:
+        route = stage_models[stage] or {}
     else:
-        raise ValueError(f"Invalid model name: {model_name}")
+        raise ValueError(f"Invalid stage: {stage}")
+    resolved = model_name or route.get("model") or default_model_name
+    if resolved not in MODELS:
+        raise ValueError(f"Invalid model name: {resolved}")
+    return resolved, route.get("max_tokens"), route.get("timeout")
+
+
+def getModelResponse(prompt, query, model_name=None, stage=None, metrics=None):
+    """
+    返回 (text, total_tokens)。stage 为 stage_models 中的阶段名，用于选择该阶段的模型和生成限制；
+    传入 metrics (PipelineMetrics) 时按阶段记录 token 和耗时。
+    """
+    resolved, max_tokens, timeout = resolve_stage(stage, model_name)
+    start = time.perf_counter()
+    with _llm_span(stage, resolved):
+        text, usage = _call_model(resolved, prompt, query, max_tokens=max_tokens, timeout=timeout)
+        _record_usage(usage)
+    if metrics is not None:
+        metrics.record_llm(stage, usage, time.perf_counter() - start)
+    return text, usage["total_tokens"]
+
+def getModelResponseStream(prompt, query, on_delta, model_name=None, stage=None, metrics=None):
+    """
+    流式调用模型：每收到一段文本调用一次 on_delta(text)，最终返回 (text, total_tokens)。
+    """
+    resolved, max_tokens, timeout = resolve_stage(stage, model_name)
+    start = time.perf_counter()
+    with _llm_span(stage, resolved):
+        text, usage = _call_model(resolved, prompt, query, on_delta=on_delta, max_tokens=max_tokens, timeout=timeout)
+        _record_usage(usage)
+    if metrics is not None:
+        metrics.record_llm(stage, usage, time.perf_counter() - start)
+    return text, usage["total_tokens"]
+
+
+async def getModelResponseAsync(prompt, query, model_name=None, stage=None, metrics=None):
+    """
+    getModelResponse 的异步版本，返回 (text, total_tokens)。
+    同一事件循环上可以同时发起大量请求，并发上限由 llm_async_concurrency 按 provider 控制。
+    """
+    resolved, max_tokens, timeout = resolve_stage(stage, model_name)
+    start = time.perf_counter()
+    with _llm_span(stage, resolved):
+        text, usage = await _call_model_async(resolved, prompt, query, max_tokens=max_tokens, timeout=timeout)
+        _record_usage(usage)
+    if metrics is not None:
+        metrics.record_llm(stage, usage, time.perf_counter() - start)
+    return text, usage["total_tokens"]
 
 if __name__ == "__main__":
     print(getModelResponse("You are a helpful assistance.", "Who are you?"))
@@ -0,0 +1,90 @@
+import random
+import threading
+import time
+
+
+class TokenBucketLimiter:
+    """
+    按 provider 统计的令牌桶限流器，同时限制每分钟请求数 (RPM) 和每分钟 token 数 (TPM)。
+
+    reserve() 会立即扣减额度（允许变为负数）并返回需要等待的秒数，
+    因此调用方按到达顺序排队，线程用 time.sleep、协程用 asyncio.sleep 等待即可。
+    请求完成后用 reconcile() 以 usage.total_tokens 修正预估的 token 数。
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm) if rpm else 0.0
+        self._tokens = float(tpm) if tpm else 0.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def reserve(self, tokens):
+        """预留一次请求和 tokens 个 token，返回需要等待的秒数。"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            delay = max(0.0, self._paused_until - now)
+            if self.rpm:
+                self._requests -= 1
+                if self._requests < 0:
+                    delay = max(delay, -self._requests * 60.0 / self.rpm)
+            if self.tpm:
+                # 单次请求超过整个桶容量时按容量计，避免永远等待
+                self._tokens -= min(tokens, self.tpm)
+                if self._tokens < 0:
+                    delay = max(delay, -self._tokens * 60.0 / self.tpm)
+            return delay
+
+    def reconcile(self, estimated_tokens, actual_tokens):
+        """用实际消耗修正预留时的估计值。"""
+        if not self.tpm:
+            return
+        with self._lock:
+            self._tokens -= actual_tokens - min(estimated_tokens, self.tpm)
+
+    def pause(self, seconds):
+        """收到 429 后让该 provider 的所有调用方一起暂停 seconds 秒。"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def estimate_tokens(prompt, query, expected_completion_tokens):
+    # 粗略估计：约 4 个字符一个 token，加上预期的输出长度
+    return (len(prompt) + len(query)) // 4 + expected_completion_tokens
+
+
+def get_retry_after(error):
+    """从 429 响应中读取 Retry-After（秒），没有时返回 None。"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    for name in ("retry-after-ms", "retry-after"):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            seconds = float(value)
+        except ValueError:
+            continue
+        return seconds / 1000.0 if name == "retry-after-ms" else seconds
+    return None
+
+
+def backoff_delay(error, attempt, base, cap):
+    """优先遵守 Retry-After，否则使用带抖动的指数退避。"""
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def make_cache_key(model_name, model, prompt, query, params):
+    """
+    根据 (模型名, system prompt, user message, 采样参数) 生成内容寻址的缓存键。
+    """
+    payload = json.dumps(
+        {"model_name": model_name, "model": model, "system": prompt, "user": query, "params": params},
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    基于 SQLite 的 LLM 响应缓存。
+
+    - 多线程共享一个连接，读写由锁串行化；WAL 模式允许多个进程同时读取同一个文件。
+    - 超过 max_entries 时按最近访问时间淘汰（LRU）。
+    - ttl（秒）不为 None 时，过期条目视为未命中并被删除。
+    - report_tokens 为 True 时命中返回原始 token 数，否则返回 0（即缓存命中不计入消耗）。
+    """
+
+    def __init__(self, path, max_entries=None, ttl=None, report_tokens=True):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.report_tokens = report_tokens
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                total_tokens INTEGER,
+                created_at REAL,
+                last_access REAL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        """命中时返回 (response, usage_dict)，否则返回 None。"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, prompt_tokens, completion_tokens, total_tokens, created_at FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            response, prompt_tokens, completion_tokens, total_tokens, created_at = row
+            if self.ttl is not None and now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self._count -= 1
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        if not self.report_tokens:
+            prompt_tokens = completion_tokens = total_tokens = 0
+        return response, {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+        }
+
+    def put(self, key, model, response, usage):
+        now = time.time()
+        with self._lock:
+            existed = self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, model, response, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+                 usage.get("total_tokens", 0), now, now),
+            )
+            if not existed:
+                self._count += 1
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        if self.max_entries is None or self._count <= self.max_entries:
+            return
+        excess = self._count - self.max_entries
+        self._conn.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+            (excess,),
+        )
+        self._count -= excess
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": self._count,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    合并同一个键上同时在途的调用：第一个调用方真正执行，其余调用方等待并共享它的结果（或异常）。
+    调用结束后键即被移除，之后的调用会重新执行（结果复用交给响应缓存）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    async def do_async(self, key, coro_fn):
+        """
+        do() 的异步版本，只在同一个事件循环内合并。调用在单独的 task 中执行，所有调用方（包括发起者）
+        都通过 shield 等待它：任何一个调用方被取消都不会取消调用本身，其他调用方照常拿到结果。
+        """
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop), key)
+        with self._lock:
+            task = self._async_calls.get(loop_key)
+            if task is None:
+                task = self._async_calls[loop_key] = loop.create_task(self._run_async(loop_key, coro_fn))
+                task.add_done_callback(_retrieve_exception)
+            else:
+                self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _run_async(self, loop_key, coro_fn):
+        try:
+            return await coro_fn()
+        finally:
+            with self._lock:
+                del self._async_calls[loop_key]
+
+
+def _retrieve_exception(task):
+    # 所有调用方都已取消时没有人读取异常，避免 "exception was never retrieved" 警告
+    if not task.cancelled():
+        task.exception()
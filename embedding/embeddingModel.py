@@ -3,6 +3,8 @@ import time
 import requests
 from openai import OpenAI
 
+from treeQA.ioCassette import cassette_call
+from treeQA.tracing import span, set_attributes
 from treeQA_Config import nv_embed_v2_url,RetrieveModelName
 
 
@@ -28,6 +30,7 @@ def getNVEmbeddings(textList, max_retries=3, retry_delay=3):
         try:
             response = requests.post(url, json=data)
             if response.status_code == 200:
+                set_attributes({"http.response_bytes": len(response.content), "http.retries": attempt})
                 return response.json()['embeddings']
             else:
                 if attempt < max_retries:
@@ -53,6 +56,9 @@ model_functions = {
 def getEmbeddings(textList,model_name=RetrieveModelName):
     response_function = model_functions.get(model_name)
     if response_function:
-        return response_function(textList)
+        with span("embedding.call", {"embedding.model": model_name, "embedding.texts": len(textList),
+                                     "embedding.chars": sum(len(text) for text in textList)}):
+            return cassette_call("embedding", {"model": model_name, "text_list": textList},
+                                 lambda: response_function(textList))
     else:
         raise ValueError(f"Invalid model name: {model_name}")
\ No newline at end of file
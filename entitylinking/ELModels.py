@@ -1,6 +1,9 @@
 
 import re
-from LLMs.models import getModelResponse
+from LLMs.models import getModelResponse, getModelResponseAsync
+from treeQA.eventLoop import run_sync
+from treeQA.ioCassette import cassette_call, cassette_call_async
+from treeQA.sharedExecutors import run_blocking
 from treeQA_Config import ELTop_k, el_model
 import aiohttp
 import asyncio
@@ -63,14 +66,17 @@ async def get_wikidata_id_with_proxy(wikipedia_url, retries=3, delay=5):
 
 
 # 主函数：提取实体并获取 Wikidata ID
-async def azureEntityLinking(text):
+async def azureEntityLinking(text, results=None):
     """
     Performs Azure Entity Linking and fetches Wikidata IDs, returning results as a JSON string.
+    results: recognize_linked_entities 的结果，同步路径在调用线程中先行取得后传入。
     """
     try:
         documents = [text]
         # 注意：实际 SDK 可能返回一个迭代器或列表，确保你正确地获取第一个结果
-        results = client.recognize_linked_entities(documents=documents)
+        # SDK 为同步客户端，放到线程池中调用以免阻塞事件循环
+        if results is None:
+            results = await run_blocking("entity_linking", client.recognize_linked_entities, documents=documents)
         result = None
         # 处理结果迭代器（如果适用）
         for doc_result in results:
@@ -186,9 +192,7 @@ def relikEntityLinking(query):
 
 
 
-#通过llm进行实体抽取
-def llmForEntityExtract(query,logicTree):
-    prompt = """ I need you to help me understand the user's request and identify the entities involved in the user's query. Your task is simple: recognize the user's request and generate the parameters accordingly. Please note that when extracting, only the noun form is required! No plural forms or other forms of nouns, etc.
+ENTITY_EXTRACT_PROMPT = """ I need you to help me understand the user's request and identify the entities involved in the user's query. Your task is simple: recognize the user's request and generate the parameters accordingly. Please note that when extracting, only the noun form is required! No plural forms or other forms of nouns, etc.
     Here's an example:
     Input: Who composed the music for Manru? The music for Manru was composed by Ignacy Jan Paderewski.
     Output: "Manru", "Ignacy Jan Paderewski"
@@ -196,31 +200,99 @@ def llmForEntityExtract(query,logicTree):
     Output:"Kirill Eskov"
     Now the user input is: """
 
-    item_string,tokenCount = getModelResponse(prompt, query)
-    logicTree.tokenCount +=tokenCount
-    print("Entity extract complete!")
-    # currentCount = currentCount + tokenCount
-    # print(f"总token消耗：[{currentCount}]，实体抽取消耗：{tokenCount}")
+
+def _parse_entities(item_string):
     # 使用正则表达式来匹配被双引号包围的内容，包括空字符串
     pattern = r'"(.*?)"'
     # 查找所有匹配实体并将结果放入列表
-    matches = re.findall(pattern, item_string)
-    return matches
+    return re.findall(pattern, item_string)
 
 
-# 使用大语言模型进行挑选有用实体，输出实体ID
-def llmForEntityFilter(itemInfo,query,logicTree):
-    itemSelectPrompt = f"""Now I need you to select the entity that is truly relevant to the query.  
+#通过llm进行实体抽取
+def llmForEntityExtract(query,logicTree):
+    item_string,tokenCount = getModelResponse(ENTITY_EXTRACT_PROMPT, query, stage="entity_extract",
+                                              metrics=logicTree.metrics)
+    print("Entity extract complete!")
+    # currentCount = currentCount + tokenCount
+    # print(f"总token消耗：[{currentCount}]，实体抽取消耗：{tokenCount}")
+    return _parse_entities(item_string)
+
+
+async def llmForEntityExtractAsync(query, logicTree):
+    item_string, tokenCount = await getModelResponseAsync(ENTITY_EXTRACT_PROMPT, query, stage="entity_extract",
+                                                          metrics=logicTree.metrics)
+    print("Entity extract complete!")
+    return _parse_entities(item_string)
+
+
+ENTITY_EXTRACT_BATCH_PROMPT = """ I need you to help me understand several user requests and identify the entities involved in each of them. Please note that when extracting, only the noun form is required! No plural forms or other forms of nouns, etc.
+    Here's an example:
+    Input:
+    1. Who composed the music for Manru? The music for Manru was composed by Ignacy Jan Paderewski.
+    2. Find information about Kirill Eskov's biography or personal details to determine his country of citizenship.
+    Output:
+    {"1": ["Manru", "Ignacy Jan Paderewski"], "2": ["Kirill Eskov"]}
+    Please just output json format content, do not output any analysis text.
+    Now the user inputs are: """
+
+
+def _number_queries(queries):
+    return "\n".join(f"{i}. {query}" for i, query in enumerate(queries, 1))
+
+
+def _parse_entity_batch(item_string, queries):
+    """解析批量抽取结果，返回 {query: [实体]}，解析失败的查询对应 None。"""
+    try:
+        item_string = item_string.replace("```json", "").replace("```", "")
+        parsed = json.loads(item_string[item_string.find('{'):item_string.rfind('}') + 1])
+    except json.JSONDecodeError:
+        parsed = {}
+    results = {}
+    for i, query in enumerate(queries, 1):
+        entities = parsed.get(str(i))
+        results[query] = [str(entity) for entity in entities] if isinstance(entities, list) else None
+    return results
+
+
+# 一次调用为多个查询抽取实体，返回 {query: [实体]}，解析失败的查询退回逐条抽取
+def llmForEntityExtractBatch(queries, logicTree):
+    if len(queries) <= 1:
+        return {query: llmForEntityExtract(query, logicTree) for query in queries}
+    item_string, tokenCount = getModelResponse(ENTITY_EXTRACT_BATCH_PROMPT, _number_queries(queries),
+                                               stage="entity_extract", metrics=logicTree.metrics)
+    print("Batch entity extract complete!")
+    results = _parse_entity_batch(item_string, queries)
+    for query, entities in results.items():
+        if entities is None:
+            results[query] = llmForEntityExtract(query, logicTree)
+    return results
+
+
+async def llmForEntityExtractBatchAsync(queries, logicTree):
+    if len(queries) <= 1:
+        return {query: await llmForEntityExtractAsync(query, logicTree) for query in queries}
+    item_string, tokenCount = await getModelResponseAsync(ENTITY_EXTRACT_BATCH_PROMPT, _number_queries(queries),
+                                                          stage="entity_extract", metrics=logicTree.metrics)
+    print("Batch entity extract complete!")
+    results = _parse_entity_batch(item_string, queries)
+    failed = [query for query, entities in results.items() if entities is None]
+    for query, entities in zip(failed, await asyncio.gather(*(llmForEntityExtractAsync(query, logicTree)
+                                                               for query in failed))):
+        results[query] = entities
+    return results
+
+
+def _entity_filter_prompt(itemInfo, query):
+    return f"""Now I need you to select the entity that is truly relevant to the query.  
     I need you to select the most relevant entity ID based on the following information, 
     Output the related IDs no more than {ELTop_k} without outputting any other content.
     format: ['','','']
     entity info: {itemInfo}
     The user's query is:{query}
     """
-    top1_item_string,tokenCount = getModelResponse(itemSelectPrompt, "Please begin to choose.")
-    logicTree.tokenCount+=tokenCount
-    # currentCount = currentCount + tokenCount
-    # print(f"总token消耗：[{currentCount}]，实体过滤消耗：{tokenCount}")
+
+
+def _parse_entity_ids(top1_item_string):
     # 正则表达式模式：匹配单引号中的文本
     pattern = r"'(.*?)'"
     # 查找所有匹配项
@@ -229,12 +301,91 @@ def llmForEntityFilter(itemInfo,query,logicTree):
     return matches
 
 
+# 使用大语言模型进行挑选有用实体，输出实体ID
+def llmForEntityFilter(itemInfo,query,logicTree):
+    top1_item_string,tokenCount = getModelResponse(_entity_filter_prompt(itemInfo, query), "Please begin to choose.",
+                                                   stage="entity_filter", metrics=logicTree.metrics)
+    # currentCount = currentCount + tokenCount
+    # print(f"总token消耗：[{currentCount}]，实体过滤消耗：{tokenCount}")
+    return _parse_entity_ids(top1_item_string)
+
+
+async def llmForEntityFilterAsync(itemInfo, query, logicTree):
+    top1_item_string, tokenCount = await getModelResponseAsync(_entity_filter_prompt(itemInfo, query),
+                                                               "Please begin to choose.", stage="entity_filter",
+                                                               metrics=logicTree.metrics)
+    return _parse_entity_ids(top1_item_string)
+
+
+def _entity_select_prompt(itemInfo, query):
+    return f"""Now I need you to identify the entities involved in the user's query and link them to Wikidata.
+    The candidate entities found by entity linking are listed below. Select the IDs of the candidates that are truly relevant to the query, no more than {ELTop_k}.
+    If an entity of the query is missing from the candidates, give its name (noun form only) so that it can be searched on Wikidata.
+    Output format: {{"qids": ["Q1", "Q2"], "search": ["entity name"]}}
+    Please just output json format content, do not output any analysis text.
+    candidate entities: {itemInfo}
+    The user's query is:{query}
+    """
+
+
+def _parse_entity_selection(item_string):
+    """解析融合选择的结果，返回 (选中的 QID, 需要检索的实体名)；不是合法 JSON 时只按 Q 号提取 QID。"""
+    try:
+        item_string = item_string.replace("```json", "").replace("```", "")
+        parsed = json.loads(item_string[item_string.find('{'):item_string.rfind('}') + 1])
+        qids = [str(QID) for QID in parsed.get("qids") or []]
+        surface_forms = [str(label) for label in parsed.get("search") or [] if label]
+    except (json.JSONDecodeError, AttributeError):
+        qids, surface_forms = re.findall(r"Q\d+", item_string), []
+    print(f"Selected {len(qids)} entities, {len(surface_forms)} to search!")
+    return qids, surface_forms
+
+
+# 融合的实体抽取和实体过滤：基于实体链接的候选，一次调用同时选出 QID 并给出候选中缺少、需要检索的实体名
+def llmForEntitySelect(itemInfo, query, logicTree):
+    item_string, tokenCount = getModelResponse(_entity_select_prompt(itemInfo, query), "Please begin to choose.",
+                                               stage="entity_select", metrics=logicTree.metrics)
+    return _parse_entity_selection(item_string)
+
+
+async def llmForEntitySelectAsync(itemInfo, query, logicTree):
+    item_string, tokenCount = await getModelResponseAsync(_entity_select_prompt(itemInfo, query),
+                                                          "Please begin to choose.", stage="entity_select",
+                                                          metrics=logicTree.metrics)
+    return _parse_entity_selection(item_string)
+
+
 
 
 def linkEntity(query, model_name=el_model):
+    return cassette_call("entity_linking", {"model": model_name, "query": query},
+                         lambda: _linkEntity(query, model_name))
+
+
+def _linkEntity(query, model_name):
     if model_name =="relik":
         return relikEntityLinking(query)
-    return asyncio.run(azureEntityLinking(query))
+    # 同步路径通常已经运行在 entity_linking 线程池中，SDK 直接在当前线程调用，
+    # 不能再提交到同一个线程池并等待（线程池占满时会互相等待而死锁）
+    try:
+        results = client.recognize_linked_entities(documents=[query])
+    except Exception as e:
+        print(f"An error occurred in azureEntityLinking: {e}")
+        return json.dumps({"error": str(e), "entities": []}, ensure_ascii=False)
+    # 取 Wikidata ID 的异步请求在进程共享的事件循环上执行，不再为每次调用新建事件循环
+    return run_sync(azureEntityLinking(query, results))
+
+
+async def linkEntityAsync(query, model_name=el_model):
+    """linkEntity 的异步版本，直接在当前事件循环上执行（relik 的同步请求放到线程池中）。"""
+    return await cassette_call_async("entity_linking", {"model": model_name, "query": query},
+                                     lambda: _linkEntityAsync(query, model_name))
+
+
+async def _linkEntityAsync(query, model_name):
+    if model_name == "relik":
+        return await run_blocking("entity_linking", relikEntityLinking, query)
+    return await azureEntityLinking(query)
 
 
 # 示例调用
@@ -63,6 +63,23 @@ def load_aliases(alias_file_path: str) -> Optional[Dict[str, List[str]]]:
         logging.error(f"加载别名文件时发生意外错误: {alias_file_path} - {e}")
         return None
 
+def load_latest_records(input_file_path: str) -> List[tuple]:
+    """读取结果文件，返回 (行号, 记录) 列表；同一 id 出现多次时（如重跑失败的问题）只保留最后一条。"""
+    records: Dict[Any, tuple] = {}
+    with open(input_file_path, 'r', encoding='utf-8') as infile:
+        for i, line in enumerate(infile):
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError as e:
+                logging.error(f"解析第 {i+1} 行 JSON 时出错: {e}")
+                continue
+            record_id = data.get("id", f"line_{i+1}") if isinstance(data, dict) else f"line_{i+1}"
+            if record_id in records:
+                # 重新插入，使保留的记录位于其最后出现的位置
+                del records[record_id]
+            records[record_id] = (i, data)
+    return list(records.values())
+
 # 修改函数签名，移除 dataset_name
 def evaluate_results(input_file_path: str,
                      alias_data: Optional[Dict[str, List[str]]] = None,
@@ -96,71 +113,67 @@ def evaluate_results(input_file_path: str,
     else:
         logging.info("未提供或加载别名数据失败，EM 评估将仅使用原始答案。")
 
-    with open(input_file_path, 'r', encoding='utf-8') as infile:
-        for i, line in enumerate(infile):
-            try:
-                data = json.loads(line)
-                total_records += 1
-
-                record_id = data.get("id", f"line_{i+1}")
-                question = data.get("question", "")
-                original_answers_raw = data.get("original_answer", [])
-                if original_answers_raw is None: original_answers = []
-                elif isinstance(original_answers_raw, list): original_answers = [str(ans) for ans in original_answers_raw if ans is not None]
-                else: original_answers = [str(original_answers_raw)]
-
-                # --- 别名处理 (仅当 alias_data 存在时) ---
-                answers_to_match = list(original_answers) # 默认使用原始答案
-                if alias_data:
-                    extended_answers = list(original_answers)
-                    for ans in original_answers:
-                        aliases = alias_data.get(ans, [])
-                        if aliases:
-                            extended_answers.extend(aliases)
-                    answers_to_match = list(set(extended_answers)) # 使用去重后的扩展列表
-
-                # --- 提取预测答案 ---
-                prediction = data.get("final_answer")
-                if prediction is None:
-                    processed_answer_str = data.get("processed_answer")
-                    if isinstance(processed_answer_str, str):
-                        try:
-                            processed_answer_json = json.loads(processed_answer_str)
-                            prediction = processed_answer_json.get("answer")
-                        except json.JSONDecodeError: prediction = None
-                    elif isinstance(processed_answer_str, dict): prediction = processed_answer_str.get("answer")
-
-                if prediction is None: prediction = ""
-                else: prediction = str(prediction)
-
-                # --- 计算 EM (使用 answers_to_match) ---
-                em = calculate_em_contains(prediction, answers_to_match)
-                em_scores.append(em)
-
-                # --- 累加指标 ---
-                for key in metric_keys:
-                    value = data.get(key, 0)
-                    if isinstance(value, (int, float)): metric_accumulators[key] += value
-                    else: logging.warning(f"记录 {record_id} 指标 '{key}' 非数值: {value} (类型: {type(value)})，计为 0")
-
-                # --- 记录错误 ---
-                if not em and error_file_path:
-                    error_entry = {
-                        "id": record_id,
-                        "question": question,
-                        "original_answer": original_answers,
-                        "predicted_answer": prediction,
-                        "fix_count": data.get("fix_count", "N/A")
-                    }
-                    # 只有在实际使用了别名时才记录扩展答案列表，更清晰
-                    if alias_data and answers_to_match != original_answers:
-                         error_entry["answers_used_for_match (incl. aliases)"] = answers_to_match
-                    error_records.append(error_entry)
+    for i, data in load_latest_records(input_file_path):
+        try:
+            total_records += 1
+
+            record_id = data.get("id", f"line_{i+1}")
+            question = data.get("question", "")
+            original_answers_raw = data.get("original_answer", [])
+            if original_answers_raw is None: original_answers = []
+            elif isinstance(original_answers_raw, list): original_answers = [str(ans) for ans in original_answers_raw if ans is not None]
+            else: original_answers = [str(original_answers_raw)]
+
+            # --- 别名处理 (仅当 alias_data 存在时) ---
+            answers_to_match = list(original_answers) # 默认使用原始答案
+            if alias_data:
+                extended_answers = list(original_answers)
+                for ans in original_answers:
+                    aliases = alias_data.get(ans, [])
+                    if aliases:
+                        extended_answers.extend(aliases)
+                answers_to_match = list(set(extended_answers)) # 使用去重后的扩展列表
+
+            # --- 提取预测答案 ---
+            prediction = data.get("final_answer")
+            if prediction is None:
+                processed_answer_str = data.get("processed_answer")
+                if isinstance(processed_answer_str, str):
+                    try:
+                        processed_answer_json = json.loads(processed_answer_str)
+                        prediction = processed_answer_json.get("answer")
+                    except json.JSONDecodeError: prediction = None
+                elif isinstance(processed_answer_str, dict): prediction = processed_answer_str.get("answer")
+
+            if prediction is None: prediction = ""
+            else: prediction = str(prediction)
+
+            # --- 计算 EM (使用 answers_to_match) ---
+            em = calculate_em_contains(prediction, answers_to_match)
+            em_scores.append(em)
+
+            # --- 累加指标 ---
+            for key in metric_keys:
+                value = data.get(key, 0)
+                if isinstance(value, (int, float)): metric_accumulators[key] += value
+                else: logging.warning(f"记录 {record_id} 指标 '{key}' 非数值: {value} (类型: {type(value)})，计为 0")
+
+            # --- 记录错误 ---
+            if not em and error_file_path:
+                error_entry = {
+                    "id": record_id,
+                    "question": question,
+                    "original_answer": original_answers,
+                    "predicted_answer": prediction,
+                    "fix_count": data.get("fix_count", "N/A")
+                }
+                # 只有在实际使用了别名时才记录扩展答案列表，更清晰
+                if alias_data and answers_to_match != original_answers:
+                     error_entry["answers_used_for_match (incl. aliases)"] = answers_to_match
+                error_records.append(error_entry)
 
-            except json.JSONDecodeError as e:
-                logging.error(f"解析第 {i+1} 行 JSON 时出错: {e}")
-            except Exception as e:
-                logging.error(f"处理第 {i+1} 行时发生意外错误: {e}")
+        except Exception as e:
+            logging.error(f"处理第 {i+1} 行时发生意外错误: {e}")
 
     if total_records == 0:
         logging.warning("文件中没有找到有效的记录进行评估。")
@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import concurrent
 import json
 import os
@@ -7,15 +8,35 @@ import time
 
 from tqdm import tqdm
 
+from LLMs.models import get_response_cache
+from treeQA.batchJobs import BatchJob
+from treeQA.checkpointStore import get_checkpoint_store
+from treeQA.eventLoop import run_sync
+from treeQA.sharedExecutors import executor_stats
+from treeQA.tracing import span, set_attributes
+from treeQA.tree_class.budget import QuestionBudget
 from treeQA.tree_class.logicTree import LogicTree
-
-
-def answerQuestion(query):
-    """Processes a single question, tracking time and tokens for stages."""
-    global _global_token_counter
-    _global_token_counter = 0 # Reset counter for each question
-
+from treeQA.tree_class.metrics import PipelineMetrics
+from treeQA_Config import stream_tree_construction, question_token_budget, question_time_budget, \
+    budget_degrade_thresholds, budget_priority_depth, async_max_questions, checkpoint_enabled
+
+
+def answerQuestion(query, init_result=None, token_budget=question_token_budget, time_budget=question_time_budget,
+                   checkpoint_scope=None):
+    """
+    Processes a single question, tracking time and tokens for stages.
+    init_result: optional (tree construction output, usage) from an offline batch job; stage 1 is then not re-run.
+    token_budget / time_budget: per-question limits (tokens / seconds, None for unlimited). As they run out,
+    verification degrades step by step (see QuestionBudget); the degradations are reported in stage_metrics.
+    checkpoint_scope: identifies the question within a run, e.g. "dataset:item_id". With checkpoint_enabled and a
+    scope, the tree state is saved after construction, after every verified node and after verification; a restarted
+    run with the same scope, question and model/retrieval config continues from the last checkpoint instead of
+    rebuilding the question. Questions without a scope are never checkpointed.
+    """
+    metrics = PipelineMetrics()
     start_time_total = time.perf_counter()
+    budget = QuestionBudget(metrics, token_budget, time_budget, thresholds=budget_degrade_thresholds,
+                            priority_depth=budget_priority_depth, start_time=start_time_total)
 
     logic_init_time = 0
     self_adaptive_time = 0
@@ -27,45 +48,77 @@ def answerQuestion(query):
     processed_answer_tree = None
     fix_count = -1
     logic_tree= None
-    try:
-        tokens_before_init=0
-        # 1. Logic Tree Initialization
-        start_time_init = time.perf_counter()
-        json_data,token_count = LogicTree.logic_tree_init(query)
-        logic_tree = LogicTree(json_data)
-        end_time_init = time.perf_counter()
-        logic_tree.tokenCount += token_count
-        logic_init_time = end_time_init - start_time_init
-        logic_init_tokens = logic_tree.tokenCount - tokens_before_init
-
-        # 2. Check and Refine (Self-Adaptive)
-        start_time_refine = time.perf_counter()
-        logic_tree.check_and_refine()
-        end_time_refine = time.perf_counter()
-        self_adaptive_time = end_time_refine - start_time_refine
-        self_adaptive_tokens = logic_tree.tokenCount - logic_init_tokens
-
-        # 3. Update Final Answer (Final Reasoning)
-        start_time_update = time.perf_counter()
-        logic_tree.update_final_answer()
-        end_time_update = time.perf_counter()
-
-        final_reasoning_time = end_time_update - start_time_update
-        final_reasoning_tokens = logic_tree.tokenCount - self_adaptive_tokens
-
-        # Get final results
-        processed_answer_tree, fix_count = logic_tree.to_json()
-        total_tokens = logic_tree.tokenCount
+    checkpoints = get_checkpoint_store() if checkpoint_scope is not None else None
+    saved = checkpoints.load(query, checkpoint_scope) if checkpoints is not None else None
+    checkpoint = (lambda stage, state: checkpoints.save(query, checkpoint_scope, stage, state)) \
+        if checkpoints is not None else None
+    with span("question", {"question.resumed": saved is not None, "question.batch": init_result is not None}):
+        try:
+            # 1. Logic Tree Initialization
+            start_time_init = time.perf_counter()
+            with span("stage.tree_construction"):
+                if saved is not None:
+                    stage, state = saved
+                    print(f"Resuming question from checkpoint (stage: {stage})")
+                    logic_tree = LogicTree.from_checkpoint(state, metrics=metrics, budget=budget, checkpoint=checkpoint)
+                    metrics.increment("resumed_from_checkpoint")
+                elif init_result is not None:
+                    result_text, usage = init_result
+                    metrics.record_llm("tree_construction", usage, 0.0)
+                    json_data = LogicTree.parse_tree_result(result_text, query)
+                    if json_data is None:
+                        raise ValueError("Batch tree construction output is not valid JSON")
+                    logic_tree = LogicTree(json_data, metrics=metrics, budget=budget, checkpoint=checkpoint)
+                elif stream_tree_construction:
+                    # Nodes are retrieved and fact-checked in the background while the tree is still being generated
+                    logic_tree, _ = LogicTree.build_streaming(query, metrics=metrics, budget=budget)
+                    logic_tree.checkpoint = checkpoint
+                else:
+                    json_data, _ = LogicTree.logic_tree_init(query, metrics=metrics)
+                    logic_tree = LogicTree(json_data, metrics=metrics, budget=budget, checkpoint=checkpoint)
+            if saved is None:
+                logic_tree.save_checkpoint("tree_built")
+            end_time_init = time.perf_counter()
+            logic_init_time = end_time_init - start_time_init
+            tokens_after_init = metrics.total_tokens
+            logic_init_tokens = tokens_after_init
+
+            # 2. Check and Refine (Self-Adaptive)
+            start_time_refine = time.perf_counter()
+            if saved is None or saved[0] != "verified":
+                logic_tree.check_and_refine()
+                logic_tree.save_checkpoint("verified")
+            end_time_refine = time.perf_counter()
+            self_adaptive_time = end_time_refine - start_time_refine
+            tokens_after_refine = metrics.total_tokens
+            self_adaptive_tokens = tokens_after_refine - tokens_after_init
+
+            # 3. Update Final Answer (Final Reasoning)
+            start_time_update = time.perf_counter()
+            logic_tree.update_final_answer()
+            end_time_update = time.perf_counter()
+
+            final_reasoning_time = end_time_update - start_time_update
+            final_reasoning_tokens = metrics.total_tokens - tokens_after_refine
+
+            # Get final results
+            processed_answer_tree, fix_count = logic_tree.to_json()
+            total_tokens = metrics.total_tokens
+            set_attributes({"question.total_tokens": total_tokens, "question.fix_count": fix_count})
+            if checkpoints is not None:
+                checkpoints.delete(query, checkpoint_scope)
 
-    except Exception as e:
-        print(f"\nError processing question '{query[:50]}...': {e}", file=sys.stderr)
-        # Record error state, return partial metrics if available
-        processed_answer_tree = {"error": str(e), "query": query, "status": "failed"}
-        fix_count = -1
+        except Exception as e:
+            print(f"\nError processing question '{query[:50]}...': {e}", file=sys.stderr)
+            # Record error state, return partial metrics if available
+            processed_answer_tree = {"error": str(e), "query": query, "status": "failed"}
+            set_attributes({"question.error": str(e)})
+            fix_count = -1
+            total_tokens = metrics.total_tokens
 
     # Prepare metrics dictionary
-    metrics = {
-        "final_answer":logic_tree.data['answer'] if logic_tree else None,
+    result_metrics = {
+        "final_answer":logic_tree.data['answer'] if logic_tree and logic_tree.data else None,
         "logic_init_time": logic_init_time,
         "self_adaptive_time": self_adaptive_time,
         "final_reasoning_time": final_reasoning_time,
@@ -73,10 +126,105 @@ def answerQuestion(query):
         "self_adaptive_tokens": self_adaptive_tokens,
         "final_reasoning_tokens": final_reasoning_tokens,
         "total_tokens": total_tokens,
-        "total_processing_time": time.perf_counter() - start_time_total # Optional: add total time
+        "total_processing_time": time.perf_counter() - start_time_total, # Optional: add total time
+        # Per LLM stage and per external service breakdown (calls, prompt/completion tokens, wall time)
+        "stage_metrics": metrics.to_dict(),
     }
 
-    return processed_answer_tree, fix_count, metrics
+    return processed_answer_tree, fix_count, result_metrics
+
+
+async def answerQuestionAsync(query, init_result=None, token_budget=question_token_budget,
+                              time_budget=question_time_budget, checkpoint_scope=None):
+    """
+    Async version of answerQuestion with the same arguments and return value. Every stage runs as a coroutine on the
+    caller's event loop, so many questions can be in flight at once without a thread per question or per retrieval
+    step. The tree is built with a regular (non-streaming) call.
+    """
+    metrics = PipelineMetrics()
+    start_time_total = time.perf_counter()
+    budget = QuestionBudget(metrics, token_budget, time_budget, thresholds=budget_degrade_thresholds,
+                            priority_depth=budget_priority_depth, start_time=start_time_total)
+
+    logic_init_time = 0
+    self_adaptive_time = 0
+    final_reasoning_time = 0
+    logic_init_tokens = 0
+    self_adaptive_tokens = 0
+    final_reasoning_tokens = 0
+    processed_answer_tree = None
+    logic_tree = None
+    checkpoints = get_checkpoint_store() if checkpoint_scope is not None else None
+    saved = await asyncio.to_thread(checkpoints.load, query, checkpoint_scope) if checkpoints is not None else None
+    checkpoint = (lambda stage, state: checkpoints.save(query, checkpoint_scope, stage, state)) \
+        if checkpoints is not None else None
+    with span("question", {"question.resumed": saved is not None, "question.batch": init_result is not None,
+                           "question.async": True}):
+        try:
+            # 1. Logic Tree Initialization
+            start_time_init = time.perf_counter()
+            with span("stage.tree_construction"):
+                if saved is not None:
+                    stage, state = saved
+                    print(f"Resuming question from checkpoint (stage: {stage})")
+                    logic_tree = LogicTree.from_checkpoint(state, metrics=metrics, budget=budget, checkpoint=checkpoint)
+                    metrics.increment("resumed_from_checkpoint")
+                else:
+                    if init_result is not None:
+                        result_text, usage = init_result
+                        metrics.record_llm("tree_construction", usage, 0.0)
+                        json_data = LogicTree.parse_tree_result(result_text, query)
+                    else:
+                        json_data, _ = await LogicTree.logic_tree_init_async(query, metrics=metrics)
+                    if json_data is None:
+                        raise ValueError("Tree construction output is not valid JSON")
+                    logic_tree = LogicTree(json_data, metrics=metrics, budget=budget, checkpoint=checkpoint)
+                    await asyncio.to_thread(logic_tree.save_checkpoint, "tree_built")
+            logic_init_time = time.perf_counter() - start_time_init
+            tokens_after_init = metrics.total_tokens
+            logic_init_tokens = tokens_after_init
+
+            # 2. Check and Refine (Self-Adaptive)
+            start_time_refine = time.perf_counter()
+            if saved is None or saved[0] != "verified":
+                await logic_tree.check_and_refine_async()
+                await asyncio.to_thread(logic_tree.save_checkpoint, "verified")
+            self_adaptive_time = time.perf_counter() - start_time_refine
+            tokens_after_refine = metrics.total_tokens
+            self_adaptive_tokens = tokens_after_refine - tokens_after_init
+
+            # 3. Update Final Answer (Final Reasoning)
+            start_time_update = time.perf_counter()
+            await logic_tree.update_final_answer_async()
+            final_reasoning_time = time.perf_counter() - start_time_update
+            final_reasoning_tokens = metrics.total_tokens - tokens_after_refine
+
+            # Get final results
+            processed_answer_tree, fix_count = logic_tree.to_json()
+            set_attributes({"question.total_tokens": metrics.total_tokens, "question.fix_count": fix_count})
+            if checkpoints is not None:
+                await asyncio.to_thread(checkpoints.delete, query, checkpoint_scope)
+
+        except Exception as e:
+            print(f"\nError processing question '{query[:50]}...': {e}", file=sys.stderr)
+            processed_answer_tree = {"error": str(e), "query": query, "status": "failed"}
+            set_attributes({"question.error": str(e)})
+            fix_count = -1
+
+    result_metrics = {
+        "final_answer": logic_tree.data['answer'] if logic_tree and logic_tree.data else None,
+        "logic_init_time": logic_init_time,
+        "self_adaptive_time": self_adaptive_time,
+        "final_reasoning_time": final_reasoning_time,
+        "logic_init_tokens": logic_init_tokens,
+        "self_adaptive_tokens": self_adaptive_tokens,
+        "final_reasoning_tokens": final_reasoning_tokens,
+        "total_tokens": metrics.total_tokens,
+        "total_processing_time": time.perf_counter() - start_time_total,
+        "stage_metrics": metrics.to_dict(),
+    }
+
+    return processed_answer_tree, fix_count, result_metrics
 
 
 # --- Dataset config and paths (Keep as before) ---
@@ -93,7 +241,11 @@ OUTPUT_DIR = "result"
 # --- End Dataset config ---
 
 def load_processed_ids(output_path):
-    """Loads IDs of already processed questions from the output JSONL file."""
+    """
+    Loads IDs of already processed questions from the output JSONL file.
+    With checkpoint_enabled, failed records are not counted, so those questions are retried and resume from their
+    checkpoint; the retry appends a new record and eval/evaluate.py keeps the last record per id.
+    """
     processed_ids = set()
     if os.path.exists(output_path):
         try:
@@ -101,6 +253,9 @@ def load_processed_ids(output_path):
                 for line in f:
                     try:
                         data = json.loads(line)
+                        processed = data.get('processed_answer')
+                        if checkpoint_enabled and isinstance(processed, dict) and processed.get('status') == 'failed':
+                            continue
                         if 'id' in data:
                             processed_ids.add(data['id'])
                     except json.JSONDecodeError:
@@ -168,17 +323,15 @@ def extract_data(item, dataset_name):
 
 
 # Helper function for multithreading - updated return values
-def process_item_task(item_id, question_text, original_answer):
+def process_item_task(item_id, question_text, original_answer, init_result=None, dataset_name=None):
     """Task executed by each thread: processes one question and returns metrics."""
-    processed_answer_tree, fix_count, metrics = answerQuestion(question_text)
+    processed_answer_tree, fix_count, metrics = answerQuestion(question_text, init_result,
+                                                               checkpoint_scope=f"{dataset_name}:{item_id}")
     return item_id, question_text, original_answer, processed_answer_tree, fix_count, metrics
 
 
-def process_dataset(dataset_name, dataset_file_path, output_file_path):
-    """Loads, processes (multithreaded), and saves results including metrics."""
-    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
-    processed_ids = load_processed_ids(output_file_path)
-
+def load_dataset_items(dataset_name, dataset_file_path, processed_ids):
+    """Loads the dataset and returns (id, question, original_answer) tuples that are not processed yet."""
     try:
         with open(dataset_file_path, 'r', encoding='utf-8') as f:
             raw_data = json.load(f)
@@ -193,10 +346,6 @@ def process_dataset(dataset_name, dataset_file_path, output_file_path):
     except Exception as e:
         print(f"Error loading/parsing dataset {dataset_file_path}: {e}", file=sys.stderr); sys.exit(1)
 
-    print(f"Processing dataset '{dataset_name}' from '{dataset_file_path}'...")
-    print(f"Results will be saved to '{output_file_path}'")
-    print(f"Using {NUM_THREADS} threads.")
-
     items_to_process_args = []
     skipped_count = 0
     processed_in_this_run = set()
@@ -211,39 +360,115 @@ def process_dataset(dataset_name, dataset_file_path, output_file_path):
         processed_in_this_run.add(item_id)
 
     if skipped_count > 0: print(f"Skipped {skipped_count} items.")
+    return items_to_process_args
+
+
+def write_result(outfile, item_id, q_text, orig_ans, processed_ans_tree, fix_cnt, metrics):
+    """Appends one processed question (answer tree merged with its metrics) to the output JSONL file."""
+    result = {
+        "id": item_id,
+        "question": q_text,
+        "original_answer": orig_ans,
+        "processed_answer": processed_ans_tree,
+        "fix_count": fix_cnt,
+        **metrics # Unpack the metrics dictionary into the result
+    }
+    outfile.write(json.dumps(result, ensure_ascii=False) + '\n')
+    outfile.flush()
+
+
+async def process_items_async(dataset_name, items_to_process_args, outfile):
+    """Runs answerQuestionAsync for all items on the current event loop, at most async_max_questions at a time."""
+    semaphore = asyncio.Semaphore(async_max_questions)
+
+    async def run(item_id, question_text, original_answer, init_result=None):
+        async with semaphore:
+            processed_answer_tree, fix_count, metrics = await answerQuestionAsync(
+                question_text, init_result, checkpoint_scope=f"{dataset_name}:{item_id}")
+        return item_id, question_text, original_answer, processed_answer_tree, fix_count, metrics
+
+    tasks = [asyncio.ensure_future(run(*args)) for args in items_to_process_args]
+    print(f"Submitting {len(tasks)} questions for processing...")
+    for next_result in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=f"Processing {dataset_name}",
+                            unit="question"):
+        try:
+            write_result(outfile, *await next_result)
+        except Exception as exc:
+            print(f'\nError retrieving result from task: {exc}', file=sys.stderr)
+
+
+def process_dataset(dataset_name, dataset_file_path, output_file_path, items_to_process_args=None,
+                    async_pipeline=False):
+    """
+    Loads, processes (multithreaded), and saves results including metrics.
+    items_to_process_args: optional (id, question, original_answer, init_result) tuples, e.g. ingested from a batch job.
+    async_pipeline: run all questions as coroutines on the shared event loop (up to async_max_questions in flight)
+    instead of NUM_THREADS worker threads.
+    """
+    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+    processed_ids = load_processed_ids(output_file_path)
+    if items_to_process_args is None:
+        items_to_process_args = load_dataset_items(dataset_name, dataset_file_path, processed_ids)
+    else:
+        items_to_process_args = [args for args in items_to_process_args if args[0] not in processed_ids]
+
+    print(f"Processing dataset '{dataset_name}' from '{dataset_file_path}'...")
+    print(f"Results will be saved to '{output_file_path}'")
+    if async_pipeline:
+        print(f"Using the async pipeline with up to {async_max_questions} questions in flight.")
+    else:
+        print(f"Using {NUM_THREADS} threads.")
     if not items_to_process_args: print("No new items to process."); return
 
     with open(output_file_path, 'a', encoding='utf-8') as outfile:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
-            futures = [executor.submit(process_item_task, *args) for args in items_to_process_args]
-            print(f"Submitting {len(futures)} questions for processing...")
-            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc=f"Processing {dataset_name}", unit="question"):
-                try:
-                    # Unpack the results including metrics
-                    item_id, q_text, orig_ans, processed_ans_tree, fix_cnt, metrics = future.result()
-
-                    # Prepare result dictionary, merging metrics
-                    result = {
-                        "id": item_id,
-                        "question": q_text,
-                        "original_answer": orig_ans,
-                        "processed_answer": processed_ans_tree,
-                        "fix_count": fix_cnt,
-                        **metrics # Unpack the metrics dictionary into the result
-                    }
-                    outfile.write(json.dumps(result, ensure_ascii=False) + '\n')
-                    outfile.flush()
-
-                except Exception as exc:
-                    # Log errors from the future execution itself
-                    print(f'\nError retrieving result from thread: {exc}', file=sys.stderr)
-                    # Optionally write an error marker to the output file
-                    # error_result = {"id": "unknown", "error": str(exc), "status": "future_error", **{k: -1 for k in metrics.keys()}} # Add placeholder metrics
-                    # outfile.write(json.dumps(error_result, ensure_ascii=False) + '\n')
-                    # outfile.flush()
+        if async_pipeline:
+            run_sync(process_items_async(dataset_name, items_to_process_args, outfile))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+                futures = [executor.submit(process_item_task, *args, dataset_name=dataset_name)
+                           for args in items_to_process_args]
+                print(f"Submitting {len(futures)} questions for processing...")
+                for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc=f"Processing {dataset_name}", unit="question"):
+                    try:
+                        # Unpack the results including metrics and append them to the output file
+                        write_result(outfile, *future.result())
+
+                    except Exception as exc:
+                        # Log errors from the future execution itself
+                        print(f'\nError retrieving result from thread: {exc}', file=sys.stderr)
+                        # Optionally write an error marker to the output file
+                        # error_result = {"id": "unknown", "error": str(exc), "status": "future_error", **{k: -1 for k in metrics.keys()}} # Add placeholder metrics
+                        # outfile.write(json.dumps(error_result, ensure_ascii=False) + '\n')
+                        # outfile.flush()
 
 
     print(f"\nFinished processing {dataset_name}. Results appended to {output_file_path}")
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        print(f"LLM response cache: {response_cache.stats()}")
+    print(f"Shared executors: {executor_stats()}")
+
+
+BATCH_STEPS = ["build", "submit", "fetch", "local", "verify"]
+
+
+def process_batch_step(step, dataset_name, dataset_file_path, output_file_path):
+    """Runs one step of the offline batch job; the job state lives next to the output file and every step is resumable."""
+    job = BatchJob(os.path.splitext(output_file_path)[0] + ".batch")
+    if step == "build":
+        processed_ids = load_processed_ids(output_file_path)
+        job.build(load_dataset_items(dataset_name, dataset_file_path, processed_ids))
+    elif step == "submit":
+        job.submit()
+    elif step == "fetch":
+        if not job.fetch():
+            print("Batch is not completed yet, run this step again later.")
+    elif step == "local":
+        job.run_local()
+    elif step == "verify":
+        items = job.ingested_items()
+        print(f"Ingested {len(items)} tree construction results from the batch output.")
+        process_dataset(dataset_name, dataset_file_path, output_file_path, items)
 
 
 def process_single_question(question):
@@ -283,6 +508,20 @@ def main():
                                 help=f'Name of the dataset. Supported: {", ".join(SUPPORTED_DATASETS)}')
     parser_dataset.add_argument('--output_filename', type=str, required=True,
                                 help=f'Output JSONL filename (e.g., results.jsonl). Saved in "{OUTPUT_DIR}/".')
+    parser_dataset.add_argument('--async_pipeline', action='store_true',
+                                help='Run questions as coroutines on one shared event loop instead of worker threads.')
+
+    # --- Offline Batch Mode ---
+    parser_batch = subparsers.add_parser('batch', help='Run tree construction of a dataset as an offline batch job.')
+    parser_batch.add_argument('--dataset_name', choices=SUPPORTED_DATASETS, required=True,
+                              help=f'Name of the dataset. Supported: {", ".join(SUPPORTED_DATASETS)}')
+    parser_batch.add_argument('--output_filename', type=str, required=True,
+                              help=f'Output JSONL filename. Saved in "{OUTPUT_DIR}/", batch files in "<output>.batch/".')
+    parser_batch.add_argument('--step', choices=BATCH_STEPS, required=True,
+                              help='build: write the batch request file; submit: upload it to the provider; '
+                                   'fetch: download the output once the batch is completed; '
+                                   'local: execute the request file locally instead of submitting it; '
+                                   'verify: ingest the output and continue with verification.')
 
     # --- Single Question Mode ---
     parser_single = subparsers.add_parser('single', help='Process a single question.')
@@ -290,7 +529,7 @@ def main():
 
     args = parser.parse_args()
 
-    if args.mode == 'dataset':
+    if args.mode in ('dataset', 'batch'):
         dataset_key = args.dataset_name
         if dataset_key not in DATASET_FILE_MAP:
             print(f"Error: Path undefined for dataset '{dataset_key}'.", file=sys.stderr); sys.exit(1)
@@ -308,7 +547,11 @@ def main():
         except OSError as e:
             print(f"Error creating output directory '{output_dir_path}': {e}", file=sys.stderr); sys.exit(1)
 
-        process_dataset(args.dataset_name, dataset_file_path, output_file_path)
+        if args.mode == 'dataset':
+            process_dataset(args.dataset_name, dataset_file_path, output_file_path,
+                            async_pipeline=args.async_pipeline)
+        else:
+            process_batch_step(args.step, args.dataset_name, dataset_file_path, output_file_path)
 
     elif args.mode == 'single':
         process_single_question(args.question)
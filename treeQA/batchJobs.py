@@ -0,0 +1,227 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from LLMs.models import MODELS, resolve_stage, get_client, getModelResponse
+from treeQA.tree_class.logicTree import LogicTree
+from treeQA_Config import batch_local_workers
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# 服务商 batch 的终止状态（除 completed 外）；expired/cancelled 的 batch 可能仍有部分输出
+BATCH_FAILED_STATUSES = ("failed", "expired", "cancelled")
+
+
+class BatchJob:
+    """
+    把数据集的建树 (stage 1) 请求打包成 OpenAI batch JSONL，提交/下载或在本地模拟执行，
+    再把结果交回 inference.py 继续做核查。所有状态写在 job_dir/state.json 中，每一步都可以重复执行。
+
+    job_dir 下的文件：
+    - requests.jsonl：batch 输入文件（每行 custom_id/method/url/body）
+    - results.jsonl：batch 输出文件（与服务商返回的格式一致）
+    - errors.jsonl：batch 错误文件（服务商返回 error_file_id 时下载）
+    - state.json：阶段、batch id 以及 custom_id -> 问题 的映射
+    """
+
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        self.requests_path = os.path.join(job_dir, "requests.jsonl")
+        self.results_path = os.path.join(job_dir, "results.jsonl")
+        self.errors_path = os.path.join(job_dir, "errors.jsonl")
+        self.state_path = os.path.join(job_dir, "state.json")
+        self.state = {"stage": "new", "questions": {}, "batch_id": None, "model_name": None}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+
+    def _save_state(self):
+        os.makedirs(self.job_dir, exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def _set_stage(self, stage):
+        self.state["stage"] = stage
+        self._save_state()
+        print(f"Batch job stage: {stage}")
+
+    def build(self, items):
+        """
+        items 为 (id, question, original_answer) 列表，已写入的 custom_id 不会重复写。
+        batch 已提交后不能再追加请求；batch 以 failed/expired/cancelled 结束时，重新 build 会清除旧的 batch id，
+        之后 submit 重新提交整个请求文件。
+        """
+        if self.state.get("batch_id"):
+            if self.state["stage"] not in BATCH_FAILED_STATUSES:
+                raise RuntimeError(f"Batch {self.state['batch_id']} was already submitted for this job "
+                                   f"(stage '{self.state['stage']}'), its requests can no longer be changed.")
+            print(f"Discarding {self.state['stage']} batch {self.state['batch_id']}.")
+            self.state["batch_id"] = None
+        os.makedirs(self.job_dir, exist_ok=True)
+        model_name, max_tokens, _ = resolve_stage("tree_construction")
+        config = MODELS[model_name]
+        params = dict(config["params"])
+        if max_tokens is not None:
+            params["max_tokens"] = max_tokens
+        questions = self.state["questions"]
+        written = 0
+        with open(self.requests_path, 'a', encoding='utf-8') as f:
+            for item_id, question, original_answer in items:
+                custom_id = str(item_id)
+                if custom_id in questions:
+                    continue
+                request = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": {
+                        "model": config["model"],
+                        "messages": [
+                            {"role": "system", "content": LogicTree.tree_prompt(question)},
+                            {"role": "user", "content": question},
+                        ],
+                        **params,
+                    },
+                }
+                f.write(json.dumps(request, ensure_ascii=False) + '\n')
+                questions[custom_id] = {"id": item_id, "question": question, "original_answer": original_answer}
+                written += 1
+        self.state["model_name"] = model_name
+        print(f"Wrote {written} new batch requests to {self.requests_path} ({len(questions)} in total).")
+        self._set_stage("built")
+
+    def submit(self):
+        """上传 requests.jsonl 并创建服务商 batch 任务。"""
+        if self.state["stage"] not in ("built", "submitted"):
+            raise RuntimeError(f"Cannot submit a batch job in stage '{self.state['stage']}', run build first.")
+        if self.state.get("batch_id"):
+            print(f"Batch already submitted: {self.state['batch_id']}")
+            return
+        client = get_client(MODELS[self.state["model_name"]]["provider"])
+        with open(self.requests_path, 'rb') as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                      completion_window="24h")
+        self.state["batch_id"] = batch.id
+        print(f"Submitted batch {batch.id}")
+        self._set_stage("submitted")
+
+    def fetch(self):
+        """
+        查询 batch 状态，结束后下载输出文件和错误文件。返回是否已完成。
+        batch 以 failed/expired/cancelled 结束时下载已有的部分输出并抛出 RuntimeError，
+        已成功的请求仍可由 verify 继续，其余请求可用 local 补跑，或重新 build/submit。
+        """
+        if self.state["stage"] == "completed":
+            return True
+        if not self.state.get("batch_id"):
+            raise RuntimeError("No batch has been submitted for this job.")
+        client = get_client(MODELS[self.state["model_name"]]["provider"])
+        batch = client.batches.retrieve(self.state["batch_id"])
+        print(f"Batch {batch.id} status: {batch.status}")
+        if batch.status != "completed" and batch.status not in BATCH_FAILED_STATUSES:
+            return False
+        self._download(client, batch.output_file_id, self.results_path)
+        if self._download(client, batch.error_file_id, self.errors_path):
+            print(f"Failed requests of batch {batch.id} (error file {batch.error_file_id}) saved to {self.errors_path}",
+                  file=sys.stderr)
+        if batch.status in BATCH_FAILED_STATUSES:
+            self._set_stage(batch.status)
+            errors = [error.message for error in (batch.errors.data or [])] if batch.errors else []
+            raise RuntimeError(f"Batch {batch.id} {batch.status}: {'; '.join(errors) or 'no error details'} "
+                               f"(error file: {batch.error_file_id})")
+        self._set_stage("completed")
+        return True
+
+    @staticmethod
+    def _download(client, file_id, path):
+        if not file_id:
+            return False
+        content = client.files.content(file_id)
+        with open(path, 'wb') as f:
+            f.write(content.read())
+        return True
+
+    def run_local(self):
+        """
+        本地替身：逐条调用 getModelResponse 执行 requests.jsonl，并按 batch 输出格式写入 results.jsonl。
+        可中断后重跑，已完成的 custom_id 会被跳过；有请求失败时阶段保持不变，重跑这一步只执行失败的请求。
+        """
+        if self.state["stage"] not in ("built", "completed") + BATCH_FAILED_STATUSES:
+            raise RuntimeError(f"Cannot run a batch job locally in stage '{self.state['stage']}'.")
+        done = set(self.load_results())
+        with open(self.requests_path, 'r', encoding='utf-8') as f:
+            requests_to_run = [r for r in map(json.loads, f) if r["custom_id"] not in done]
+        print(f"Running {len(requests_to_run)} batch requests locally ({len(done)} already done).")
+
+        def run(request):
+            messages = request["body"]["messages"]
+            text, total_tokens = getModelResponse(messages[0]["content"], messages[1]["content"],
+                                                  model_name=self.state["model_name"], stage="tree_construction")
+            return {
+                "id": f"local-{request['custom_id']}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "request_id": f"local-{request['custom_id']}",
+                    "body": {
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": request["body"]["model"],
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                     "finish_reason": "stop"}],
+                        "usage": {"total_tokens": total_tokens},
+                    },
+                },
+                "error": None,
+            }
+
+        with open(self.results_path, 'a', encoding='utf-8') as out, \
+                ThreadPoolExecutor(max_workers=batch_local_workers) as executor:
+            futures = [executor.submit(run, request) for request in requests_to_run]
+            failed = 0
+            for future in as_completed(futures):
+                try:
+                    out.write(json.dumps(future.result(), ensure_ascii=False) + '\n')
+                    out.flush()
+                except Exception as e:
+                    failed += 1
+                    print(f"Local batch request failed: {e}", file=sys.stderr)
+        if failed:
+            print(f"{failed} of {len(requests_to_run)} batch requests failed, run this step again to retry them.",
+                  file=sys.stderr)
+            return
+        self._set_stage("completed")
+
+    def load_results(self):
+        """读取 results.jsonl（及 errors.jsonl），返回 {custom_id: (content, usage)}，失败的请求被跳过。"""
+        results = {}
+        for path in (self.results_path, self.errors_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    response = record.get("response") or {}
+                    if record.get("error") or response.get("status_code") != 200:
+                        print(f"Batch request {record.get('custom_id')} failed: "
+                              f"{record.get('error') or response.get('body')}", file=sys.stderr)
+                        continue
+                    body = response["body"]
+                    results[record["custom_id"]] = (body["choices"][0]["message"]["content"], body.get("usage", {}))
+        return results
+
+    def ingested_items(self):
+        """返回 [(id, question, original_answer, (content, usage))]，供 inference.py 继续核查。"""
+        results = self.load_results()
+        items = []
+        for custom_id, info in self.state["questions"].items():
+            if custom_id in results:
+                items.append((info["id"], info["question"], info["original_answer"], results[custom_id]))
+        return items
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import treeQA_Config
+from treeQA_Config import checkpoint_enabled, checkpoint_path
+
+# 问题处理的阶段，按先后顺序
+STAGES = ("tree_built", "verifying", "verified")
+
+# 影响逻辑树、检索结果和核查结论的配置项，任一项变化后旧断点不再恢复
+CONFIG_KEYS = ("model_name", "stage_models", "el_model", "RetrieveModelName", "Chroma_store", "ELTop_k", "RLTop_k",
+               "article_top_k", "entity_selection_mode", "duplicate_question_threshold", "final_answer_context_tokens")
+
+
+def config_fingerprint():
+    config = {name: getattr(treeQA_Config, name, None) for name in CONFIG_KEYS}
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def question_key(query, scope):
+    """断点键：scope（如 "数据集:题目 id"）、问题文本和当前模型/检索配置的哈希。"""
+    payload = json.dumps([scope, query, config_fingerprint()], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CheckpointStore:
+    """
+    基于 SQLite 的问题级断点存储，每个问题保存最近一次的状态：
+    阶段、逻辑树 JSON（含已写入的 ref 和修正）、已核查节点的状态、fix_count 以及已产生的计量。
+    断点按 (scope, 问题, 配置) 区分，换数据集、题目或模型配置后不会恢复到别的运行留下的断点。
+    多线程共享一个连接，写入由锁串行化；问题完成后删除其断点。
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                key TEXT PRIMARY KEY,
+                query TEXT,
+                stage TEXT,
+                state TEXT,
+                updated_at REAL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def save(self, query, scope, stage, state):
+        payload = json.dumps(state, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (key, query, stage, state, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (question_key(query, scope), query, stage, payload, time.time()),
+            )
+            self._conn.commit()
+
+    def load(self, query, scope):
+        """返回 (stage, state)，没有断点时返回 None。"""
+        with self._lock:
+            row = self._conn.execute("SELECT stage, state FROM checkpoints WHERE key = ?",
+                                     (question_key(query, scope),)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def delete(self, query, scope):
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE key = ?", (question_key(query, scope),))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_checkpoint_store = None
+_checkpoint_store_lock = threading.Lock()
+
+
+def get_checkpoint_store():
+    """checkpoint_enabled 打开时返回进程内共享的 CheckpointStore，否则返回 None。"""
+    global _checkpoint_store
+    if not checkpoint_enabled:
+        return None
+    if _checkpoint_store is None:
+        with _checkpoint_store_lock:
+            if _checkpoint_store is None:
+                _checkpoint_store = CheckpointStore(checkpoint_path)
+    return _checkpoint_store
@@ -0,0 +1,61 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from treeQA_Config import async_blocking_workers
+
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """
+    返回进程内共享的事件循环，首次调用时在一个后台守护线程中启动。
+    循环的默认线程池（asyncio.to_thread 使用）大小固定为 async_blocking_workers，用于缓存、断点等本地阻塞操作；
+    访问外部服务的阻塞调用提交到 sharedExecutors 中对应后端的线程池。
+    """
+    global _loop, _loop_thread
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(ThreadPoolExecutor(max_workers=async_blocking_workers,
+                                                             thread_name_prefix="treeQA-blocking"))
+                thread = threading.Thread(target=loop.run_forever, name="treeQA-event-loop", daemon=True)
+                thread.start()
+                _loop_thread = thread
+                _loop = loop
+    return _loop
+
+
+def run_sync(coro):
+    """
+    在共享事件循环上执行协程并阻塞等待结果，供同步代码（如线程池中的节点核查）调用，
+    代替每次调用都新建一个事件循环的 asyncio.run。调用方的 contextvars（如当前 span）会带到协程中。
+    不能在共享事件循环所在的线程中调用，协程内部应直接 await。
+    """
+    loop = get_event_loop()
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise RuntimeError("run_sync() called from the shared event loop, await the coroutine instead")
+    result = concurrent.futures.Future()
+    context = contextvars.copy_context()
+
+    def _done(task):
+        if task.cancelled():
+            result.cancel()
+        elif task.exception() is not None:
+            result.set_exception(task.exception())
+        else:
+            result.set_result(task.result())
+
+    def _start():
+        # 在调用方上下文中创建任务，任务会复制该上下文
+        task = context.run(loop.create_task, coro)
+        task.add_done_callback(_done)
+
+    loop.call_soon_threadsafe(_start)
+    return result.result()
@@ -0,0 +1,197 @@
+import threading
+from concurrent.futures import Future
+
+from LLMs.singleFlight import SingleFlight
+from treeQA.wikidataUtills import getWikidataEntity, getAllRelationsOfQIDs, getRelationValue, getAnswerOfRelation, \
+    get_wikipedia_title_from_qid
+from treeQA.wikipediaUtills import embed_article_chunks, query_article_chunks, getWikipediaResultByNV
+from embedding.embeddingModel import getEmbeddings
+from treeQA_Config import Chroma_store
+
+_MISSING = object()
+
+
+class EvidenceStore:
+    """
+    一棵逻辑树内共享的证据缓存，所有节点（包括 new_clue 重新检索）在访问网络前先查这里：
+
+    - 实体标签 -> Wikidata 检索结果，QID -> 实体信息
+    - QID -> 全部关系（多个 QID 合并为一次批量 SPARQL 查询），(QID, PID, 方向) -> 关系取值
+    - QID -> 维基百科文章切块及其 embedding，chunk id -> 文本块
+
+    同一个键同时被多个线程请求时只会访问一次网络（SingleFlight）。
+    命中/未命中次数记录在 metrics 的 evidence_hits / evidence_misses 计数中。
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+        self._searches = {}
+        self.entities = {}
+        self._relations = {}
+        self._pending_relations = {}
+        self._values = {}
+        self._articles = {}
+        self._titles = {}
+        self.chunks = {}
+
+    def _get(self, table, kind, key, fetch):
+        with self._lock:
+            value = table.get(key, _MISSING)
+        if value is not _MISSING:
+            self.metrics.increment("evidence_hits")
+            return value
+
+        def load():
+            with self._lock:
+                cached = table.get(key, _MISSING)
+            if cached is not _MISSING:
+                return cached
+            self.metrics.increment("evidence_misses")
+            result = fetch()
+            with self._lock:
+                table[key] = result
+            return result
+
+        return self._single_flight.do((kind, key), load)
+
+    def search_entities(self, labels):
+        """getWikidataEntity 的缓存版本：每个标签只检索一次，返回合并后的 {QID: 实体信息}。"""
+        results = {}
+        for label in labels:
+            found = self._get(self._searches, "search", label,
+                              lambda: self.metrics.timed("wikidata_search", getWikidataEntity, [label]))
+            results.update(found)
+        with self._lock:
+            self.entities.update(results)
+        return results
+
+    def relations_of_many(self, QIDs):
+        """
+        多个 QID 的全部关系，返回 {QID: 关系}。未缓存的 QID 合并为一次 getAllRelationsOfQIDs 批量查询；
+        其他线程正在查询的 QID 等待其结果，不重复查询。查询失败的 QID 本次按空关系返回但不缓存，之后的节点会重新查询。
+        """
+        QIDs = [QID for QID in dict.fromkeys(QIDs) if QID]
+        results = {}
+        waiting = {}
+        fetching = []
+        with self._lock:
+            for QID in QIDs:
+                if QID in self._relations:
+                    results[QID] = self._relations[QID]
+                elif QID in self._pending_relations:
+                    waiting[QID] = self._pending_relations[QID]
+                else:
+                    self._pending_relations[QID] = Future()
+                    fetching.append(QID)
+        if results:
+            self.metrics.increment("evidence_hits", len(results))
+        if fetching:
+            self.metrics.increment("evidence_misses", len(fetching))
+            try:
+                failed = set()
+                fetched = self.metrics.timed("sparql_relations", getAllRelationsOfQIDs, fetching, failed=failed)
+            except BaseException as e:
+                with self._lock:
+                    for QID in fetching:
+                        self._pending_relations.pop(QID).set_exception(e)
+                raise
+            with self._lock:
+                for QID in fetching:
+                    if QID not in failed:
+                        self._relations[QID] = fetched[QID]
+                    self._pending_relations.pop(QID).set_result(fetched[QID])
+            results.update(fetched)
+        for QID, future in waiting.items():
+            results[QID] = future.result()
+        return {QID: results[QID] for QID in QIDs}
+
+    def relation_values(self, InfoByEntity):
+        """
+        为 InfoByEntity 中选中的关系填入取值（与 getRelationValue 相同的结构，原地修改并返回）。
+        已查询过的 (QID, PID, 方向) 直接使用缓存，其余的合并成一次 getRelationValue 调用。
+        """
+        missing = self._cached_values(InfoByEntity)
+        if missing:
+            with self.metrics.service("sparql_values"):
+                # getAnswerOfRelation 直接把取值写入传入的关系 dict，也就是 InfoByEntity 中的同一批对象
+                getRelationValue(missing)
+            self._store_values(missing)
+        return {QID: entry for QID, entry in InfoByEntity.items() if "pointed_relations" in entry}
+
+    async def relation_values_async(self, InfoByEntity):
+        """relation_values 的异步版本，未缓存的取值直接在当前事件循环上查询。"""
+        missing = self._cached_values(InfoByEntity)
+        if missing:
+            with self.metrics.service("sparql_values"):
+                await getAnswerOfRelation(missing)
+            self._store_values(missing)
+        return {QID: entry for QID, entry in InfoByEntity.items() if "pointed_relations" in entry}
+
+    def _cached_values(self, InfoByEntity):
+        """填入已缓存的取值，返回需要查询的 {QID: {方向: [关系]}}。"""
+        missing = {}
+        hits = 0
+        for QID, entry in InfoByEntity.items():
+            for direction in ("pointed_relations", "pointing_relations"):
+                for relation in entry.get(direction, []):
+                    with self._lock:
+                        value = self._values.get((QID, relation["id"], direction), _MISSING)
+                    if value is _MISSING:
+                        missing.setdefault(QID, {"pointed_relations": [], "pointing_relations": []})[
+                            direction].append(relation)
+                        continue
+                    hits += 1
+                    if value:
+                        relation["value"] = value
+        if hits:
+            self.metrics.increment("evidence_hits", hits)
+        if missing:
+            self.metrics.increment("evidence_misses",
+                                   sum(len(relations) for entry in missing.values() for relations in entry.values()))
+        return missing
+
+    def _store_values(self, missing):
+        with self._lock:
+            for QID, entry in missing.items():
+                for direction, relations in entry.items():
+                    for relation in relations:
+                        self._values[(QID, relation["id"], direction)] = relation.get("value")
+
+    def article(self, QID):
+        """QID 对应的维基百科文章切块和 embedding，每篇文章只获取和计算一次。"""
+        def fetch():
+            label = get_wikipedia_title_from_qid(QID)
+            if not label:
+                return label, [], None
+            chunks, chunk_embeddings = embed_article_chunks(label)
+            with self._lock:
+                for chunk in chunks:
+                    self.chunks[chunk["id"]] = chunk
+            return label, chunks, chunk_embeddings
+
+        return self._get(self._articles, "article", QID, lambda: self.metrics.timed("wikipedia", fetch))
+
+    def title(self, QID):
+        """get_wikipedia_title_from_qid 的缓存版本。"""
+        return self._get(self._titles, "title", QID, lambda: get_wikipedia_title_from_qid(QID))
+
+    def prefetch_article(self, QID):
+        """提前获取 QID 的维基百科文章（使用 Chroma 时只取标题），结果只写入缓存，供之后的 wikipedia_texts 使用。"""
+        if Chroma_store:
+            self.title(QID)
+        else:
+            self.article(QID)
+
+    def wikipedia_texts(self, QID, queries, top_k):
+        """为多个查询分别从 QID 的文章中取 top_k 个文本块，返回 {query: texts}。"""
+        if Chroma_store:
+            label = self.title(QID)
+            return {query: getWikipediaResultByNV(label, query, top_k=top_k) for query in queries}
+        label, chunks, chunk_embeddings = self.article(QID)
+        if not chunks:
+            return {query: [] for query in queries}
+        query_embeddings = getEmbeddings(list(queries))
+        return {query: query_article_chunks(chunks, chunk_embeddings, embedding, top_k)
+                for query, embedding in zip(queries, query_embeddings)}
@@ -1,47 +1,74 @@
 
+import asyncio
 import json
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from entitylinking.ELModels import llmForEntityExtract,llmForEntityFilter, linkEntity
-from treeQA.wikipediaUtills import getWikipediaResultByNV, getWikipediaResultDirect
-from treeQA_Config import Chroma_store, article_top_k, RLTop_k
-from treeQA.wikidataUtills import relationLinking, get_wikipedia_title_from_qid, getWikidataEntity, HEADERS
+from entitylinking.ELModels import llmForEntityExtract, llmForEntityExtractBatch, llmForEntityFilter, linkEntity, \
+    llmForEntityExtractAsync, llmForEntityExtractBatchAsync, llmForEntityFilterAsync, linkEntityAsync, \
+    llmForEntitySelect, llmForEntitySelectAsync
+from treeQA.sharedExecutors import get_executor, run_blocking
+from treeQA.tracing import span
+from treeQA.tree_class.infoBox import infoBox
+from treeQA_Config import article_top_k, RLTop_k, ELTop_k, speculative_prefetch, \
+    speculative_prefetch_candidates, entity_selection_mode
+from treeQA.wikidataUtills import relationLinking, selectRelations, relationTriples, relationLinkingAsync, selectRelationsAsync
 
-import requests
 
+def mergeLinkedEntities(entity_results, json_data):
+    """把实体链接结果并入 Wikidata 检索到的候选实体。"""
+    for entityLinkingItem in json_data:
+        # 避免消耗过多tokens只保留实体定义的第一句话
+        # 找到第一个句号的位置
+        first_sentence_end = entityLinkingItem['definition'].find('.')
 
+        # 提取第一句话
+        first_sentence = entityLinkingItem['definition'][
+                         :first_sentence_end + 1] if first_sentence_end != -1 else entityLinkingItem['definition']
+        entity_results[entityLinkingItem['wikidata']] = {
+            'text': entityLinkingItem['text'],
+            'wikidata': entityLinkingItem['wikidata'],
+            'definition': first_sentence
+        }
 
-def safe_request(url, params, my_proxies, max_retries=3):
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url,headers=HEADERS,params=params,proxies=my_proxies)
-            response.raise_for_status()  # 如果响应状态码不是200，则抛出HTTPError
-            return response.json()
-        except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError) as e:
-            if attempt < (max_retries - 1):  # i.e. if it's not the last retry
-                print(f"Request failed: {e}. Retrying ({attempt + 1}/{max_retries})...")
-                time.sleep(2 ** attempt)  # 指数退避
-            else:
-                raise  # 如果所有重试都失败了，就抛出最后一次异常
-    return None  # 如果没有异常抛出，返回None
 
+def _prefetch_candidates(entity_results, json_data):
+    """预取的候选 QID：实体链接结果在前，其余按 Wikidata 检索顺序，最多 speculative_prefetch_candidates 个。"""
+    linked = [entityLinkingItem['wikidata'] for entityLinkingItem in json_data]
+    return [QID for QID in dict.fromkeys(linked + list(entity_results)) if QID][:speculative_prefetch_candidates]
 
-# 获取文本信息
-def fetch_wikipedia_text(QID, query, top_k):
-    label = get_wikipedia_title_from_qid(QID)
-    if Chroma_store:
-        return getWikipediaResultByNV(label, query,top_k=top_k)
-    return getWikipediaResultDirect(label, query,top_k=top_k)
 
+def _start_prefetch(evidence, QIDs):
+    """
+    在实体过滤的大模型调用返回之前，为候选 QID 提前获取维基百科文章和全部关系（所有候选一次批量查询），
+    返回 [(涉及的 QID, future)]。结果写入 evidence，之后的正式检索命中缓存或等待仍在进行的请求。
+    """
+    QIDs = list(QIDs)
+    if not QIDs:
+        return []
+    prefetches = [({QID}, get_executor("wikipedia").submit(evidence.prefetch_article, QID)) for QID in QIDs]
+    prefetches.append((set(QIDs), get_executor("wikidata").submit(evidence.relations_of_many, QIDs)))
+    return prefetches
 
-def getQueryInfo(query, myInfoBox,logicTree,top_k=RLTop_k):
 
-    with ThreadPoolExecutor() as executor:
-        # Step 1: Parallel entity extraction and linking
-        entity_extract_future = executor.submit(llmForEntityExtract, query,logicTree)
+def _settle_prefetch(prefetches, kept, metrics):
+    """过滤掉的候选：取消还在排队的预取，已经开始的照常完成，结果只留在证据缓存中。"""
+    if not prefetches:
+        return
+    cancelled = sum(future.cancel() for QIDs, future in prefetches if QIDs.isdisjoint(kept))
+    metrics.increment("speculative_prefetches", len(prefetches))
+    if cancelled:
+        metrics.increment("speculative_cancelled", cancelled)
+
+
+def _extract_and_filter(query, logicTree):
+    """getQueryInfo 的 Step 1-3（entity_selection_mode 为 "two_step"），返回 (候选实体信息, 过滤后的实体 ID)。"""
+    evidence = logicTree.evidence
+
+    # Step 1: Parallel entity extraction and linking
+    with span("query_info.entities"):
+        entity_extract_future = get_executor("llm").submit(llmForEntityExtract, query,logicTree)
 
-        entity_linking_future = executor.submit(linkEntity, query)
+        entity_linking_future = get_executor("entity_linking").submit(logicTree.metrics.timed, "entity_linking",
+                                                                      linkEntity, query)
 
         entity_linking_result = entity_linking_future.result()
 
@@ -51,28 +78,37 @@ def getQueryInfo(query, myInfoBox,logicTree,top_k=RLTop_k):
         entities = entity_extract_future.result()
 
 
-        # Step 2: Parallel fetching of Wikidata entities and relation generalization
-
-        entity_results_future = executor.submit(getWikidataEntity, entities)
-        entity_results = entity_results_future.result()
-        #relaQuery = relation_generalization_future.result()
-        #print(f"可能涉及的关系：{relaQuery}")
-        # Merge entity linking results
-        for entityLinkingItem in json_data:
-            # 避免消耗过多tokens只保留实体定义的第一句话
-            # 找到第一个句号的位置
-            first_sentence_end = entityLinkingItem['definition'].find('.')
-
-            # 提取第一句话
-            first_sentence = entityLinkingItem['definition'][
-                             :first_sentence_end + 1] if first_sentence_end != -1 else entityLinkingItem['definition']
-            entity_results[entityLinkingItem['wikidata']] = {
-                'text': entityLinkingItem['text'],
-                'wikidata': entityLinkingItem['wikidata'],
-                'definition': first_sentence
-            }
-        # Step 3: Filter entities
+    # Step 2: Parallel fetching of Wikidata entities and relation generalization
+
+    with span("query_info.search", {"query_info.labels": len(entities)}):
+        entity_results = evidence.search_entities(entities)
+    #relaQuery = relation_generalization_future.result()
+    #print(f"可能涉及的关系：{relaQuery}")
+    # Merge entity linking results
+    mergeLinkedEntities(entity_results, json_data)
+    prefetches = _start_prefetch(evidence, _prefetch_candidates(entity_results, json_data)) \
+        if speculative_prefetch else []
+    # Step 3: Filter entities
+    with span("query_info.filter", {"query_info.candidates": len(entity_results)}):
         entityIDs = llmForEntityFilter(entity_results, query,logicTree)
+    _settle_prefetch(prefetches, set(entityIDs), logicTree.metrics)
+    return entity_results, entityIDs
+
+
+def getQueryInfo(query, myInfoBox,logicTree,top_k=RLTop_k):
+    """
+    单个查询的检索。实体、关系和文章都经过树内共享的 logicTree.evidence，已获取过的不再访问网络。
+    并行的步骤提交到各后端共享的线程池（sharedExecutors），每一步对应一个 query_info.* span。
+    """
+    evidence = logicTree.evidence
+
+    with span("query_info", {"query_info.mode": "single"}):
+        # Step 1-3: 实体抽取和链接、Wikidata 检索、实体过滤
+        if entity_selection_mode == "fused":
+            entity_results_by_query, qids_by_query = _select_entities_fused([query], logicTree)
+            entity_results, entityIDs = entity_results_by_query[query], qids_by_query[query]
+        else:
+            entity_results, entityIDs = _extract_and_filter(query, logicTree)
         # Save filtered results
         retrieve_QID = []
         itemInfo_filtered = []
@@ -85,16 +121,404 @@ def getQueryInfo(query, myInfoBox,logicTree,top_k=RLTop_k):
         # Step 4: Parallel retrieval of graph content and Wikipedia text
 
         #print(entityIDs, relaQuery, entity_results, query, top_k, myInfoBox)
-        retrieve_relation_future = executor.submit(relationLinking, entityIDs, query,entity_results,myInfoBox, top_k,logicTree)
+        with span("query_info.retrieve", {"query_info.qids": len(retrieve_QID)}):
+            retrieve_relation_future = get_executor("wikidata").submit(relationLinking, entityIDs, query,entity_results,myInfoBox, top_k,logicTree)
 
-        # Parallel fetching of Wikipedia texts
-        futures = [executor.submit(fetch_wikipedia_text, QID, query, top_k=article_top_k) for QID in retrieve_QID]
+            # Parallel fetching of Wikipedia texts
+            futures = [get_executor("wikipedia").submit(evidence.wikipedia_texts, QID, [query], article_top_k)
+                       for QID in retrieve_QID]
 
-        for future in as_completed(futures):
-            text = future.result()
-            myInfoBox.addText(text)
+            # 按提交顺序加入文本，infoBox 的内容（及之后的 prompt）不受完成先后影响
+            for future in futures:
+                text = future.result()[query]
+                myInfoBox.addText(text)
 
-        retrieve_relation_List = retrieve_relation_future.result()
+            retrieve_relation_List = retrieve_relation_future.result()
     return retrieve_QID, list(retrieve_relation_List)
 
 
+def _filtered_qids(queries, entity_results_by_query, filtered):
+    """按查询整理实体过滤结果，返回 {query: [QID]}。"""
+    qids_by_query = {}
+    for query, entityIDs in zip(queries, filtered):
+        entity_results = entity_results_by_query[query]
+        # 过滤结果中不在候选里的 ID 无法取到标签和定义，直接丢弃
+        qids_by_query[query] = [QID for QID in dict.fromkeys(entityIDs) if QID and QID in entity_results]
+    return qids_by_query
+
+
+def _queries_by_qid(qids_by_query):
+    queries_by_qid = {}
+    for query, qids in qids_by_query.items():
+        for QID in qids:
+            queries_by_qid.setdefault(QID, []).append(query)
+    return queries_by_qid
+
+
+def _merge_selections(pairs, results):
+    """
+    pairs 为 (query, QID)，results 为对应的 selectRelations 结果或异常。
+    返回 (按 QID 合并后待查询取值的关系, {(query, QID): (pointed_relations, pointing_relations)})。
+    """
+    merged = {}
+    selections = {}
+    for (query, QID), result in zip(pairs, results):
+        if isinstance(result, Exception):
+            print(f"Relation selection failed for {QID}: {result}")
+            pointed_relations, pointing_relations = [], []
+        else:
+            pointed_relations, pointing_relations, _ = result
+        selections[(query, QID)] = (pointed_relations, pointing_relations)
+        entry = merged.setdefault(QID, {"pointed_relations": [], "pointing_relations": []})
+        entry["pointed_relations"].extend(dict(relation) for relation in pointed_relations)
+        entry["pointing_relations"].extend(dict(relation) for relation in pointing_relations)
+    return merged, selections
+
+
+def _query_answers(query, qids, selections):
+    answersInfo = {}
+    for QID in qids:
+        pointed_relations, pointing_relations = selections[(query, QID)]
+        answersInfo[QID] = {"pointed_relations": [dict(relation) for relation in pointed_relations],
+                            "pointing_relations": [dict(relation) for relation in pointing_relations]}
+    return answersInfo
+
+
+def _extract_and_filter_batch(queries, logicTree):
+    """
+    getTreeQueryInfo 的 Step 1-3（entity_selection_mode 为 "two_step"）。
+    返回 ({query: 候选实体信息}, {query: [QID]})。
+    """
+    metrics = logicTree.metrics
+    evidence = logicTree.evidence
+
+    # Step 1: 实体链接按查询并行，实体抽取合并为一次调用
+    with span("query_info.entities"):
+        linking_futures = {query: get_executor("entity_linking").submit(metrics.timed, "entity_linking",
+                                                                        linkEntity, query)
+                           for query in queries}
+        entities_by_query = llmForEntityExtractBatch(queries, logicTree)
+
+    # Step 2: 每个不同的实体标签只检索一次 Wikidata
+    with span("query_info.search"):
+        labels = list(dict.fromkeys(label for entities in entities_by_query.values() for label in entities))
+        search_futures = {label: get_executor("wikidata").submit(evidence.search_entities, [label])
+                          for label in labels}
+        entity_results_by_query = {}
+        candidates = []
+        for query in queries:
+            entity_results = {}
+            for label in entities_by_query[query]:
+                entity_results.update(search_futures[label].result())
+            json_data = json.loads(linking_futures[query].result())
+            mergeLinkedEntities(entity_results, json_data)
+            entity_results_by_query[query] = entity_results
+            candidates.extend(_prefetch_candidates(entity_results, json_data))
+    prefetches = _start_prefetch(evidence, dict.fromkeys(candidates)) if speculative_prefetch else []
+
+    # Step 3: 按查询过滤实体
+    with span("query_info.filter"):
+        filter_futures = [get_executor("llm").submit(llmForEntityFilter, entity_results_by_query[query], query, logicTree)
+                          for query in queries]
+        qids_by_query = _filtered_qids(queries, entity_results_by_query,
+                                       [future.result() for future in filter_futures])
+    _settle_prefetch(prefetches, _queries_by_qid(qids_by_query), metrics)
+    return entity_results_by_query, qids_by_query
+
+
+def _fused_qids(queries, entity_results_by_query, selections, searched):
+    """
+    合并融合选择的结果，返回 {query: [QID]}：选中的候选在前，其后是每个检索名在 Wikidata 中排名第一的实体，
+    最多 ELTop_k 个。检索到的实体信息写入该查询的候选中。
+    """
+    qids_by_query = {}
+    for query, (qids, surface_forms) in zip(queries, selections):
+        entity_results = entity_results_by_query[query]
+        selected = [QID for QID in qids if QID in entity_results]
+        for label in surface_forms:
+            found = searched[label]
+            if found:
+                QID = next(iter(found))
+                entity_results[QID] = found[QID]
+                selected.append(QID)
+        qids_by_query[query] = list(dict.fromkeys(selected))[:ELTop_k]
+    return qids_by_query
+
+
+def _select_entities_fused(queries, logicTree):
+    """
+    entity_selection_mode 为 "fused" 时的 Step 1-3：以实体链接结果为候选，每个查询只调用一次大模型，
+    同时选出 QID 并给出候选中缺少的实体名，省去单独的实体抽取调用。返回 ({query: 候选实体信息}, {query: [QID]})。
+    """
+    metrics = logicTree.metrics
+    evidence = logicTree.evidence
+
+    # Step 1: 实体链接按查询并行
+    with span("query_info.entities"):
+        linking_futures = {query: get_executor("entity_linking").submit(metrics.timed, "entity_linking",
+                                                                        linkEntity, query)
+                           for query in queries}
+        entity_results_by_query = {}
+        candidates = []
+        for query in queries:
+            json_data = json.loads(linking_futures[query].result())
+            entity_results = {}
+            mergeLinkedEntities(entity_results, json_data)
+            entity_results_by_query[query] = entity_results
+            candidates.extend(_prefetch_candidates(entity_results, json_data))
+    prefetches = _start_prefetch(evidence, dict.fromkeys(candidates)) if speculative_prefetch else []
+
+    # Step 2: 按查询选择实体
+    with span("query_info.select"):
+        select_futures = [get_executor("llm").submit(llmForEntitySelect, entity_results_by_query[query], query,
+                                                     logicTree)
+                          for query in queries]
+        selections = [future.result() for future in select_futures]
+
+    # Step 3: 候选中缺少的实体名在 Wikidata 检索，每个名称只检索一次
+    with span("query_info.search"):
+        labels = list(dict.fromkeys(label for _, surface_forms in selections for label in surface_forms))
+        search_futures = {label: get_executor("wikidata").submit(evidence.search_entities, [label])
+                          for label in labels}
+        searched = {label: future.result() for label, future in search_futures.items()}
+    qids_by_query = _fused_qids(queries, entity_results_by_query, selections, searched)
+    _settle_prefetch(prefetches, _queries_by_qid(qids_by_query), metrics)
+    return entity_results_by_query, qids_by_query
+
+
+def getTreeQueryInfo(queries, logicTree, top_k=RLTop_k):
+    """
+    整棵树的批量检索：所有节点的查询一起做实体抽取，每个不同的实体标签、QID、关系和维基百科文章只访问一次，
+    再把证据分发到各个查询自己的 infoBox 中。返回 {query: infoBox}。
+    实体过滤和关系挑选与问题相关，仍按查询分别调用大模型（并行执行）。
+    获取到的证据保存在 logicTree.evidence 中，之后的单节点检索和 new_clue 重试也会复用。
+    """
+    queries = list(dict.fromkeys(queries))
+    boxes = {query: infoBox() for query in queries}
+    if not queries:
+        return boxes
+    metrics = logicTree.metrics
+    evidence = logicTree.evidence
+
+    with span("query_info", {"query_info.mode": "tree", "query_info.queries": len(queries)}):
+        # Step 1-3: 实体抽取和链接、Wikidata 检索、实体过滤
+        if entity_selection_mode == "fused":
+            entity_results_by_query, qids_by_query = _select_entities_fused(queries, logicTree)
+        else:
+            entity_results_by_query, qids_by_query = _extract_and_filter_batch(queries, logicTree)
+
+        # Step 4: 每个 QID 只查询一次全部关系和维基百科文章
+        with span("query_info.retrieve"):
+            queries_by_qid = _queries_by_qid(qids_by_query)
+            relations_future = get_executor("wikidata").submit(evidence.relations_of_many, list(queries_by_qid))
+            text_futures = [get_executor("wikipedia").submit(evidence.wikipedia_texts, QID, qid_queries, article_top_k)
+                            for QID, qid_queries in queries_by_qid.items()]
+
+            # Step 5: 按查询挑选关系，再把所有 (QID, 关系, 方向) 合并后一次性查询取值
+            pairs = [(query, QID) for query, qids in qids_by_query.items() for QID in qids]
+            relations_by_qid = relations_future.result()
+            selection_futures = [get_executor("llm").submit(selectRelations, query, relations_by_qid[QID], top_k,
+                                                            logicTree)
+                                 for query, QID in pairs]
+            results = []
+            for future in selection_futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(e)
+            merged, selections = _merge_selections(pairs, results)
+            try:
+                evidence.relation_values(merged)
+            except Exception as e:
+                print(e)
+
+        for query, qids in qids_by_query.items():
+            answersInfo = _query_answers(query, qids, selections)
+            try:
+                # 取值都已在上一步查询过，这里只读缓存
+                answersInfo = evidence.relation_values(answersInfo)
+            except Exception as e:
+                print(e)
+            boxes[query].addGraph(json_array=relationTriples(answersInfo, entity_results_by_query[query]))
+
+        for future in text_futures:
+            for query, text in future.result().items():
+                boxes[query].addText(text)
+    return boxes
+
+
+async def _extract_and_filter_async(query, logicTree):
+    """_extract_and_filter 的异步版本。"""
+    evidence = logicTree.evidence
+    metrics = logicTree.metrics
+
+    # Step 1: 实体抽取和实体链接同时进行
+    with span("query_info.entities"):
+        entities, entity_linking_result = await asyncio.gather(
+            llmForEntityExtractAsync(query, logicTree),
+            metrics.timed_async("entity_linking", linkEntityAsync, query),
+        )
+
+    # Step 2: 检索 Wikidata 实体并合并实体链接结果
+    with span("query_info.search", {"query_info.labels": len(entities)}):
+        entity_results = await run_blocking("wikidata", evidence.search_entities, entities)
+    json_data = json.loads(entity_linking_result)
+    mergeLinkedEntities(entity_results, json_data)
+    prefetches = _start_prefetch(evidence, _prefetch_candidates(entity_results, json_data)) \
+        if speculative_prefetch else []
+
+    # Step 3: 过滤实体
+    with span("query_info.filter", {"query_info.candidates": len(entity_results)}):
+        entityIDs = await llmForEntityFilterAsync(entity_results, query, logicTree)
+    _settle_prefetch(prefetches, set(entityIDs), metrics)
+    return entity_results, entityIDs
+
+
+async def getQueryInfoAsync(query, myInfoBox, logicTree, top_k=RLTop_k):
+    """
+    getQueryInfo 的异步版本，供异步流水线使用：大模型调用、实体链接和 SPARQL 取值直接在事件循环上并发，
+    没有异步客户端的检索（Wikidata API、维基百科、embedding）提交到对应后端的共享线程池中执行。
+    """
+    evidence = logicTree.evidence
+    metrics = logicTree.metrics
+
+    with span("query_info", {"query_info.mode": "async"}):
+        # Step 1-3: 实体抽取和链接、Wikidata 检索、实体过滤
+        if entity_selection_mode == "fused":
+            entity_results_by_query, qids_by_query = await _select_entities_fused_async([query], logicTree)
+            entity_results, entityIDs = entity_results_by_query[query], qids_by_query[query]
+        else:
+            entity_results, entityIDs = await _extract_and_filter_async(query, logicTree)
+        retrieve_QID = [entityID for entityID in entityIDs if entityID]
+
+        # Step 4: 图谱关系和维基百科文本同时检索
+        with span("query_info.retrieve", {"query_info.qids": len(retrieve_QID)}):
+            retrieve_relation_List, *texts = await asyncio.gather(
+                relationLinkingAsync(entityIDs, query, entity_results, myInfoBox, top_k, logicTree),
+                *(run_blocking("wikipedia", evidence.wikipedia_texts, QID, [query], article_top_k)
+                  for QID in retrieve_QID),
+            )
+        for text in texts:
+            myInfoBox.addText(text[query])
+    return retrieve_QID, list(retrieve_relation_List)
+
+
+async def _extract_and_filter_batch_async(queries, logicTree):
+    """_extract_and_filter_batch 的异步版本。"""
+    metrics = logicTree.metrics
+    evidence = logicTree.evidence
+
+    # Step 1: 实体链接按查询并发，实体抽取合并为一次调用
+    with span("query_info.entities"):
+        linking_results, entities_by_query = await asyncio.gather(
+            asyncio.gather(*(metrics.timed_async("entity_linking", linkEntityAsync, query) for query in queries)),
+            llmForEntityExtractBatchAsync(queries, logicTree),
+        )
+
+    # Step 2: 每个不同的实体标签只检索一次 Wikidata
+    with span("query_info.search"):
+        labels = list(dict.fromkeys(label for entities in entities_by_query.values() for label in entities))
+        searched = await asyncio.gather(*(run_blocking("wikidata", evidence.search_entities, [label])
+                                          for label in labels))
+        search_results = dict(zip(labels, searched))
+        entity_results_by_query = {}
+        candidates = []
+        for query, linking_result in zip(queries, linking_results):
+            entity_results = {}
+            for label in entities_by_query[query]:
+                entity_results.update(search_results[label])
+            json_data = json.loads(linking_result)
+            mergeLinkedEntities(entity_results, json_data)
+            entity_results_by_query[query] = entity_results
+            candidates.extend(_prefetch_candidates(entity_results, json_data))
+    prefetches = _start_prefetch(evidence, dict.fromkeys(candidates)) if speculative_prefetch else []
+
+    # Step 3: 按查询过滤实体
+    with span("query_info.filter"):
+        filtered = await asyncio.gather(*(llmForEntityFilterAsync(entity_results_by_query[query], query, logicTree)
+                                          for query in queries))
+        qids_by_query = _filtered_qids(queries, entity_results_by_query, filtered)
+    _settle_prefetch(prefetches, _queries_by_qid(qids_by_query), metrics)
+    return entity_results_by_query, qids_by_query
+
+
+async def _select_entities_fused_async(queries, logicTree):
+    """_select_entities_fused 的异步版本。"""
+    metrics = logicTree.metrics
+    evidence = logicTree.evidence
+
+    # Step 1: 实体链接按查询并发
+    with span("query_info.entities"):
+        linking_results = await asyncio.gather(*(metrics.timed_async("entity_linking", linkEntityAsync, query)
+                                                 for query in queries))
+        entity_results_by_query = {}
+        candidates = []
+        for query, linking_result in zip(queries, linking_results):
+            json_data = json.loads(linking_result)
+            entity_results = {}
+            mergeLinkedEntities(entity_results, json_data)
+            entity_results_by_query[query] = entity_results
+            candidates.extend(_prefetch_candidates(entity_results, json_data))
+    prefetches = _start_prefetch(evidence, dict.fromkeys(candidates)) if speculative_prefetch else []
+
+    # Step 2: 按查询选择实体
+    with span("query_info.select"):
+        selections = await asyncio.gather(*(llmForEntitySelectAsync(entity_results_by_query[query], query, logicTree)
+                                            for query in queries))
+
+    # Step 3: 候选中缺少的实体名在 Wikidata 检索，每个名称只检索一次
+    with span("query_info.search"):
+        labels = list(dict.fromkeys(label for _, surface_forms in selections for label in surface_forms))
+        searched = await asyncio.gather(*(run_blocking("wikidata", evidence.search_entities, [label])
+                                          for label in labels))
+    qids_by_query = _fused_qids(queries, entity_results_by_query, selections, dict(zip(labels, searched)))
+    _settle_prefetch(prefetches, _queries_by_qid(qids_by_query), metrics)
+    return entity_results_by_query, qids_by_query
+
+
+async def getTreeQueryInfoAsync(queries, logicTree, top_k=RLTop_k):
+    """getTreeQueryInfo 的异步版本，返回 {query: infoBox}。"""
+    queries = list(dict.fromkeys(queries))
+    boxes = {query: infoBox() for query in queries}
+    if not queries:
+        return boxes
+    metrics = logicTree.metrics
+    evidence = logicTree.evidence
+
+    with span("query_info", {"query_info.mode": "tree_async", "query_info.queries": len(queries)}):
+        # Step 1-3: 实体抽取和链接、Wikidata 检索、实体过滤
+        if entity_selection_mode == "fused":
+            entity_results_by_query, qids_by_query = await _select_entities_fused_async(queries, logicTree)
+        else:
+            entity_results_by_query, qids_by_query = await _extract_and_filter_batch_async(queries, logicTree)
+
+        # Step 4: 每个 QID 只查询一次全部关系和维基百科文章，文章在后台检索
+        with span("query_info.retrieve"):
+            queries_by_qid = _queries_by_qid(qids_by_query)
+            texts = asyncio.gather(*(run_blocking("wikipedia", evidence.wikipedia_texts, QID, qid_queries, article_top_k)
+                                     for QID, qid_queries in queries_by_qid.items()))
+            relations_by_qid = await run_blocking("wikidata", evidence.relations_of_many, list(queries_by_qid))
+
+            # Step 5: 按查询挑选关系，再把所有 (QID, 关系, 方向) 合并后一次性查询取值
+            pairs = [(query, QID) for query, qids in qids_by_query.items() for QID in qids]
+            results = await asyncio.gather(*(selectRelationsAsync(query, relations_by_qid[QID], top_k, logicTree)
+                                             for query, QID in pairs), return_exceptions=True)
+            merged, selections = _merge_selections(pairs, results)
+            try:
+                await evidence.relation_values_async(merged)
+            except Exception as e:
+                print(e)
+
+        for query, qids in qids_by_query.items():
+            answersInfo = _query_answers(query, qids, selections)
+            try:
+                # 取值都已在上一步查询过，这里只读缓存
+                answersInfo = await evidence.relation_values_async(answersInfo)
+            except Exception as e:
+                print(e)
+            boxes[query].addGraph(json_array=relationTriples(answersInfo, entity_results_by_query[query]))
+
+        for result in await texts:
+            for query, text in result.items():
+                boxes[query].addText(text)
+    return boxes
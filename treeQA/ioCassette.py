@@ -0,0 +1,243 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from array import array
+
+from treeQA.tracing import span
+from treeQA_Config import io_cassette_mode, io_cassette_path, io_cassette_latency
+
+
+class CassetteMiss(Exception):
+    """回放模式下找不到对应请求的录制结果。"""
+
+
+def _normalize(obj):
+    # 请求参数里可能出现 set（如 searchWikiID 的 params），排序后保证键稳定
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    return str(obj)
+
+
+def request_key(service, request):
+    payload = json.dumps([service, request], ensure_ascii=False, sort_keys=True, default=_normalize)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def _is_vector_list(obj):
+    return (isinstance(obj, list) and obj and isinstance(obj[0], list) and obj[0]
+            and all(isinstance(v, float) for v in obj[0]))
+
+
+def _pack(obj):
+    """把 embedding 向量列表压成 float32 + base64，其它内容原样保存。"""
+    if _is_vector_list(obj):
+        flat = array("f")
+        for row in obj:
+            flat.extend(row)
+        return {"__f32__": [len(obj), base64.b64encode(flat.tobytes()).decode("ascii")]}
+    return obj
+
+
+def _unpack(obj):
+    if isinstance(obj, dict) and "__f32__" in obj:
+        rows, data = obj["__f32__"]
+        flat = array("f")
+        flat.frombytes(base64.b64decode(data))
+        dim = len(flat) // rows if rows else 0
+        return [flat[i * dim:(i + 1) * dim].tolist() for i in range(rows)]
+    return obj
+
+
+class Cassette:
+    """
+    外部 I/O 的录制/回放。
+
+    - record：正常访问外部服务，并把每个 (请求, 响应) 追加写入 gzip 压缩的 JSONL 文件。
+    - replay：不访问网络，直接从文件返回录制的响应；latency 为 "recorded" 时按录制时的耗时等待，
+      为数字时每次固定等待该秒数，为 None 时不等待。
+    只录制成功的调用；回放时找不到请求会抛出 CassetteMiss。
+    """
+
+    def __init__(self, path, mode, latency=None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Invalid cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if mode == "replay":
+            self._load()
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 录制进程中断时最后一行可能不完整
+                    continue
+                self._entries[entry["k"]] = entry
+        print(f"Loaded {len(self._entries)} recorded responses from {self.path}")
+
+    def _record(self, key, service, response, elapsed):
+        line = json.dumps({"k": key, "s": service, "t": round(elapsed, 4), "r": _pack(response)},
+                          ensure_ascii=False)
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = True
+            if self._file is None:
+                self._file = gzip.open(self.path, "at", encoding="utf-8")
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def _lookup(self, service, request):
+        key = request_key(service, request)
+        entry = self._entries.get(key)
+        if entry is None:
+            raise CassetteMiss(f"No recorded response for {service} request {str(request)[:200]}")
+        return entry
+
+    def _delay(self, entry):
+        if self.latency == "recorded":
+            return entry.get("t", 0.0)
+        return self.latency or 0.0
+
+    def call(self, service, request, fn, on_replay=None):
+        if self.mode == "replay":
+            entry = self._lookup(service, request)
+            delay = self._delay(entry)
+            if delay:
+                time.sleep(delay)
+            response = _unpack(entry["r"])
+            if on_replay is not None:
+                on_replay(response)
+            return response
+        start = time.perf_counter()
+        response = fn()
+        self._record(request_key(service, request), service, response, time.perf_counter() - start)
+        return response
+
+    async def call_async(self, service, request, coro_fn, on_replay=None):
+        if self.mode == "replay":
+            entry = self._lookup(service, request)
+            delay = self._delay(entry)
+            if delay:
+                await asyncio.sleep(delay)
+            response = _unpack(entry["r"])
+            if on_replay is not None:
+                on_replay(response)
+            return response
+        start = time.perf_counter()
+        response = await coro_fn()
+        self._record(request_key(service, request), service, response, time.perf_counter() - start)
+        return response
+
+    def call_many(self, service, requests, fn):
+        if self.mode == "replay":
+            entries = [self._lookup(service, request) for request in requests]
+            delay = max((self._delay(entry) for entry in entries), default=0.0)
+            if delay:
+                time.sleep(delay)
+            return [_unpack(entry["r"]) for entry in entries]
+        start = time.perf_counter()
+        responses = fn()
+        self._record_many(service, requests, responses, time.perf_counter() - start)
+        return responses
+
+    async def call_many_async(self, service, requests, coro_fn):
+        if self.mode == "replay":
+            entries = [self._lookup(service, request) for request in requests]
+            delay = max((self._delay(entry) for entry in entries), default=0.0)
+            if delay:
+                await asyncio.sleep(delay)
+            return [_unpack(entry["r"]) for entry in entries]
+        start = time.perf_counter()
+        responses = await coro_fn()
+        self._record_many(service, requests, responses, time.perf_counter() - start)
+        return responses
+
+    def _record_many(self, service, requests, responses, elapsed):
+        # 批量调用失败（返回 None）时不录制
+        if responses is None:
+            return
+        for request, response in zip(requests, responses):
+            self._record(request_key(service, request), service, response, elapsed)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def get_cassette():
+    """io_cassette_mode 为 record/replay 时返回进程内共享的 Cassette，否则返回 None。"""
+    global _cassette
+    if io_cassette_mode not in ("record", "replay"):
+        return None
+    if _cassette is None:
+        with _cassette_lock:
+            if _cassette is None:
+                _cassette = Cassette(io_cassette_path, io_cassette_mode, io_cassette_latency)
+    return _cassette
+
+
+def cassette_call(service, request, fn, on_replay=None):
+    """
+    经过录制/回放层执行一次外部调用：fn 无参数，返回可 JSON 序列化的结果。
+    未开启录制/回放时直接调用 fn()。每次调用对应一个 io.<service> span，回放的调用带有 io.replayed 属性。
+    """
+    cassette = get_cassette()
+    with span(f"io.{service}", {"io.service": service, "io.replayed": io_cassette_mode == "replay"}):
+        if cassette is None:
+            return fn()
+        return cassette.call(service, request, fn, on_replay)
+
+
+async def cassette_call_async(service, request, coro_fn, on_replay=None):
+    """cassette_call 的异步版本，coro_fn 无参数并返回协程。"""
+    cassette = get_cassette()
+    with span(f"io.{service}", {"io.service": service, "io.replayed": io_cassette_mode == "replay"}):
+        if cassette is None:
+            return await coro_fn()
+        return await cassette.call_async(service, request, coro_fn, on_replay)
+
+
+def cassette_call_many(service, requests, fn):
+    """
+    一次批量外部调用，按条录制/回放：requests 为每一条的请求，fn 无参数，返回与 requests 一一对应的响应列表，
+    失败时返回 None（不录制）。录制时每条响应单独保存，回放时逐条查找，因此批次怎样组合（取决于其他线程
+    已缓存或正在查询的内容）不影响回放；单条调用使用相同的 service 和请求时，两者的录制可以互相回放。
+    """
+    cassette = get_cassette()
+    with span(f"io.{service}", {"io.service": service, "io.replayed": io_cassette_mode == "replay",
+                                "io.batch_size": len(requests)}):
+        if cassette is None:
+            return fn()
+        return cassette.call_many(service, requests, fn)
+
+
+async def cassette_call_many_async(service, requests, coro_fn):
+    """cassette_call_many 的异步版本，coro_fn 无参数并返回协程。"""
+    cassette = get_cassette()
+    with span(f"io.{service}", {"io.service": service, "io.replayed": io_cassette_mode == "replay",
+                                "io.batch_size": len(requests)}):
+        if cassette is None:
+            return await coro_fn()
+        return await cassette.call_many_async(service, requests, coro_fn)
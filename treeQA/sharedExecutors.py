@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+
+from treeQA.tracing import TracedThreadPoolExecutor
+from treeQA_Config import executor_workers
+
+# 按后端划分的线程池，检索代码按调用的服务选择其中一个提交任务
+RESOURCES = ("llm", "wikidata", "wikipedia", "embedding", "entity_linking")
+# 逻辑树层面的线程池：verification 执行并行核查的节点任务，prefetch 执行流式建树时的节点预取。
+# 这些任务本身会向上面的检索线程池提交调用并等待，因此与检索线程池分开，避免在同一个池内嵌套提交造成死锁
+TREE_RESOURCES = ("verification", "prefetch")
+
+
+class BoundedExecutor(TracedThreadPoolExecutor):
+    """
+    进程内共享、大小固定的线程池，限制同时访问同一后端的阻塞调用数。
+    记录排队深度（已提交、尚未开始执行的任务数）及其峰值、正在执行的任务数和累计排队等待时间。
+    """
+
+    def __init__(self, name, max_workers):
+        super().__init__(max_workers=max_workers, thread_name_prefix=f"treeQA-{name}")
+        self.name = name
+        self.max_workers = max_workers
+        self._stats_lock = threading.Lock()
+        self._queued = 0
+        self._peak_queued = 0
+        self._active = 0
+        self._submitted = 0
+        self._wait = 0.0
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted_at = time.perf_counter()
+
+        def run():
+            with self._stats_lock:
+                self._queued -= 1
+                self._active += 1
+                self._wait += time.perf_counter() - submitted_at
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self._active -= 1
+
+        def cancelled(future):
+            # 排队时被取消的任务不会执行 run，这里把它移出排队计数
+            if future.cancelled():
+                with self._stats_lock:
+                    self._queued -= 1
+
+        with self._stats_lock:
+            self._queued += 1
+            self._submitted += 1
+            self._peak_queued = max(self._peak_queued, self._queued)
+        future = super().submit(run)
+        future.add_done_callback(cancelled)
+        return future
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "workers": self.max_workers,
+                "queued": self._queued,
+                "peak_queued": self._peak_queued,
+                "active": self._active,
+                "submitted": self._submitted,
+                "avg_queue_wait": self._wait / self._submitted if self._submitted else 0.0,
+            }
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(resource):
+    """返回 resource（RESOURCES 或 TREE_RESOURCES 之一）对应的共享线程池，大小由 executor_workers 配置，首次使用时创建。"""
+    if resource not in RESOURCES and resource not in TREE_RESOURCES:
+        raise ValueError(f"Invalid executor resource: {resource}")
+    executor = _executors.get(resource)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(resource)
+            if executor is None:
+                executor = BoundedExecutor(resource, executor_workers[resource])
+                _executors[resource] = executor
+    return executor
+
+
+async def run_blocking(resource, fn, *args, **kwargs):
+    """异步流水线中代替 asyncio.to_thread：在 resource 对应的共享线程池中执行阻塞调用并等待结果。"""
+    return await asyncio.wrap_future(get_executor(resource).submit(fn, *args, **kwargs))
+
+
+def executor_stats():
+    """已创建的各线程池的排队和执行统计，{resource: stats}。"""
+    with _executors_lock:
+        executors = dict(_executors)
+    return {resource: executor.stats() for resource, executor in executors.items()}
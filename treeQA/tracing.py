@@ -0,0 +1,103 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from treeQA_Config import tracing_exporter, tracing_file_path, tracing_service_name
+
+
+class _NoopSpan:
+    """关闭追踪时 span() 返回的占位对象。"""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def _create_tracer():
+    # 只在开启追踪时才导入 OpenTelemetry
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    if tracing_exporter == "console":
+        exporter = ConsoleSpanExporter()
+    elif tracing_exporter == "file":
+        directory = os.path.dirname(tracing_file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 每个 span 一行 JSON，追加写入
+        exporter = ConsoleSpanExporter(out=open(tracing_file_path, "a", encoding="utf-8"),
+                                       formatter=lambda span: span.to_json(indent=None) + "\n")
+    else:
+        raise ValueError(f"Invalid tracing exporter: {tracing_exporter}")
+    provider = TracerProvider(resource=Resource.create({"service.name": tracing_service_name}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer("treeQA")
+
+
+def get_tracer():
+    """tracing_exporter 为 console/file 时返回进程内共享的 Tracer，否则返回 None。"""
+    global _tracer
+    if tracing_exporter == "off":
+        return None
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = _create_tracer()
+    return _tracer
+
+
+def _clean(attributes):
+    # OpenTelemetry 属性只接受基本类型，None 值直接丢弃
+    cleaned = {}
+    for key, value in (attributes or {}).items():
+        if value is None:
+            continue
+        if not isinstance(value, (bool, int, float, str)):
+            value = str(value)
+        cleaned[key] = value
+    return cleaned
+
+
+@contextmanager
+def span(name, attributes=None):
+    """
+    以 name 开启一个 span 并设为当前 span，退出时结束；异常会记录在 span 上后继续抛出。
+    关闭追踪时不做任何事，返回的对象同样支持 set_attribute / set_attributes。
+    """
+    tracer = get_tracer()
+    if tracer is None:
+        yield _NOOP_SPAN
+        return
+    with tracer.start_as_current_span(name, attributes=_clean(attributes)) as current:
+        yield current
+
+
+def set_attributes(attributes):
+    """给当前 span 添加属性（如 token 数、字节数、缓存命中、重试次数）。"""
+    if get_tracer() is None:
+        return
+    from opentelemetry import trace
+    trace.get_current_span().set_attributes(_clean(attributes))
+
+
+class TracedThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    提交任务时带上提交方的 contextvars 上下文，线程池中产生的 span 挂在提交时的当前 span 之下，
+    而不是各自成为新的根 span。
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
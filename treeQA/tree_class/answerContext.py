@@ -0,0 +1,62 @@
+def _tokens(text):
+    # 与 LLMs.rateLimiter.estimate_tokens 相同的粗略估计：约 4 个字符一个 token
+    return len(text) // 4 + 1
+
+
+def shortest_evidence(ref):
+    """从节点的 ref 中取最短的一条证据（wikidata 三元组或 "title||content" 形式的维基百科文本）。"""
+    if not ref:
+        return None
+    candidates = []
+    for ref_list in ref.values():
+        if isinstance(ref_list, str):
+            ref_list = [ref_list]
+        if not isinstance(ref_list, list):
+            continue
+        for item in ref_list:
+            item = str(item).strip()
+            if item and item != "No Information provided.":
+                candidates.append(item)
+    return min(candidates, key=len) if candidates else None
+
+
+def build_answer_context(root, max_tokens):
+    """
+    为 update_final_answer 生成紧凑的证据摘要：每个节点一行，包含编号、子问题、（修正后的）答案、
+    核查状态和最短的一条支撑证据。
+
+    总长度不超过 max_tokens（估计值）。超出时按深度优先保留：先放入所有能放下的浅层节点的问答，
+    再按同样的顺序为节点补上证据；放不下的节点被省略并在末尾注明数量。
+    """
+    nodes = [node for node in root.iter_subtree() if node.has_qa()]
+    lines = {}
+    for node in nodes:
+        number = ".".join(str(i + 1) for i in node.path)
+        line = f"[{number}] Q: {node.sub_question} | A: {node.hypothesis_answer}"
+        if node.status:
+            line += f" | {node.status}"
+        evidence = shortest_evidence(node.ref)
+        lines[node.id] = (line, f"{line} | evidence: {evidence}" if evidence else line)
+
+    by_priority = sorted(nodes, key=lambda node: len(node.path))
+    chosen = {}
+    used = 0
+    for node in by_priority:
+        cost = _tokens(lines[node.id][0])
+        if used + cost <= max_tokens:
+            chosen[node.id] = lines[node.id][0]
+            used += cost
+    for node in by_priority:
+        if node.id not in chosen:
+            continue
+        short, full = lines[node.id]
+        extra = _tokens(full) - _tokens(short)
+        if full != short and used + extra <= max_tokens:
+            chosen[node.id] = full
+            used += extra
+
+    output = [chosen[node.id] for node in nodes if node.id in chosen]
+    omitted = len(nodes) - len(chosen)
+    if omitted:
+        output.append(f"({omitted} deeper sub-questions omitted)")
+    return "\n".join(output)
@@ -0,0 +1,60 @@
+import time
+
+# 降级等级：预算消耗越多，核查做得越少
+SKIP_NEW_CLUE = 1  # 证据不足时不再生成 new_clue 重新检索
+SKIP_LOW_PRIORITY = 2  # 跳过深度超过 priority_depth 的节点
+STOP_VERIFICATION = 3  # 停止核查，直接生成最终答案
+
+
+class QuestionBudget:
+    """
+    单个问题的 token 预算和耗时预算。
+
+    已用比例取 token 和耗时两者中较大的一个，依次达到 thresholds 中的三个比例时
+    进入 SKIP_NEW_CLUE、SKIP_LOW_PRIORITY、STOP_VERIFICATION。
+    因预算实际跳过的操作通过 metrics.record_degradation 计数；stop_verification 每个问题只记录一次。
+    token_budget / time_budget 为 None 时不限制对应维度。
+    """
+
+    def __init__(self, metrics, token_budget=None, time_budget=None, thresholds=(0.5, 0.75, 0.9),
+                 priority_depth=1, start_time=None):
+        self.metrics = metrics
+        self.token_budget = token_budget
+        self.time_budget = time_budget
+        self.thresholds = thresholds
+        self.priority_depth = priority_depth
+        self.start_time = start_time if start_time is not None else time.perf_counter()
+
+    def used(self):
+        """已用预算比例，未设置任何预算时为 0。"""
+        used = 0.0
+        if self.token_budget:
+            used = max(used, self.metrics.total_tokens / self.token_budget)
+        if self.time_budget:
+            used = max(used, (time.perf_counter() - self.start_time) / self.time_budget)
+        return used
+
+    def level(self):
+        used = self.used()
+        return sum(1 for threshold in self.thresholds if used >= threshold)
+
+    def degraded(self, level, name, once=False):
+        """
+        当前预算等级达到 level 时记录一次名为 name 的降级并返回 True，只应在确实要跳过对应操作时调用。
+        once 为 True 时每个问题只记录一次。
+        """
+        if self.level() < level:
+            return False
+        self.metrics.record_degradation(name, once=once)
+        return True
+
+    def skips_node(self, path):
+        """与 skip_node 的判断相同，但不记录降级（如流式建树时决定是否预取）。"""
+        level = self.level()
+        return level >= STOP_VERIFICATION or (len(path) > self.priority_depth and level >= SKIP_LOW_PRIORITY)
+
+    def skip_node(self, path):
+        """按预算判断是否跳过 path 处节点的核查，跳过低优先级节点时按节点计数。"""
+        if self.degraded(STOP_VERIFICATION, "stop_verification", once=True):
+            return True
+        return len(path) > self.priority_depth and self.degraded(SKIP_LOW_PRIORITY, "skip_low_priority_node")
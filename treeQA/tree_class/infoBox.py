@@ -26,3 +26,12 @@ class infoBox:
                 if key and key not in self.seen_texts:
                     self.textInfo.append([json_array])
                     self.seen_texts.add(key)
+
+    def extend(self, other):
+        # 合并另一个 infoBox 的内容（例如整棵树批量检索得到的证据），同样去重
+        for item in other.graphInfo:
+            key = (item[0].get('head', ''), item[0].get('relation', ''), item[0].get('tail'))
+            if key not in self.seen_graphs:
+                self.graphInfo.append(item)
+                self.seen_graphs.add(key)
+        self.addText([item[0] for item in other.textInfo])
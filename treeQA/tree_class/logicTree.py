@@ -1,23 +1,166 @@
+import asyncio
+import collections
+import copy
+import itertools
 import json
+import re
+import threading
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from LLMs.models import getModelResponse, getModelResponseStream, getModelResponseAsync
+from LLMs.singleFlight import SingleFlight
+from treeQA.evidenceStore import EvidenceStore
+from treeQA.getQueryInfo import getQueryInfo, getTreeQueryInfo, getQueryInfoAsync, getTreeQueryInfoAsync
+from treeQA.sharedExecutors import get_executor
+from treeQA.tracing import span, set_attributes
+
+from treeQA.tree_class.answerContext import build_answer_context
+from treeQA.tree_class.budget import QuestionBudget, SKIP_NEW_CLUE, STOP_VERIFICATION
+from treeQA.tree_class.infoBox import infoBox
+from treeQA.tree_class.metrics import PipelineMetrics
+from treeQA.tree_class.streamParser import StreamingTreeParser
+from treeQA.tree_class.treeNode import TreeNode
+from treeQA_Config import verify_parallelism, batch_retrieval, \
+    final_answer_context_tokens, duplicate_question_threshold
 
-from LLMs.models import getModelResponse
-from treeQA.getQueryInfo import getQueryInfo
 
-from treeQA.tree_class.infoBox import infoBox
+def parse_json_block(result):
+    """去掉 ```json 标记，截取第一个 '{' 到最后一个 '}' 之间的内容并解析。"""
+    result = result.replace('```json', '').replace('```', '')
+    # 找到 JSON 字符串的起始和结束位置
+    start_index = result.find('{')
+    end_index = result.rfind('}') + 1
+    # 提取并解析 JSON 字符串
+    return json.loads(result[start_index:end_index])
+
+
+FACT_CHECK_PROMPT = f"""Please verify whether the answer is correct based on the given Info.  
+
+- If no relevant Info is provided (e.g., ["No Information provided."] or []), set `"isTrue": "unknown"` and `"fact_sufficient": false`.  
+- If the answer is correct and no reason is needed, set `"isTrue": true`.  
+- If the answer is incorrect, set `"isTrue": false`, provide the reason for the error, and include the correct answer in the reason.  
+- Always include reference information (`ref`) when available, for both correct and incorrect answers.  
+
+### Reference Formatting Rules:  
+- If no Info is available or unrelated to the question, set `"fact_sufficient": false`, `"ref": "No Information provided."`, and `"isTrue": "unknown"`.  
+- If citing `textInfo`, provide only the Wikipedia article's title ID (omit full text).  
+- If citing `graphInfo`, provide up to 3 relevant triplets in the format: `entityLabel-relationLabel-Value` from Wikidata.  
+- Do not fabricate information—references must match the provided Info.  
+
+### Output Format (JSON only):  
+```json
+{{
+    "isTrue": true/false/unknown,
+    "fact_sufficient": true/false,
+    "reason": "<None>/<reason>",
+    "ref": {{
+        "wikipedia": ["<textInfo id>"],
+        "wikidata": ["entityLabel-relationLabel-Value"]
+    }}
+}}
+```
+        """
+
 
+NEW_CLUE_PROMPT = """The available information is insufficient to answer the question. Based on the given information and the question, generate a new clue to help retrieve the missing information needed to answer it.  
+            ### Output Format (JSON only):  
+            ```json
+            {
+                "new_clue": "<New clue>"
+            }"""
 
 
+def _fact_check_query(childQuestion, hypothesis_answer, checkInfoBox):
+    return f"question：{childQuestion}\nanswer:{hypothesis_answer}\nInfo：\t\ntextInfo:{checkInfoBox.textInfo}\t\ngraphInfo:{checkInfoBox.graphInfo}"
+
+
+def _new_clue_query(childQuestion, checkInfoBox):
+    return f"question：{childQuestion}\nCurrent Info：\t\ntextInfo:{checkInfoBox.textInfo}\t\ngraphInfo:{checkInfoBox.graphInfo}"
+
+
+def _word_set(text):
+    return frozenset(re.findall(r"\w+", (text or "").lower()))
+
+
+def _jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def _path_label(path):
+    # 与 print_tree / 答案摘要一致的 1 起始编号，如 "1.2"
+    return ".".join(str(i + 1) for i in path) or "root"
+
 
 class LogicTree:
 
-    def __init__(self, data):
-        self.data = data
-        self.root = self.data["logic_tree"]
+    def __init__(self, data=None, metrics=None, budget=None, checkpoint=None):
+        self.data = None
+        self.root = None
         self.fix_count = 0
-        self.tokenCount = 0
+        self._fix_lock = threading.Lock()
+        # token、调用次数和耗时统一记录在 metrics 中，可被多个线程同时更新
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
+        # 单个问题的 token/耗时预算，默认不限制
+        self.budget = budget if budget is not None else QuestionBudget(self.metrics)
+        # 流式建树时提前开始的节点检索与事实核查，键为 (sub_question, hypothesis_answer)
+        self._prefetched = {}
+        self._prefetch_lock = threading.Lock()
+        # 整棵树批量检索得到的证据，键为节点的检索文本 sub_question + hypothesis_answer
+        self._retrieved = {}
+        # 已完成的核查结果，键为核查键（见 _verification_key），值为 (infoBox, 核查结果)；文本未变的节点直接复用
+        self._verdicts = {}
+        # content_hash -> 核查键；近似重复的节点共用同一个键，同时在途时只核查一次
+        self._verification_keys = {}
+        self._signatures = []
+        self._verify_flight = SingleFlight()
+        # 树内共享的实体、关系和文章证据
+        self.evidence = EvidenceStore(self.metrics)
+        # 断点回调 checkpoint(stage, state)，每核查完一个节点调用一次，state 见 checkpoint_state()
+        self.checkpoint = checkpoint
+        self._checkpoint_lock = threading.Lock()
+        # 节点索引：id -> TreeNode，path (tuple) -> TreeNode
+        self._ids = itertools.count()
+        self._nodes_by_id = {}
+        self._nodes_by_path = {}
+        # 索引和节点内容（子树、status、ref）的修改与断点快照共用这一把锁
+        self._index_lock = threading.RLock()
+        if data is not None:
+            self.set_data(data)
+
+    def set_data(self, data):
+        """
+        data 为建树得到的 JSON dict。逻辑树部分转换为 TreeNode 并建立索引，由 self.root 维护；
+        data["logic_tree"] 仅保留位置（字段顺序），序列化时由 to_dict() 重新生成。
+        """
+        self.data = data
+        self.root = TreeNode.from_dict(data["logic_tree"], self._ids)
+        self.data["logic_tree"] = None
+        with self._index_lock:
+            self._nodes_by_id.clear()
+            self._nodes_by_path.clear()
+            self._index_subtree(self.root)
+
+    def _index_subtree(self, node):
+        for item in node.iter_subtree():
+            self._nodes_by_id[item.id] = item
+            self._nodes_by_path[item.path] = item
+
+    def _unindex_descendants(self, node):
+        if node.children:
+            for child in node.children:
+                for item in child.iter_subtree():
+                    self._nodes_by_id.pop(item.id, None)
+                    self._nodes_by_path.pop(item.path, None)
+
+    @property
+    def tokenCount(self):
+        return self.metrics.total_tokens
+
     @staticmethod
-    def logic_tree_init(query):
-        prompt = f"""You are an intelligent assistant who is good at analyzing and reasoning, and your task is to construct a logic tree to break down and reason step by step according to the complex questions posed by the user, and finally arrive at the answer.
+    def tree_prompt(query):
+        return f"""You are an intelligent assistant who is good at analyzing and reasoning, and your task is to construct a logic tree to break down and reason step by step according to the complex questions posed by the user, and finally arrive at the answer.
 
     **Rules for constructing a logic tree:**
 
@@ -80,216 +223,563 @@ class LogicTree:
 
     Now the user question is:{query}
     """
-        result,tokenCount = getModelResponse(prompt, query)
-        result=result.replace("```json", "").replace("```", "")
-        print("Tree construction complete!")
-        # 找到 JSON 字符串的起始和结束位置
-        start_index = result.find('{')
-        end_index = result.rfind('}') + 1
 
-        # 提取 JSON 字符串
-        json_string = result[start_index:end_index]
-
-        # 解析 JSON 字符串
+    @staticmethod
+    def parse_tree_result(result, query):
+        """解析建树结果，失败时返回 None。"""
         try:
-            data = json.loads(json_string)
+            data = parse_json_block(result)
             data["input_question"] = query
-            return data,tokenCount
+            return data
         except json.JSONDecodeError as e:
-            print("error" + json_string)
+            print("error" + result)
             print(f"Decomposition failed, invalid JSON format.{e}")
         return None
 
-    def traverse(self):
-        qa_pairs = []
+    @staticmethod
+    def logic_tree_init(query, metrics=None):
+        result,tokenCount = getModelResponse(LogicTree.tree_prompt(query), query, stage="tree_construction",
+                                             metrics=metrics)
+        print("Tree construction complete!")
+        data = LogicTree.parse_tree_result(result, query)
+        if data is None:
+            return None
+        return data,tokenCount
 
-        def _traverse(node):
-            if "sub_question" in node and "hypothesis_answer" in node:
-                qa_pairs.append((node["sub_question"], node["hypothesis_answer"]))
-            if "children" in node:
-                for child in node["children"]:
-                    _traverse(child)
+    @staticmethod
+    async def logic_tree_init_async(query, metrics=None):
+        """logic_tree_init 的异步版本。"""
+        result, tokenCount = await getModelResponseAsync(LogicTree.tree_prompt(query), query,
+                                                         stage="tree_construction", metrics=metrics)
+        print("Tree construction complete!")
+        data = LogicTree.parse_tree_result(result, query)
+        if data is None:
+            return None
+        return data, tokenCount
 
-        _traverse(self.root)
-        return qa_pairs
+    @classmethod
+    def build_streaming(cls, query, metrics=None, budget=None):
+        """
+        以流式方式建树：每个节点的 sub_question/hypothesis_answer 一输出完整，
+        就在后台开始该节点的检索和事实核查，与模型继续生成后续节点重叠进行。
+        返回 (LogicTree, tokenCount)。
+        """
+        tree = cls(metrics=metrics, budget=budget)
+        parser = StreamingTreeParser()
 
-    def update_node(self, path, new_value):
-        node = self.root
-        for index in path:
-            node = node["children"][index]
+        def on_delta(delta):
+            for path, sub_question, hypothesis_answer in parser.feed(delta):
+                print(f"Streamed node:{list(path)}")
+                # 只决定是否预取，不计入降级；核查时 _precheck 会再判断一次
+                if tree.budget.skips_node(list(path)):
+                    continue
+                tree.prefetch_node(sub_question, hypothesis_answer)
+
+        try:
+            with span("tree.build_streaming"):
+                result, tokenCount = getModelResponseStream(cls.tree_prompt(query), query, on_delta,
+                                                            stage="tree_construction", metrics=tree.metrics)
+            print("Tree construction complete!")
+            data = cls.parse_tree_result(result, query)
+            if data is None:
+                raise ValueError("Decomposition failed, invalid JSON format.")
+            tree.set_data(data)
+        except BaseException:
+            # 建树失败时树不会被返回，取消还在排队的预取任务；成功时预取结果留给之后的核查，由 check_and_refine 关闭
+            tree.close()
+            raise
+        return tree, tokenCount
+
+    def prefetch_node(self, sub_question, hypothesis_answer):
+        """在共享的 prefetch 线程池中提前完成节点的检索和事实核查，供 refine_subtree 直接使用。"""
+        key = (sub_question, hypothesis_answer)
+        with self._prefetch_lock:
+            if key in self._prefetched:
+                return
+            self._prefetched[key] = get_executor("prefetch").submit(self.verify_text, sub_question, hypothesis_answer)
+
+    def _take_prefetched(self, sub_question, hypothesis_answer):
+        with self._prefetch_lock:
+            future = self._prefetched.pop((sub_question, hypothesis_answer), None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"Prefetched verification failed, checking again: {e}")
+            return None
+
+    def batch_retrieve(self):
+        """
+        对树中所有尚未预取的节点做一次批量检索（getTreeQueryInfo），结果供 verify_text 直接使用。
+        批量检索失败时不影响核查，各节点退回单独检索。
+        """
+        queries = self._batch_queries()
+        if not queries:
+            return
+        try:
+            with span("tree.batch_retrieve", {"tree.queries": len(queries)}):
+                retrieved = getTreeQueryInfo(queries, self)
+        except Exception as e:
+            print(f"Batch retrieval failed, retrieving per node: {e}")
+            return
+        with self._prefetch_lock:
+            self._retrieved.update(retrieved)
+
+    async def batch_retrieve_async(self):
+        """batch_retrieve 的异步版本。"""
+        queries = self._batch_queries()
+        if not queries:
+            return
+        try:
+            with span("tree.batch_retrieve", {"tree.queries": len(queries)}):
+                retrieved = await getTreeQueryInfoAsync(queries, self)
+        except Exception as e:
+            print(f"Batch retrieval failed, retrieving per node: {e}")
+            return
+        with self._prefetch_lock:
+            self._retrieved.update(retrieved)
+
+    def _batch_queries(self):
+        with self._prefetch_lock:
+            # 已预取或（从断点恢复时）已核查过的节点不再检索
+            return [node.sub_question + node.hypothesis_answer for node in self.root.iter_subtree()
+                    if node.has_qa() and node.status in (None, "skipped")
+                    and (node.sub_question, node.hypothesis_answer) not in self._prefetched]
+
+    def _take_retrieved(self, query):
+        with self._prefetch_lock:
+            return self._retrieved.pop(query, None)
+
+    def close(self):
+        """丢弃未使用的预取结果，还在排队的预取任务直接取消。"""
+        with self._prefetch_lock:
+            futures = list(self._prefetched.values())
+            self._prefetched.clear()
+            self._retrieved.clear()
+            self._verdicts.clear()
+        for future in futures:
+            future.cancel()
+
+    def traverse(self):
+        return [(node.sub_question, node.hypothesis_answer) for node in self.root.iter_subtree() if node.has_qa()]
 
-        node.update(new_value)
+    def update_node(self, path, new_value):
+        """
+        用 dict new_value 更新节点（与 dict.update 语义相同），给出 children 时重建该子树的索引。
+        重写后文本未变的后代节点（按 content_hash 匹配）保留原来的 ref 和核查状态，
+        之后的核查也会复用已有的证据与结论；只有文本变化的节点需要重新检索和核查。
+        """
+        with self._index_lock:
+            node = self.get_node_by_path(path)
+            old = {}
+            if "children" in new_value and node.children:
+                for child in node.children:
+                    for item in child.iter_subtree():
+                        old.setdefault(item.content_hash, item)
+                self._unindex_descendants(node)
+            node.update(new_value, self._ids)
+            self._index_subtree(node)
+            if "children" not in new_value:
+                return
+            changed = unchanged = 0
+            for child in node.children:
+                for item in child.iter_subtree():
+                    if not item.has_qa():
+                        continue
+                    previous = old.pop(item.content_hash, None)
+                    if previous is None:
+                        changed += 1
+                        continue
+                    unchanged += 1
+                    item.ref = previous.ref
+                    item.status = previous.status
+        print(f"Subtree fix changed {changed} nodes, {unchanged} unchanged nodes keep their evidence.")
+        self.metrics.increment("fix_changed_nodes", changed)
+        self.metrics.increment("fix_unchanged_nodes", unchanged)
+        # 文本已被改写的旧节点不会再被核查，丢弃为它们预取/批量检索的结果
+        with self._prefetch_lock:
+            for item in old.values():
+                if item.has_qa():
+                    future = self._prefetched.pop((item.sub_question, item.hypothesis_answer), None)
+                    if future is not None:
+                        future.cancel()
+                    self._retrieved.pop(item.sub_question + item.hypothesis_answer, None)
 
     def get_node_by_path(self, path):
-        node = self.root
-        for index in path:
-            node = node["children"][index]
+        with self._index_lock:
+            node = self._nodes_by_path.get(tuple(path))
+        if node is None:
+            raise IndexError(f"No node at path {list(path)}")
         return node
 
-    def refine_subtree(self, path):
-        current_node = self.get_node_by_path(path)
-        question = self.data["input_question"]
+    def get_node_by_id(self, node_id):
+        with self._index_lock:
+            return self._nodes_by_id[node_id]
+
+    def checkpoint_state(self):
+        """可 JSON 序列化的断点状态：树、已核查节点的状态（按路径）、fix_count 和计量。快照在锁内复制，不与树共享对象。"""
+        with self._index_lock:
+            statuses = {".".join(map(str, node.path)): node.status
+                        for node in self.root.iter_subtree() if node.status not in (None, "skipped")}
+            data = copy.deepcopy(self.to_dict())
+        return {"data": data, "statuses": statuses, "fix_count": self.fix_count, "metrics": self.metrics.to_dict()}
+
+    @classmethod
+    def from_checkpoint(cls, state, metrics=None, budget=None, checkpoint=None):
+        """由 checkpoint_state() 的结果恢复，已核查的节点不会再被核查。"""
+        tree = cls(json.loads(json.dumps(state["data"])), metrics=metrics, budget=budget, checkpoint=checkpoint)
+        tree.fix_count = state.get("fix_count", 0)
+        tree.metrics.merge(state.get("metrics", {}))
+        for path, status in state.get("statuses", {}).items():
+            key = tuple(int(i) for i in path.split(".")) if path else ()
+            node = tree._nodes_by_path.get(key)
+            if node is not None:
+                node.status = status
+        return tree
+
+    def save_checkpoint(self, stage):
+        if self.checkpoint is None:
+            return
+        with self._checkpoint_lock:
+            self.checkpoint(stage, self.checkpoint_state())
+
+    def to_dict(self):
+        """返回与原始建树结果相同结构的 dict（包含核查后写入的 ref 与修正）。"""
+        data = dict(self.data)
+        data["logic_tree"] = self.root.to_dict()
+        return data
+
+    def verify_text(self, childQuestion, hypothesis_answer):
+        """
+        对一个节点的文本做检索和事实核查，返回 (infoBox, 核查结果)，不修改树本身。
+        """
+        with span("tree.verify_text"):
+            return self._verify_text(childQuestion, hypothesis_answer)
 
-        def factCheck(current_node,question):
-            print(f"#####################Begin self-adaptive reasoning!#####################")
+    def _verify_text(self, childQuestion, hypothesis_answer):
+        # 从问题出发获取相关信息，批量检索已覆盖的节点直接使用其结果
+        checkInfoBox = self._retrieved_box(childQuestion, hypothesis_answer)
+        if checkInfoBox is None:
             checkInfoBox = infoBox()
-            childQuestion = current_node.get("sub_question")
-            hypothesis_answer = current_node.get("hypothesis_answer")
-            # 从问题出发获取相关信息
             getQueryInfo(childQuestion+hypothesis_answer, checkInfoBox, self)
 
-            # 判断答案是否有误,并填充引用来源
-            factCheckPrompt = f"""Please verify whether the answer is correct based on the given Info.  
-
-- If no relevant Info is provided (e.g., ["No Information provided."] or []), set `"isTrue": "unknown"` and `"fact_sufficient": false`.  
-- If the answer is correct and no reason is needed, set `"isTrue": true`.  
-- If the answer is incorrect, set `"isTrue": false`, provide the reason for the error, and include the correct answer in the reason.  
-- Always include reference information (`ref`) when available, for both correct and incorrect answers.  
-
-### Reference Formatting Rules:  
-- If no Info is available or unrelated to the question, set `"fact_sufficient": false`, `"ref": "No Information provided."`, and `"isTrue": "unknown"`.  
-- If citing `textInfo`, provide only the Wikipedia article's title ID (omit full text).  
-- If citing `graphInfo`, provide up to 3 relevant triplets in the format: `entityLabel-relationLabel-Value` from Wikidata.  
-- Do not fabricate information—references must match the provided Info.  
-
-### Output Format (JSON only):  
-```json
-{{
-    "isTrue": true/false/unknown,
-    "fact_sufficient": true/false,
-    "reason": "<None>/<reason>",
-    "ref": {{
-        "wikipedia": ["<textInfo id>"],
-        "wikidata": ["entityLabel-relationLabel-Value"]
-    }}
-}}
-```
-        """
-            result,tokenCount = getModelResponse(factCheckPrompt, f"question：{childQuestion}\nanswer:{hypothesis_answer}\nInfo：\t\ntextInfo:{checkInfoBox.textInfo}\t\ngraphInfo:{checkInfoBox.graphInfo}")
-            result=result.replace('```json', '').replace('```', '')
-            self.tokenCount+=tokenCount
-            # 找到 JSON 字符串的起始和结束位置
-            start_index = result.find('{')
-            end_index = result.rfind('}') + 1
-
-            # 提取 JSON 字符串
-            json_string = result[start_index:end_index]
-
-            # 解析 JSON 字符串
-
-            resultJson = json.loads(json_string)
-            if resultJson["isTrue"] == "unknown" and resultJson["fact_sufficient"]==False:
-
-                prompt_new_cue="""The available information is insufficient to answer the question. Based on the given information and the question, generate a new clue to help retrieve the missing information needed to answer it.  
-                ### Output Format (JSON only):  
-                ```json
-                {
-                    "new_clue": "<New clue>"
-                }"""
-                new_clue, tokenCount=getModelResponse(prompt_new_cue, f"question：{childQuestion}\nCurrent Info：\t\ntextInfo:{checkInfoBox.textInfo}\t\ngraphInfo:{checkInfoBox.graphInfo}")
-                self.tokenCount += tokenCount
+        # 判断答案是否有误,并填充引用来源
+        result,tokenCount = getModelResponse(FACT_CHECK_PROMPT, _fact_check_query(childQuestion, hypothesis_answer, checkInfoBox), stage="fact_check", metrics=self.metrics)
+        resultJson = parse_json_block(result)
+        if self._needs_new_clue(resultJson):
+            new_clue, tokenCount=getModelResponse(NEW_CLUE_PROMPT, _new_clue_query(childQuestion, checkInfoBox), stage="new_clue", metrics=self.metrics)
+            print("#########No useful information obtained, new leads provided:#############"+new_clue)
+            set_attributes({"verify.new_clue": True})
+            getQueryInfo(new_clue, checkInfoBox,self)
+            result, tokenCount = getModelResponse(FACT_CHECK_PROMPT,
+                                      _fact_check_query(childQuestion, hypothesis_answer, checkInfoBox),
+                                      stage="fact_check", metrics=self.metrics)
+            resultJson = parse_json_block(result)
+        return checkInfoBox, resultJson
+
+    async def verify_text_async(self, childQuestion, hypothesis_answer):
+        """verify_text 的异步版本。"""
+        with span("tree.verify_text"):
+            checkInfoBox = self._retrieved_box(childQuestion, hypothesis_answer)
+            if checkInfoBox is None:
+                checkInfoBox = infoBox()
+                await getQueryInfoAsync(childQuestion+hypothesis_answer, checkInfoBox, self)
+
+            result, tokenCount = await getModelResponseAsync(
+                FACT_CHECK_PROMPT, _fact_check_query(childQuestion, hypothesis_answer, checkInfoBox),
+                stage="fact_check", metrics=self.metrics)
+            resultJson = parse_json_block(result)
+            if self._needs_new_clue(resultJson):
+                new_clue, tokenCount = await getModelResponseAsync(
+                    NEW_CLUE_PROMPT, _new_clue_query(childQuestion, checkInfoBox), stage="new_clue",
+                    metrics=self.metrics)
                 print("#########No useful information obtained, new leads provided:#############"+new_clue)
-                getQueryInfo(new_clue, checkInfoBox,self)
-                result, tokenCount = getModelResponse(factCheckPrompt,
-                                          f"question：{childQuestion}\nanswer:{hypothesis_answer}\nInfo：\t\ntextInfo:{checkInfoBox.textInfo}\t\ngraphInfo:{checkInfoBox.graphInfo}")
-                result=result.replace('```json', '').replace('```', '')
-                self.tokenCount += tokenCount
-                # 找到 JSON 字符串的起始和结束位置
-                start_index = result.find('{')
-                end_index = result.rfind('}') + 1
-                # 提取 JSON 字符串
-                json_string = result[start_index:end_index]
-                # 解析 JSON 字符串
-                resultJson = json.loads(json_string)
-
-            # 若无误进入下一步，添加相关参考信息
-            if resultJson["isTrue"]:
-                print("############Evidence support node!##############")
+                set_attributes({"verify.new_clue": True})
+                await getQueryInfoAsync(new_clue, checkInfoBox, self)
+                result, tokenCount = await getModelResponseAsync(
+                    FACT_CHECK_PROMPT, _fact_check_query(childQuestion, hypothesis_answer, checkInfoBox),
+                    stage="fact_check", metrics=self.metrics)
+                resultJson = parse_json_block(result)
+            return checkInfoBox, resultJson
+
+    def _retrieved_box(self, childQuestion, hypothesis_answer):
+        """批量检索已覆盖该节点时返回装有其证据的 infoBox，否则返回 None。"""
+        retrieved = self._take_retrieved(childQuestion+hypothesis_answer)
+        set_attributes({"verify.batch_retrieved": retrieved is not None})
+        if retrieved is None:
+            return None
+        checkInfoBox = infoBox()
+        checkInfoBox.extend(retrieved)
+        return checkInfoBox
+
+    def _needs_new_clue(self, resultJson):
+        # 证据不足时生成 new_clue 重新检索一次，预算不足时跳过
+        return (resultJson["isTrue"] == "unknown" and resultJson["fact_sufficient"]==False
+                and not self.budget.degraded(SKIP_NEW_CLUE, "skip_new_clue"))
+
+    def _verification_key(self, node):
+        """
+        节点的核查键，默认为 content_hash。子问题和答案的词集合与之前出现过的节点都近似重复
+        （Jaccard 相似度 >= duplicate_question_threshold）时，使用那个节点的键，从而共享同一次核查。
+        """
+        with self._prefetch_lock:
+            key = self._verification_keys.get(node.content_hash)
+            if key is not None:
+                return key
+            key = node.content_hash
+            question_words = _word_set(node.sub_question)
+            answer_words = _word_set(node.hypothesis_answer)
+            if duplicate_question_threshold is not None:
+                for other_question, other_answer, other_key in self._signatures:
+                    if (_jaccard(question_words, other_question) >= duplicate_question_threshold
+                            and _jaccard(answer_words, other_answer) >= duplicate_question_threshold):
+                        key = other_key
+                        break
+            if key == node.content_hash:
+                self._signatures.append((question_words, answer_words, key))
+            self._verification_keys[node.content_hash] = key
+            return key
+
+    def _verify_node(self, node):
+        """返回节点的 (infoBox, 核查结果)：优先复用相同或近似重复节点的结论，其次使用预取结果，最后重新核查。"""
+        key = self._verification_key(node)
+
+        def run():
+            verified = self._cached_verdict(key)
+            if verified is not None:
+                return verified
+            verified = self._take_prefetched(node.sub_question, node.hypothesis_answer)
+            set_attributes({"verify.prefetched": verified is not None})
+            if verified is None:
+                verified = self.verify_text(node.sub_question, node.hypothesis_answer)
+            with self._prefetch_lock:
+                self._verdicts[key] = verified
+            return verified
+
+        return self._verify_flight.do(key, run)
+
+    async def _verify_node_async(self, node):
+        """_verify_node 的异步版本（异步流水线不做流式预取）。"""
+        key = self._verification_key(node)
+
+        async def run():
+            verified = self._cached_verdict(key)
+            if verified is not None:
+                return verified
+            verified = await self.verify_text_async(node.sub_question, node.hypothesis_answer)
+            with self._prefetch_lock:
+                self._verdicts[key] = verified
+            return verified
+
+        return await self._verify_flight.do_async(key, run)
+
+    def _cached_verdict(self, key):
+        with self._prefetch_lock:
+            verified = self._verdicts.get(key)
+        if verified is not None:
+            print("############Node already verified (same or near-duplicate text), reusing the result!##############")
+            self.metrics.increment("reused_verdicts")
+            set_attributes({"verify.reused": True})
+        return verified
+
+    def refine_subtree(self, path):
+        current_node = self.get_node_by_path(path)
+        print(f"#####################Begin self-adaptive reasoning!#####################")
+        checkInfoBox, resultJson = self._verify_node(current_node)
+        fixHypothesisPropmt = self._apply_verdict(current_node, checkInfoBox, resultJson)
+        if fixHypothesisPropmt is not None:
+            with span("tree.fix_subtree", {"node.path": _path_label(path)}):
+                result, tokenCount = getModelResponse(fixHypothesisPropmt, self._fix_query(), stage="subtree_fix", metrics=self.metrics)
+                self._apply_fix(path, current_node, result, checkInfoBox, resultJson)
+        return current_node
+
+    async def refine_subtree_async(self, path):
+        """refine_subtree 的异步版本。"""
+        current_node = self.get_node_by_path(path)
+        print(f"#####################Begin self-adaptive reasoning!#####################")
+        checkInfoBox, resultJson = await self._verify_node_async(current_node)
+        fixHypothesisPropmt = self._apply_verdict(current_node, checkInfoBox, resultJson)
+        if fixHypothesisPropmt is not None:
+            with span("tree.fix_subtree", {"node.path": _path_label(path)}):
+                result, tokenCount = await getModelResponseAsync(fixHypothesisPropmt, self._fix_query(),
+                                                                 stage="subtree_fix", metrics=self.metrics)
+                self._apply_fix(path, current_node, result, checkInfoBox, resultJson)
+        return current_node
+
+    def _apply_verdict(self, current_node, checkInfoBox, resultJson):
+        """根据核查结果更新节点的状态和引用；答案有误时返回修正子树的 prompt，否则返回 None。"""
+        # 若无误进入下一步，添加相关参考信息
+        if resultJson["isTrue"]:
+            print("############Evidence support node!##############")
+            with self._index_lock:
+                current_node.status = "unverified" if resultJson["isTrue"] == "unknown" else "supported"
                 # 这里向当前的节点添加reference信息
-                if "ref" not in current_node:
-                    current_node["ref"] = {}
-
-                # 从 infoBox 中获取完整的维基百科文章
-                wikipedia_ref_with_text = []
-                if "wikipedia" in resultJson["ref"]:
-                    for title in resultJson["ref"]["wikipedia"]:
-                        for item in checkInfoBox.textInfo:
-                            if item[0]['id'] == title:
-                                wikipedia_ref_with_text.append(f"{title}||{item[0]['content']}")
-                                break  # 找到匹配项后退出内层循环
-                # 更新 ref 字段，将维基百科的引用替换为带有文本的引用
-                current_node["ref"].update(resultJson["ref"])
-                if wikipedia_ref_with_text:
-                    current_node["ref"]["wikipedia"] = wikipedia_ref_with_text
-                return current_node
-            # 若有误将错误原因记下，修正整个过程
-            if not resultJson["isTrue"]:
-                errorReason = resultJson["reason"]
-                print(f"############Conflict were found:###################\n\n{errorReason}")
-                self.fix_count+=1
-                fixHypothesisPropmt = f"""An error was found in the step {current_node} of the current assumption, with a specific error reason of {errorReason}.
+                self._add_refs(current_node, checkInfoBox, resultJson)
+            return None
+        # 若有误将错误原因记下，修正整个过程
+        errorReason = resultJson["reason"]
+        print(f"############Conflict were found:###################\n\n{errorReason}")
+        with self._fix_lock:
+            self.fix_count+=1
+        question = self.data["input_question"]
+        return f"""An error was found in the step {current_node} of the current assumption, with a specific error reason of {errorReason}.
                            Please fully review and refactor all sub_questions and hypothesis_answer starting at subtree node:{current_node}.
                            The refactoring process involves correcting or redoing each step as necessary based on the latest information and logic to ensure that the answer does not deviate from the current question:{question}. 
                    Keeping the original subtree depth and structure,you only need to fix the errors in the subtree node, and do not add any deeper child node in the subtree. 
                    Please just output json format content, do not output any analysis text.
                    """
-                result, tokenCount = getModelResponse(fixHypothesisPropmt, f"Please be careful that current responses do not deviate from the question:{question}")
-                result = result.replace('```json', '').replace('```', '')
-                self.tokenCount += tokenCount
-                print(f"################New subtree:######################\n{result}")
-
-                # 找到 JSON 字符串的起始和结束位置
-                start_index = result.find('{')
-                end_index = result.rfind('}') + 1
-
-                # 提取 JSON 字符串
-                json_string = result[start_index:end_index]
-                # 解析 JSON 字符串
-
-                fixedHypothesis = json.loads(json_string)
-                # 更新当前节点和其子节点
-                self.update_node(path, fixedHypothesis)
-
-                print(f"################Subtree update complete!##################")
-                # 添加参考信息
-                if "ref" not in current_node:
-                    current_node["ref"] = {}
-
-                # 从 infoBox 中获取完整的维基百科文章
-                wikipedia_ref_with_text = []
-                if "wikipedia" in resultJson["ref"]:
-                    for title in resultJson["ref"]["wikipedia"]:
-                        for item in checkInfoBox.textInfo:
-                            if item[0]['id'] == title:
-                                wikipedia_ref_with_text.append(f"{title}||{item[0]['content']}")
-                                break  # 找到匹配项后退出内层循环
-
-                # 更新 ref 字段，将维基百科的引用替换为带有文本的引用
-                current_node["ref"].update(resultJson["ref"])
-                if wikipedia_ref_with_text:
-                    current_node["ref"]["wikipedia"] = wikipedia_ref_with_text
-            else:
-                print("Unable to check node, continue to next node.")
-            return current_node
-
-        updated_node = factCheck(current_node,question)
-        return updated_node
+
+    def _fix_query(self):
+        question = self.data["input_question"]
+        return f"Please be careful that current responses do not deviate from the question:{question}"
+
+    def _apply_fix(self, path, current_node, result, checkInfoBox, resultJson):
+        print(f"################New subtree:######################\n{result}")
+        fixedHypothesis = parse_json_block(result)
+        # 更新当前节点和其子节点
+        self.update_node(path, fixedHypothesis)
+        print(f"################Subtree update complete!##################")
+        with self._index_lock:
+            current_node.status = "corrected"
+            # 添加参考信息
+            self._add_refs(current_node, checkInfoBox, resultJson)
+
+    def _add_refs(self, current_node, checkInfoBox, resultJson):
+        # 从 infoBox 中获取完整的维基百科文章
+        wikipedia_ref_with_text = []
+        if "wikipedia" in resultJson["ref"]:
+            for title in resultJson["ref"]["wikipedia"]:
+                for item in checkInfoBox.textInfo:
+                    if item[0]['id'] == title:
+                        wikipedia_ref_with_text.append(f"{title}||{item[0]['content']}")
+                        break  # 找到匹配项后退出内层循环
+        with self._index_lock:
+            if current_node.ref is None:
+                current_node.ref = {}
+            # 更新 ref 字段，将维基百科的引用替换为带有文本的引用
+            current_node.ref.update(resultJson["ref"])
+            if wikipedia_ref_with_text:
+                current_node.ref["wikipedia"] = wikipedia_ref_with_text
 
     def check_and_refine(self):
         """
         遍历整个逻辑树，对每个节点进行 factCheck()，并根据需要进行 refineTree()。
+        verify_parallelism > 1 时按依赖关系并行核查：节点核查（及可能的子树重写）完成后才调度它的子节点，
+        兄弟子树之间互不依赖、同时进行，单个问题的耗时接近树的深度而不是节点数。
+        batch_retrieval 开启时先对整棵树做一次批量检索；被重写的子树中的新节点仍单独检索。
+        预算 (self.budget) 不足时依次跳过 new_clue 重试、低优先级（较深）节点，最后停止核查。
+        """
+        try:
+            with span("tree.check_and_refine", {"tree.nodes": len(self._nodes_by_id),
+                                                "tree.parallelism": verify_parallelism}):
+                if batch_retrieval and not self.budget.degraded(STOP_VERIFICATION, "skip_batch_retrieval"):
+                    self.batch_retrieve()
+                if verify_parallelism > 1:
+                    self._parallel_check()
+                else:
+                    self._recursive_check(self.root)
+                set_attributes({"tree.fix_count": self.fix_count})
+        finally:
+            self.close()
+
+    async def check_and_refine_async(self):
+        """
+        check_and_refine 的异步版本：每个节点是一个协程，核查完成后再为子节点创建协程，
+        同时核查的节点数不超过 verify_parallelism。
         """
+        semaphore = asyncio.Semaphore(max(verify_parallelism, 1))
 
-        def _recursive_check(node, path):
-            if "sub_question" in node and "hypothesis_answer" in node:
-                print(f"Checking:{path}")
-                self.refine_subtree(path)
+        async def _task(node):
+            async with semaphore:
+                checked = await self._check_node_async(node)
+            if checked:
+                # update_node 可能重写了子树，核查完成后再读取子节点
+                await asyncio.gather(*(_task(child) for child in list(node.children or [])))
 
-            if "children" in node:
-                for i, child in enumerate(node["children"]):
-                    _recursive_check(child, path + [i])
+        try:
+            with span("tree.check_and_refine", {"tree.nodes": len(self._nodes_by_id),
+                                                "tree.parallelism": verify_parallelism}):
+                if batch_retrieval and not self.budget.degraded(STOP_VERIFICATION, "skip_batch_retrieval"):
+                    await self.batch_retrieve_async()
+                await _task(self.root)
+                set_attributes({"tree.fix_count": self.fix_count})
+        finally:
+            self.close()
+
+    def _precheck(self, node):
+        """返回 None 表示需要核查该节点；否则直接作为 _check_node 的结果（预算不足跳过为 False）。"""
+        path = list(node.path)
+        if node.status not in (None, "skipped"):
+            # 从断点恢复时已经核查过的节点，不需要核查也就不算跳过
+            return True
+        if self.budget.skip_node(path):
+            print(f"Budget exhausted, skipping:{path}")
+            with self._index_lock:
+                for item in node.iter_subtree():
+                    if item.status in (None, "skipped"):
+                        item.status = "skipped"
+            return False
+        if not node.has_qa():
+            # 没有问答的节点
+            return True
+        return None
 
-        _recursive_check(self.root, [])
+    def _check_node(self, node):
+        """核查一个节点，预算不足而跳过时返回 False，其子节点也不再核查。"""
+        checked = self._precheck(node)
+        if checked is not None:
+            return checked
+        path = list(node.path)
+        print(f"Checking:{path}")
+        with span("tree.verify_node", {"node.path": _path_label(path), "node.depth": len(path)}):
+            self.refine_subtree(path)
+            set_attributes({"node.status": node.status})
+        self.save_checkpoint("verifying")
+        return True
+
+    async def _check_node_async(self, node):
+        checked = self._precheck(node)
+        if checked is not None:
+            return checked
+        path = list(node.path)
+        print(f"Checking:{path}")
+        with span("tree.verify_node", {"node.path": _path_label(path), "node.depth": len(path)}):
+            await self.refine_subtree_async(path)
+            set_attributes({"node.status": node.status})
+        # 断点写入 SQLite，放到线程池中以免阻塞事件循环
+        await asyncio.to_thread(self.save_checkpoint, "verifying")
+        return True
+
+    def _recursive_check(self, node):
+        if not self._check_node(node):
+            return
+        # update_node 可能重写了子树，核查完成后再读取子节点
+        for child in node.children or []:
+            self._recursive_check(child)
+
+    def _parallel_check(self):
+        def _task(node):
+            if not self._check_node(node):
+                return []
+            # update_node 可能重写了子树，核查完成后再读取子节点
+            return list(node.children or [])
+
+        # 节点任务在进程共享的 verification 线程池中执行，每棵树同时在途的节点不超过 verify_parallelism
+        executor = get_executor("verification")
+        waiting = collections.deque([self.root])
+        pending = set()
+        try:
+            while waiting or pending:
+                while waiting and len(pending) < verify_parallelism:
+                    pending.add(executor.submit(_task, waiting.popleft()))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    waiting.extend(future.result())
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
 
     def print_tree(self, node=None, indent=0, output_lines=None):
         """
@@ -304,12 +794,12 @@ class LogicTree:
             output_lines.append(f"**Input Question:** {self.data['input_question']}\n")
             output_lines.append(f"**Final Answer:** {self.data['answer']}\n")
 
-        if "sub_question" in node and "hypothesis_answer" in node:
-            output_lines.append("  " * indent + f"- Question: {node['sub_question']}")
-            output_lines.append("  " * indent + f"  Answer: {node['hypothesis_answer']}")
-            if "ref" in node:
+        if node.has_qa():
+            output_lines.append("  " * indent + f"- Question: {node.sub_question}")
+            output_lines.append("  " * indent + f"  Answer: {node.hypothesis_answer}")
+            if node.ref is not None:
                 output_lines.append("  " * indent + "  References:")
-                for ref_type, ref_list in node["ref"].items():
+                for ref_type, ref_list in node.ref.items():
                     if ref_type == "wikipedia":
                         for ref in ref_list:
                             output_lines.append("  " * indent + f"    - Wikipedia: {ref}")
@@ -319,20 +809,35 @@ class LogicTree:
                     else:
                         output_lines.append("  " * indent + f"    - {ref_type}: {ref_list}")
 
-        if "children" in node:
-            for child in node["children"]:
-                self.print_tree(child, indent + 1, output_lines)
+        for child in node.children or []:
+            self.print_tree(child, indent + 1, output_lines)
 
         return output_lines
-    def update_final_answer(self):
-        info=self.data["logic_tree"]
-        prompt=f"""
+    def _final_answer_prompt(self):
+        # 紧凑的节点摘要（问题、修正后的答案、核查状态、最短证据），final_answer_context_tokens 为 None 时使用完整的树
+        if final_answer_context_tokens is None:
+            info=self.root.to_dict()
+        else:
+            info=build_answer_context(self.root, final_answer_context_tokens)
+        return f"""
             Now based all information and your own knowledge,please give a final answer to the question.
             question:{self.data["input_question"]}
             information:{info}
          """
-        final_answer,tokenCount=getModelResponse(prompt,self.data["input_question"])
-        self.tokenCount += tokenCount
+
+    def update_final_answer(self):
+        prompt=self._final_answer_prompt()
+        with span("tree.final_answer", {"final_answer.prompt_chars": len(prompt)}):
+            final_answer,tokenCount=getModelResponse(prompt,self.data["input_question"], stage="final_answer",
+                                                     metrics=self.metrics)
+        print(f"########the final answer is:####################\n{final_answer}")
+        self.data["answer"]=final_answer
+
+    async def update_final_answer_async(self):
+        prompt = self._final_answer_prompt()
+        with span("tree.final_answer", {"final_answer.prompt_chars": len(prompt)}):
+            final_answer, tokenCount = await getModelResponseAsync(prompt, self.data["input_question"],
+                                                                   stage="final_answer", metrics=self.metrics)
         print(f"########the final answer is:####################\n{final_answer}")
         self.data["answer"]=final_answer
 
@@ -343,4 +848,4 @@ class LogicTree:
         Returns:
             一个表示整棵树的 JSON 字符串。
         """
-        return json.dumps(self.data, indent=4),self.fix_count
\ No newline at end of file
+        return json.dumps(self.to_dict(), indent=4),self.fix_count
\ No newline at end of file
@@ -0,0 +1,108 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from treeQA.tracing import span
+
+
+class PipelineMetrics:
+    """
+    单个问题的线程安全计量：按 LLM 阶段记录调用次数、prompt/completion token 和耗时，
+    按外部服务记录调用次数、耗时和错误数，并记录因预算不足发生的降级次数和其他事件计数（如复用的核查结果）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.llm = {}
+        self.services = {}
+        self.degradations = {}
+        self.counters = {}
+
+    def record_llm(self, stage, usage, seconds):
+        with self._lock:
+            entry = self.llm.setdefault(stage or "default", {
+                "calls": 0, "cache_hits": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0,
+                "time": 0.0,
+            })
+            entry["calls"] += 1
+            entry["cache_hits"] += 1 if usage.get("cached") else 0
+            entry["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            entry["completion_tokens"] += usage.get("completion_tokens", 0)
+            entry["total_tokens"] += usage.get("total_tokens", 0)
+            entry["time"] += seconds
+
+    def record_service(self, service, seconds, error=False):
+        with self._lock:
+            entry = self.services.setdefault(service, {"calls": 0, "errors": 0, "time": 0.0})
+            entry["calls"] += 1
+            entry["errors"] += 1 if error else 0
+            entry["time"] += seconds
+
+    def record_degradation(self, name, once=False):
+        """once 为 True 时同名降级只记录一次（包括从断点恢复的计量中已有的）。"""
+        with self._lock:
+            if once and name in self.degradations:
+                return
+            self.degradations[name] = self.degradations.get(name, 0) + 1
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def service(self, name):
+        """统计一次外部服务调用的耗时（同时记为 service.<name> span），异常会计入 errors 后继续抛出。"""
+        start = time.perf_counter()
+        error = False
+        try:
+            with span(f"service.{name}"):
+                yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record_service(name, time.perf_counter() - start, error)
+
+    def timed(self, name, fn, *args, **kwargs):
+        """以 service(name) 计时调用 fn，便于直接提交到线程池。"""
+        with self.service(name):
+            return fn(*args, **kwargs)
+
+    async def timed_async(self, name, coro_fn, *args, **kwargs):
+        """timed 的异步版本，coro_fn 返回协程。"""
+        with self.service(name):
+            return await coro_fn(*args, **kwargs)
+
+    def merge(self, snapshot):
+        """并入 to_dict() 的结果，例如从断点恢复时之前已经产生的消耗。"""
+        with self._lock:
+            for stage, entry in snapshot.get("llm", {}).items():
+                target = self.llm.setdefault(stage, dict.fromkeys(entry, 0))
+                for name, value in entry.items():
+                    target[name] = target.get(name, 0) + value
+            for service, entry in snapshot.get("services", {}).items():
+                target = self.services.setdefault(service, dict.fromkeys(entry, 0))
+                for name, value in entry.items():
+                    target[name] = target.get(name, 0) + value
+            for table, values in ((self.degradations, snapshot.get("degradations", {})),
+                                  (self.counters, snapshot.get("counters", {}))):
+                for name, value in values.items():
+                    table[name] = table.get(name, 0) + value
+
+    @property
+    def total_tokens(self):
+        with self._lock:
+            return sum(entry["total_tokens"] for entry in self.llm.values())
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "llm": {stage: dict(entry) for stage, entry in self.llm.items()},
+                "services": {name: dict(entry) for name, entry in self.services.items()},
+                "degradations": dict(self.degradations),
+                "counters": dict(self.counters),
+                "prompt_tokens": sum(entry["prompt_tokens"] for entry in self.llm.values()),
+                "completion_tokens": sum(entry["completion_tokens"] for entry in self.llm.values()),
+                "total_tokens": sum(entry["total_tokens"] for entry in self.llm.values()),
+                "llm_calls": sum(entry["calls"] for entry in self.llm.values()),
+            }
@@ -0,0 +1,90 @@
+import json
+
+
+class StreamingTreeParser:
+    """
+    逻辑树 JSON 的增量解析器。
+
+    通过 feed() 逐段输入模型的流式输出，一旦某个节点的 sub_question 和 hypothesis_answer
+    都已完整输出（无需等待其 children），就返回 (path, sub_question, hypothesis_answer)。
+    path 与 LogicTree.get_node_by_path 使用的下标路径一致。
+    JSON 之外的文本（如 ```json 标记）会被忽略。
+    """
+
+    def __init__(self):
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._chars = []
+        self._done = False
+
+    def feed(self, text):
+        emitted = []
+        for c in text:
+            if self._done:
+                break
+            if self._in_string:
+                self._consume_string_char(c, emitted)
+            elif c == '"':
+                if self._stack:
+                    self._in_string = True
+                    self._chars = []
+            elif c == '{':
+                self._open_object()
+            elif c == '[':
+                if self._stack:
+                    top = self._stack[-1]
+                    parent_key = top["key"] if top["kind"] == "obj" else None
+                    self._stack.append({"kind": "arr", "parent_key": parent_key, "path": top["path"], "count": 0})
+            elif c in '}]':
+                if self._stack:
+                    self._stack.pop()
+                    if not self._stack:
+                        self._done = True
+            elif c == ',':
+                if self._stack and self._stack[-1]["kind"] == "obj":
+                    self._stack[-1]["expecting_key"] = True
+        return emitted
+
+    def _open_object(self):
+        if not self._stack:
+            path = ()
+        else:
+            top = self._stack[-1]
+            if top["kind"] == "arr" and top["parent_key"] == "children":
+                path = top["path"] + (top["count"],)
+                top["count"] += 1
+            else:
+                path = top["path"]
+        self._stack.append({"kind": "obj", "path": path, "key": None, "expecting_key": True,
+                            "fields": {}, "emitted": False})
+
+    def _consume_string_char(self, c, emitted):
+        if self._escape:
+            self._chars.append(c)
+            self._escape = False
+            return
+        if c == '\\':
+            self._chars.append(c)
+            self._escape = True
+            return
+        if c != '"':
+            self._chars.append(c)
+            return
+        self._in_string = False
+        try:
+            value = json.loads('"' + "".join(self._chars) + '"')
+        except json.JSONDecodeError:
+            value = "".join(self._chars)
+        top = self._stack[-1]
+        if top["kind"] != "obj":
+            return
+        if top["expecting_key"]:
+            top["key"] = value
+            top["expecting_key"] = False
+            return
+        top["fields"][top["key"]] = value
+        fields = top["fields"]
+        if not top["emitted"] and "sub_question" in fields and "hypothesis_answer" in fields:
+            top["emitted"] = True
+            emitted.append((top["path"], fields["sub_question"], fields["hypothesis_answer"]))
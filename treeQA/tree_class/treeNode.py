@@ -0,0 +1,110 @@
+import hashlib
+import itertools
+
+# 单独存放的字段，其余字段原样保存在 extra 中
+_FIELDS = ("sub_question", "hypothesis_answer", "ref", "children")
+
+
+class TreeNode:
+    """
+    逻辑树节点。
+
+    使用 __slots__ 存放常用字段，并保存父节点指针和在树中的下标路径 (path)。
+    from_dict / to_dict 与原来的嵌套 dict JSON 结构相互转换（字段顺序、缺失的字段均保持不变）。
+    字段不存在时对应属性为 None。
+    status 为核查状态（None 未核查，"supported"/"corrected"/"unverified"/"skipped"），不写入 JSON。
+    content_hash 为 sub_question/hypothesis_answer 的哈希，用于判断节点文本在子树修正后是否发生变化。
+    """
+
+    __slots__ = ("id", "sub_question", "hypothesis_answer", "ref", "children", "extra", "parent", "path",
+                 "status", "_hash", "_order")
+
+    def __init__(self, node_id, parent=None, path=()):
+        self.id = node_id
+        self.sub_question = None
+        self.hypothesis_answer = None
+        self.ref = None
+        self.children = None
+        self.extra = None
+        self.parent = parent
+        self.path = path
+        self.status = None
+        self._hash = None
+        # 原 dict 的字段顺序，to_dict 时按此顺序输出
+        self._order = ()
+
+    @classmethod
+    def from_dict(cls, data, ids=None, parent=None, path=()):
+        """由嵌套 dict 构建子树，ids 为节点 id 的计数器。"""
+        if ids is None:
+            ids = itertools.count()
+        node = cls(next(ids), parent, path)
+        node._assign(data, ids)
+        return node
+
+    def _assign(self, data, ids):
+        order = list(self._order)
+        for key, value in data.items():
+            if key not in order:
+                order.append(key)
+            if key == "children":
+                self.children = [TreeNode.from_dict(child, ids, self, self.path + (i,))
+                                 for i, child in enumerate(value or [])]
+            elif key in _FIELDS:
+                setattr(self, key, value)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+        self._order = tuple(order)
+        self._hash = None
+
+    def update(self, data, ids):
+        """等价于原来的 dict.update：给出 children 时整个子树被替换。"""
+        self._assign(data, ids)
+
+    @property
+    def content_hash(self):
+        if self._hash is None:
+            text = f"{self.sub_question}\x1f{self.hypothesis_answer}"
+            self._hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return self._hash
+
+    @property
+    def depth(self):
+        return len(self.path)
+
+    def has_qa(self):
+        return self.sub_question is not None and self.hypothesis_answer is not None
+
+    def iter_subtree(self):
+        """先序遍历以该节点为根的子树（含自身），不使用递归。"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            if node.children:
+                stack.extend(reversed(node.children))
+
+    def get(self, key, default=None):
+        if key in _FIELDS:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.extra.get(key, default) if self.extra else default
+
+    def to_dict(self):
+        result = {}
+        for key in self._order:
+            if key == "children":
+                result[key] = [child.to_dict() for child in self.children]
+            elif key in _FIELDS:
+                result[key] = getattr(self, key)
+            else:
+                result[key] = self.extra[key]
+        # 原 dict 中没有、后来才添加的字段（如核查后写入的 ref）
+        if self.ref is not None and "ref" not in self._order:
+            result["ref"] = self.ref
+        return result
+
+    def __repr__(self):
+        return repr(self.to_dict())
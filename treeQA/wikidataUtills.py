@@ -1,11 +1,18 @@
 import json
 import os
+import re
+import threading
 import time
+from types import MappingProxyType
 
 import requests
 
-from LLMs.models import getModelResponse
-from treeQA_Config import proxies
+from LLMs.models import getModelResponse, getModelResponseAsync
+from treeQA.eventLoop import run_sync
+from treeQA.ioCassette import cassette_call, cassette_call_async, cassette_call_many, cassette_call_many_async
+from treeQA.sharedExecutors import run_blocking
+from treeQA.tracing import set_attributes
+from treeQA_Config import proxies, property_index_path, sparql_relation_batch_size, sparql_value_batch_size
 
 from treeQA.tree_class.infoBox import infoBox
 import asyncio
@@ -56,11 +63,18 @@ def getWikidataEntity(entityLabels):
     return results
 
 def safe_request(url, params, my_proxies, max_retries=3):
+    # 经过录制/回放层，参数拷贝一份以免调用方后续修改 params 影响录制的请求
+    return cassette_call("wikidata", {"url": url, "params": dict(params)},
+                         lambda: _safe_request(url, params, my_proxies, max_retries))
+
+
+def _safe_request(url, params, my_proxies, max_retries=3):
 
     for attempt in range(max_retries):
         try:
             response = requests.get(url,headers=HEADERS, params=params,proxies=my_proxies)
             response.raise_for_status()  # 如果响应状态码不是200，则抛出HTTPError
+            set_attributes({"http.response_bytes": len(response.content), "http.retries": attempt})
             return response.json()
         except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError) as e:
             if attempt < (max_retries - 1):  # i.e. if it's not the last retry
@@ -70,29 +84,11 @@ def safe_request(url, params, my_proxies, max_retries=3):
                 raise  # 如果所有重试都失败了，就抛出最后一次异常
     return None  # 如果没有异常抛出，返回None
 
-async def fetch_relation_value(session, entity_code, relation_code, pointing):
+async def _sparql_get(session, sparql_query, description):
+    """异步执行一次 SPARQL 查询，429 和其他失败最多重试 3 次，返回 JSON 结果，全部失败时返回 None。"""
     MAX_RETRIES = 3
     RETRY_DELAY = 3  # 秒
 
-    if pointing:
-        sparql_query = (
-            f"""
-            SELECT ?value ?valueLabel WHERE {{
-                ?value wdt:{relation_code} wd:{entity_code}.
-              SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en,[AUTO_LANGUAGE]" }}
-            }} LIMIT 10
-            """
-        )
-    else:
-        sparql_query = (
-            f"""
-            SELECT ?value ?valueLabel WHERE {{
-              wd:{entity_code} wdt:{relation_code} ?value .
-              SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en,[AUTO_LANGUAGE]" }}
-            }} LIMIT 10
-            """
-        )
-
     url = 'https://query.wikidata.org/sparql'
     params = {'query': sparql_query, 'format': 'json'}
     retries = 0
@@ -105,63 +101,150 @@ async def fetch_relation_value(session, entity_code, relation_code, pointing):
                     retries += 1
                 elif response.status == 200:
                     data = await response.json()
-                    if 'results' in data and 'bindings' in data['results'] and data['results']['bindings']:
-                        if len(data['results']['bindings'][0])==1:
-                            binding = data['results']['bindings'][0]
-                            if 'valueLabel' in binding and binding['valueLabel']['value']:
-                                return binding['valueLabel']['value']
-                            elif 'value' in binding:
-                                return binding['value']['value']
-                        else:
-                            resultList = []
-                            for binding in data['results']['bindings']:
-                                if 'valueLabel' in binding and binding['valueLabel']['value']:
-                                     resultList.append(binding['valueLabel']['value'])
-                                elif 'value' in binding:
-                                    resultList.append(binding['value']['value'])
-                            return ",".join(resultList)
-                    return None
+                    set_attributes({"http.response_bytes": response.content_length, "http.retries": retries,
+                                    "sparql.bindings": len(data.get("results", {}).get("bindings", []))})
+                    return data
                 else:
-                    print(f"Failed to fetch {entity_code} {relation_code}, status code: {response.status}")
+                    print(f"Failed to fetch {description}, status code: {response.status}")
                     retries += 1
                     if retries < MAX_RETRIES:
                         await asyncio.sleep(RETRY_DELAY)
         except Exception as e:
-            print(f"Error fetching {entity_code} {relation_code}: {e}")
+            print(f"Error fetching {description}: {e}")
             retries += 1
             if retries < MAX_RETRIES:
                 await asyncio.sleep(RETRY_DELAY)
     return None
 
 
+def _binding_value(binding):
+    if 'valueLabel' in binding and binding['valueLabel']['value']:
+        return binding['valueLabel']['value']
+    if 'value' in binding:
+        return binding['value']['value']
+    return None
+
+
+async def fetch_relation_value(session, entity_code, relation_code, pointing):
+    return await cassette_call_async(
+        "sparql_relation_value", {"entity": entity_code, "relation": relation_code, "pointing": pointing},
+        lambda: _fetch_relation_value(session, entity_code, relation_code, pointing))
+
+
+async def _fetch_relation_value(session, entity_code, relation_code, pointing):
+    if pointing:
+        sparql_query = (
+            f"""
+            SELECT ?value ?valueLabel WHERE {{
+                ?value wdt:{relation_code} wd:{entity_code}.
+              SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en,[AUTO_LANGUAGE]" }}
+            }} LIMIT 10
+            """
+        )
+    else:
+        sparql_query = (
+            f"""
+            SELECT ?value ?valueLabel WHERE {{
+              wd:{entity_code} wdt:{relation_code} ?value .
+              SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en,[AUTO_LANGUAGE]" }}
+            }} LIMIT 10
+            """
+        )
+
+    data = await _sparql_get(session, sparql_query, f"{entity_code} {relation_code}")
+    if data and 'results' in data and 'bindings' in data['results'] and data['results']['bindings']:
+        if len(data['results']['bindings'][0])==1:
+            return _binding_value(data['results']['bindings'][0])
+        resultList = [value for value in map(_binding_value, data['results']['bindings']) if value]
+        return ",".join(resultList)
+    return None
+
+
+def _relation_values_query(pairs):
+    """
+    一次查询多个 (实体, 关系, 是否指向实体) 的取值。实体指向的取值用 VALUES 连接，
+    指向实体的取值可能非常多（如指向某个国家的所有条目），每对各用一个带 LIMIT 10 的子查询。
+    """
+    pointed = [(entity_code, relation_code) for entity_code, relation_code, pointing in pairs if not pointing]
+    pointing = [(entity_code, relation_code) for entity_code, relation_code, pointing in pairs if pointing]
+    blocks = []
+    if pointed:
+        values = " ".join(f"(wd:{entity_code} wdt:{relation_code})" for entity_code, relation_code in pointed)
+        blocks.append(f"{{ VALUES (?entity ?relation) {{ {values} }} ?entity ?relation ?value. BIND(false AS ?pointing) }}")
+    for entity_code, relation_code in pointing:
+        blocks.append(f"{{ SELECT (wd:{entity_code} AS ?entity) (wdt:{relation_code} AS ?relation) (true AS ?pointing) ?value "
+                      f"WHERE {{ ?value wdt:{relation_code} wd:{entity_code}. }} LIMIT 10 }}")
+    return f"""
+    SELECT ?entity ?relation ?pointing ?value ?valueLabel WHERE {{
+      {" UNION ".join(blocks)}
+      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "en,[AUTO_LANGUAGE]" }}
+    }}
+    """
+
+
+async def fetch_relation_values(session, pairs):
+    """
+    批量版本的 fetch_relation_value：pairs 为 (实体, 关系, 是否指向实体)，一次 SPARQL 查询后按实体和关系拆分，
+    返回与 pairs 一一对应的取值列表，取值格式与 fetch_relation_value 相同（多个取值以逗号连接，每对最多 10 个，
+    没有取值为 None）。查询失败时返回 None。
+    每对的取值与 fetch_relation_value 一样按 (实体, 关系, 方向) 单独录制和回放，与批次的组合无关。
+    """
+    requests = [{"entity": entity_code, "relation": relation_code, "pointing": pointing}
+                for entity_code, relation_code, pointing in pairs]
+    return await cassette_call_many_async("sparql_relation_value", requests,
+                                          lambda: _fetch_relation_values(session, pairs))
+
+
+async def _fetch_relation_values(session, pairs):
+    data = await _sparql_get(session, _relation_values_query(pairs), f"values of {len(pairs)} relations")
+    if data is None or 'results' not in data:
+        return None
+    values = {}
+    for binding in data['results'].get('bindings', []):
+        pair = (binding['entity']['value'].split('/')[-1], binding['relation']['value'].split('/')[-1],
+                binding['pointing']['value'] == "true")
+        value = _binding_value(binding)
+        if value and len(values.setdefault(pair, [])) < 10:
+            values[pair].append(value)
+    return [",".join(values[pair]) if values.get(pair) else None for pair in map(tuple, pairs)]
+
+
 async def getAnswerOfRelation(json_data):
+    """
+    查询 json_data 中所有选中关系的取值并写入各关系的 "value"。每 sparql_value_batch_size 对合并为一次查询，
+    某一批查询失败时退回逐对查询。
+    """
     updated_entities = {}
     async with ClientSession() as session:
-        tasks = []
+        relations = {}
         for entity_code, entity in json_data.items():
             for relation in entity['pointed_relations']:
-                task = asyncio.create_task(
-                    fetch_relation_value(session, entity_code, relation['id'], pointing=False)
-                )
-                tasks.append((entity_code, relation, task))
+                relations.setdefault((entity_code, relation['id'], False), []).append(relation)
             for relation in entity['pointing_relations']:
-                task = asyncio.create_task(
-                    fetch_relation_value(session, entity_code, relation['id'], pointing=True)
-                )
-                tasks.append((entity_code, relation, task))
-
-        for entity_code, relation, task in tasks:
-            relation_value = await task
-            if relation_value:
-                relation.update({'value': relation_value})
-            if entity_code not in updated_entities:
-                updated_entities[entity_code] = json_data[entity_code]
+                relations.setdefault((entity_code, relation['id'], True), []).append(relation)
+            if entity['pointed_relations'] or entity['pointing_relations']:
+                updated_entities[entity_code] = entity
+
+        pairs = list(relations)
+        batches = [pairs[i:i + sparql_value_batch_size] for i in range(0, len(pairs), sparql_value_batch_size)]
+        values = {}
+        for batch, batch_values in zip(batches, await asyncio.gather(
+                *(fetch_relation_values(session, batch) for batch in batches))):
+            if batch_values is None:
+                batch_values = await asyncio.gather(*(fetch_relation_value(session, *pair) for pair in batch))
+            values.update(zip(batch, batch_values))
+
+        for pair, pair_relations in relations.items():
+            if values.get(pair):
+                for relation in pair_relations:
+                    relation.update({'value': values[pair]})
 
     return updated_entities
 
 
 def getRelationValue(json_data):
-    return asyncio.run(getAnswerOfRelation(json_data))
+    # 在进程共享的事件循环上执行，不再为每次调用新建事件循环；异步流水线中直接 await getAnswerOfRelation
+    return run_sync(getAnswerOfRelation(json_data))
 
 
 # 加载prop用于查询
@@ -174,82 +257,142 @@ def load_property_data(file_path):
     # 将列表转换为字典，key 为 "id"，value 为该条目
     return {item['id']: item for item in property_list}
 
-# 获取实体指向的属性/关系 或 指向实体的关系
-def getAllRelationOfQID(QID, property_data):
-    # 1. 构造查询：获取 QID 所指向的关系（QID -> 关系）
-    sparql_query_pointed = f"""
-    SELECT DISTINCT ?property ?propertyLabel WHERE {{
-      wd:{QID} ?property ?target.
-      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }}
-    }}
-    Limit 100
-    """
 
-    # 2. 构造查询：获取指向 QID 的关系（关系 -> QID）
-    sparql_query_pointing = f"""
-    SELECT DISTINCT ?property ?propertyLabel WHERE {{
-      ?item ?property wd:{QID}.
-      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }}
-    }}
-    LIMIT 100 OFFSET 0
+_property_labels = None
+_property_labels_lock = threading.Lock()
+
+
+def compile_property_index(props_file_path, index_path):
+    """把属性文件压缩为每行 "PID\tlabel" 的索引文件（只保留关系查询用到的 label），先写临时文件再替换。"""
+    property_data = load_property_data(props_file_path)
+    directory = os.path.dirname(index_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for property_id, item in property_data.items():
+            label = " ".join(item['label'].split())
+            f.write(f"{property_id}\t{label}\n")
+    os.replace(tmp_path, index_path)
+
+
+def get_property_labels():
     """
+    进程内共享的只读属性索引 {PID: label}，首次调用时加载。
+    索引文件 property_index_path 不存在或比 wikidata_props.json 旧时先由 JSON 编译生成，
+    之后各进程只读取这个紧凑的文本文件，不再解析完整的 JSON。
+    """
+    global _property_labels
+    if _property_labels is None:
+        with _property_labels_lock:
+            if _property_labels is None:
+                if not os.path.exists(property_index_path) or \
+                        os.path.getmtime(property_index_path) < os.path.getmtime(PROPS_FILE_PATH):
+                    compile_property_index(PROPS_FILE_PATH, property_index_path)
+                labels = {}
+                with open(property_index_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        property_id, _, label = line.rstrip('\n').partition('\t')
+                        labels[property_id] = label
+                _property_labels = MappingProxyType(labels)
+    return _property_labels
+
+
+_QID_PATTERN = re.compile(r"^Q\d+$")
+
+
+def _relation_discovery_query(QIDs, pointing):
+    """
+    多个实体的关系查询。与单个实体的查询一样每个方向只取前 100 个属性：每个实体各用一个带 LIMIT 100 的子查询再 UNION，
+    由服务端截断，热门实体（如国家、职业）不会返回全部属性。QIDs 须已通过 _QID_PATTERN 校验。
+    """
+    if pointing:
+        pattern = "?item ?property wd:{QID}."
+    else:
+        pattern = "wd:{QID} ?property ?target."
+    blocks = " UNION ".join(f"{{ SELECT DISTINCT (wd:{QID} AS ?entity) ?property WHERE {{ {pattern.format(QID=QID)} }} "
+                            f"LIMIT 100 }}" for QID in QIDs)
+    return f"SELECT ?entity ?property WHERE {{ {blocks} }}"
+
+
+def _split_relations(response, QIDs, property_labels):
+    """把批量查询的结果按实体拆分为 {QID: {PID: label}}，每个实体最多保留前 100 个不同的属性。"""
+    relations = {QID: {} for QID in QIDs}
+    seen = {QID: set() for QID in QIDs}
+    for item in response['results']['bindings'] if response else []:
+        QID = item['entity']['value'].split('/')[-1]
+        property_uri = item['property']['value']
+        if QID not in seen or len(seen[QID]) >= 100:
+            continue
+        seen[QID].add(property_uri)
+        # 过滤，只保留 wikidata 的属性，并且该 PID 在属性索引中能查到 label
+        if 'wikidata' in property_uri:
+            property_id = property_uri.split('/')[-1]
+            if property_id in property_labels:
+                relations[QID][property_id] = property_labels[property_id]
+    return relations
+
 
-    # 3. 设置请求头和请求体
+def _fetch_relations(batch, pointing, property_labels):
+    """
+    一个方向上 batch 中各实体的关系，返回与 batch 一一对应的 {PID: label} 列表。
+    每个实体按 (QID, 方向) 单独录制和回放，回放结果与实体被分到哪个批次无关。
+    """
     url = "https://query.wikidata.org/sparql"
-    params = {
-        'format': 'json'
-    }
 
-    # 4. 发送请求获取 QID 所指向的关系（QID -> 关系）
-    params['query'] = sparql_query_pointed
+    def fetch():
+        response = _safe_request(url, {'format': 'json', 'query': _relation_discovery_query(batch, pointing)}, proxies)
+        relations = _split_relations(response, batch, property_labels)
+        return [relations[QID] for QID in batch]
 
-    try:
-        response_pointed = safe_request(url, params, proxies)
-    except Exception as e:
-        print(e)
-        response_pointed=[]
+    return cassette_call_many("sparql_relations", [{"entity": QID, "pointing": pointing} for QID in batch], fetch)
 
-    # 5. 发送请求获取指向 QID 的关系（关系 -> QID）
-    params['query'] = sparql_query_pointing
+
+def _fetch_relations_or_each(batch, pointing, property_labels, failed):
+    """_fetch_relations 的批量查询失败时退回逐个实体查询，仍然失败的实体记为 {} 并加入 failed。"""
     try:
-        response_pointing =  safe_request(url, params, proxies)
+        return _fetch_relations(batch, pointing, property_labels)
     except Exception as e:
         print(e)
-        response_pointing=[]
-    pointed_relations = {}
-    if response_pointed:
-        # 6. 处理 QID 所指向的关系
-        data_pointed = response_pointed
-
-        for item in data_pointed['results']['bindings']:
-            property_uri = item['property']['value']
-            # 过滤，只保留以 "http://www.wikidata.org/prop/P" 开头的属性
-            if 'wikidata' in property_uri:
-                # 提取以 P 开头的属性 ID（如 P7033）
-                property_id = property_uri.split('/')[-1]
-                # 如果该 PID 在文件中查到，保存其 label
-                if property_id in property_data:
-                    pointed_relations[property_id] = property_data[property_id]["label"]
-    pointing_relations = {}
-    if response_pointing:
-        # 7. 处理指向 QID 的关系
-        data_pointing = response_pointing
-
-        for item in data_pointing['results']['bindings']:
-            property_uri = item['property']['value']
-            # 过滤，只保留以 "http://www.wikidata.org/prop/P" 开头的属性
-            if 'wikidata' in property_uri:
-                # 提取以 P 开头的属性 ID（如 P7033）
-                property_id = property_uri.split('/')[-1]
-                # 如果该 PID 在文件中查到，保存其 label
-                if property_id in property_data:
-                    pointing_relations[property_id] = property_data[property_id]["label"]
-
-    # 8. 返回结果，包含 ID 和 label
-    return {
-        "pointing_relations": pointing_relations,  # 返回字典形式，包含ID和label
-        "pointed_relations": pointed_relations  # 返回字典形式，包含ID和label
-    }
+    if len(batch) == 1:
+        failed.update(batch)
+        return [{}]
+    relations = []
+    for QID in batch:
+        try:
+            relations.extend(_fetch_relations([QID], pointing, property_labels))
+        except Exception as e:
+            print(e)
+            failed.add(QID)
+            relations.append({})
+    return relations
+
+
+# 批量获取多个实体指向的关系和指向实体的关系，每 sparql_relation_batch_size 个实体各用一次两个方向的查询
+def getAllRelationsOfQIDs(QIDs, property_labels=None, failed=None):
+    """
+    多个实体各自的全部关系（每个方向最多 100 个），返回 {QID: {"pointing_relations": {PID: label}, "pointed_relations": {PID: label}}}。
+    某一批查询失败时退回逐个实体查询；仍然失败的 QID 关系为空，并加入集合 failed（若给出），调用方不应缓存它们的结果。
+    不是 Q 加数字的 QID（如 LLM 输出的无效 ID）不会放进查询，关系为空。
+    """
+    if property_labels is None:
+        property_labels = get_property_labels()
+    if failed is None:
+        failed = set()
+    QIDs = list(dict.fromkeys(QIDs))
+    results = {QID: {"pointing_relations": {}, "pointed_relations": {}} for QID in QIDs if not _QID_PATTERN.match(QID)}
+    if results:
+        print(f"Skipping invalid QIDs: {list(results)}")
+    valid = [QID for QID in QIDs if QID not in results]
+    for start in range(0, len(valid), sparql_relation_batch_size):
+        batch = valid[start:start + sparql_relation_batch_size]
+        pointed = _fetch_relations_or_each(batch, False, property_labels, failed)
+        pointing = _fetch_relations_or_each(batch, True, property_labels, failed)
+        for QID, pointed_relations, pointing_relations in zip(batch, pointed, pointing):
+            results[QID] = {"pointing_relations": pointing_relations, "pointed_relations": pointed_relations}
+    return {QID: results[QID] for QID in QIDs}
+
+
 def get_wikipedia_title_from_qid(qid, language='en'):
     """
     根据Wikidata的QID获取对应语言的Wikipedia条目标题.
@@ -284,78 +427,71 @@ def get_wikipedia_title_from_qid(qid, language='en'):
         print(f"请求失败: {e}")
 
     return None
-def relationLinking(entityIDs,question,itemInfo,myInfoBox,top_k,logicTree):
-    # 创建一个字典来存储每个实体以及其关系信息
-    InfoByEntity = {}
-    retrieve_relation_List=set()
-    # 遍历每一个实体ID
-    for QId in entityIDs:
-        if not QId:
-            print(f"QId is None:{QId}")
-            continue
-        # 初始化当前实体的关系信息字典和关系标签集合
-        if QId not in InfoByEntity:
-            InfoByEntity[QId] = {}
-        # 获取当前实体的所有关系项
-        current_dir = os.path.dirname(os.path.abspath(__file__))
+# wikidata_props.json 与 wikidataUtills.py 位于同一目录
+PROPS_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wikidata_props.json')
+
+
+def _relation_selection_prompt(question, relaJson, top_k):
+    # 当前实体指向关系
+    return f"""
+    现在请根据info，从两个后续列表中分别选出{top_k}个最可能与之相关的关系，并且最相关的关系排在最前面。
+        info:{question}
+        pointed_relations:{relaJson["pointed_relations"]}
+        pointing_relations:{relaJson["pointing_relations"]}
+    请注意你只需输出关系的id即可，请不要输出其他内容。
+    参考输出json格式为：
+    {{
+        "pointed_relations":["", "", ""],
+        "pointing_relations":["", "", ""]
+    }}
+    Please just output json format content, do not output any analysis text.
+    """
 
-        # Construct the absolute path to wikidata_props.json, which is
-        # in the SAME directory as wikidataUtills.py
-        props_file_path = os.path.join(current_dir, 'wikidata_props.json')
-        relaJson = getAllRelationOfQID(QId, load_property_data(props_file_path))
-        if relaJson != {}:
-            pointing_relations_pid = []
-            pointed_relations_pid = []
-            for item in relaJson["pointing_relations"]:
-                pointing_relations_pid.append(relaJson["pointing_relations"][item])
-            for item in relaJson["pointed_relations"]:
-                pointed_relations_pid.append(relaJson["pointed_relations"][item])
-
-            # 当前实体指向关系
-            prompt_get_top6_rela = f"""
-            现在请根据info，从两个后续列表中分别选出{top_k}个最可能与之相关的关系，并且最相关的关系排在最前面。
-                info:{question}
-                pointed_relations:{relaJson["pointed_relations"]}
-                pointing_relations:{relaJson["pointing_relations"]}
-            请注意你只需输出关系的id即可，请不要输出其他内容。
-            参考输出json格式为：
-            {{
-                "pointed_relations":["", "", ""],
-                "pointing_relations":["", "", ""]
-            }}
-            Please just output json format content, do not output any analysis text.
-            """
-            top6_entities,tokenCount = getModelResponse(prompt_get_top6_rela, "Now begin output：")
-            logicTree.tokenCount+=tokenCount
-            top6_entities = top6_entities.replace("```json", "").replace("```", "")
-            json_data = json.loads(top6_entities)
-
-            pointed_relations = []
-            pointing_relations = []
-
-            for item in json_data["pointed_relations"]:
-                if item in relaJson["pointing_relations"]:
-                    pointed_relations.append({"id":item, "label":relaJson["pointing_relations"][item]})
-                if item in relaJson["pointed_relations"]:
-                    pointed_relations.append({"id":item, "label":relaJson["pointed_relations"][item]})
-                retrieve_relation_List.add(item)
-            for item in json_data["pointing_relations"]:
-                if item in relaJson["pointing_relations"]:
-                    pointing_relations.append({"id": item, "label": relaJson["pointing_relations"][item]})
-                if item in relaJson["pointed_relations"]:
-                    pointing_relations.append({"id": item, "label": relaJson["pointed_relations"][item]})
-                retrieve_relation_List.add(item)
-            InfoByEntity[QId]['label'] = itemInfo[QId]['text']
-            InfoByEntity[QId]['definition'] = itemInfo[QId]['definition']
-            InfoByEntity[QId]['pointed_relations'] = pointed_relations
-            InfoByEntity[QId]['pointing_relations'] = pointing_relations
-            print(f"Linking {len(pointed_relations)+len(pointing_relations)} relations!")
-    try:
-        answersInfo = getRelationValue(InfoByEntity)
-        #print(f"Entity Linking result：{json.dumps(answersInfo,indent=4)}")
-    except Exception as e:
-        answersInfo = InfoByEntity
-        print(e)
+
+def _parse_selected_relations(top6_entities, relaJson):
+    top6_entities = top6_entities.replace("```json", "").replace("```", "")
+    json_data = json.loads(top6_entities)
+
+    pointed_relations = []
+    pointing_relations = []
+    selected = set()
+
+    for item in json_data["pointed_relations"]:
+        if item in relaJson["pointing_relations"]:
+            pointed_relations.append({"id":item, "label":relaJson["pointing_relations"][item]})
+        if item in relaJson["pointed_relations"]:
+            pointed_relations.append({"id":item, "label":relaJson["pointed_relations"][item]})
+        selected.add(item)
+    for item in json_data["pointing_relations"]:
+        if item in relaJson["pointing_relations"]:
+            pointing_relations.append({"id": item, "label": relaJson["pointing_relations"][item]})
+        if item in relaJson["pointed_relations"]:
+            pointing_relations.append({"id": item, "label": relaJson["pointed_relations"][item]})
+        selected.add(item)
+    return pointed_relations, pointing_relations, selected
+
+
+def selectRelations(question, relaJson, top_k, logicTree):
+    """
+    让大模型从实体的全部关系中为问题挑选 top_k 个，
+    返回 (pointed_relations, pointing_relations, 选中的关系 id 集合)。
+    """
+    top6_entities,tokenCount = getModelResponse(_relation_selection_prompt(question, relaJson, top_k),
+                                                "Now begin output：", stage="relation_selection",
+                                                metrics=logicTree.metrics)
+    return _parse_selected_relations(top6_entities, relaJson)
+
+
+async def selectRelationsAsync(question, relaJson, top_k, logicTree):
+    """selectRelations 的异步版本。"""
+    top6_entities, tokenCount = await getModelResponseAsync(_relation_selection_prompt(question, relaJson, top_k),
+                                                            "Now begin output：", stage="relation_selection",
+                                                            metrics=logicTree.metrics)
+    return _parse_selected_relations(top6_entities, relaJson)
+
+
+def relationTriples(answersInfo, itemInfo):
+    """把查询到取值的关系整理成 infoBox.addGraph 使用的三元组格式。"""
     infos={
         "pointed": [],
         "pointing": []
@@ -379,7 +515,69 @@ def relationLinking(entityIDs,question,itemInfo,myInfoBox,top_k,logicTree):
                 }
                 infos["pointed"].append(triple)
         infos["pointing"]=answersInfo[item]["pointing_relations"]
-    myInfoBox.addGraph(json_array=infos)
+    return infos
+
+
+def relationLinking(entityIDs,question,itemInfo,myInfoBox,top_k,logicTree):
+    # 创建一个字典来存储每个实体以及其关系信息
+    InfoByEntity = {}
+    retrieve_relation_List=set()
+    # 所有实体的关系合并为一次批量查询（经过树内共享的证据缓存）
+    relaJsons = logicTree.evidence.relations_of_many(entityIDs)
+    # 遍历每一个实体ID
+    for QId in entityIDs:
+        if not QId:
+            print(f"QId is None:{QId}")
+            continue
+        # 初始化当前实体的关系信息字典和关系标签集合
+        if QId not in InfoByEntity:
+            InfoByEntity[QId] = {}
+        # 获取当前实体的所有关系项
+        relaJson = relaJsons[QId]
+        if relaJson != {}:
+            pointed_relations, pointing_relations, selected = selectRelations(question, relaJson, top_k, logicTree)
+            retrieve_relation_List.update(selected)
+            InfoByEntity[QId]['label'] = itemInfo[QId]['text']
+            InfoByEntity[QId]['definition'] = itemInfo[QId]['definition']
+            InfoByEntity[QId]['pointed_relations'] = pointed_relations
+            InfoByEntity[QId]['pointing_relations'] = pointing_relations
+            print(f"Linking {len(pointed_relations)+len(pointing_relations)} relations!")
+    try:
+        answersInfo = logicTree.evidence.relation_values(InfoByEntity)
+        #print(f"Entity Linking result：{json.dumps(answersInfo,indent=4)}")
+    except Exception as e:
+        answersInfo = InfoByEntity
+        print(e)
+    myInfoBox.addGraph(json_array=relationTriples(answersInfo, itemInfo))
+    return retrieve_relation_List
+
+
+async def relationLinkingAsync(entityIDs, question, itemInfo, myInfoBox, top_k, logicTree):
+    """
+    relationLinking 的异步版本：所有实体的关系一次批量查询（线程池中执行），各实体的关系挑选并发进行，
+    取值直接在事件循环上用一次异步 SPARQL 批量查询。
+    """
+    evidence = logicTree.evidence
+    QIds = [QId for QId in dict.fromkeys(entityIDs) if QId]
+    relaJsons = await run_blocking("wikidata", evidence.relations_of_many, QIds)
+    linked = [(QId, relaJsons[QId]) for QId in QIds if relaJsons[QId] != {}]
+    selections = await asyncio.gather(*(selectRelationsAsync(question, relaJson, top_k, logicTree)
+                                        for QId, relaJson in linked))
+    InfoByEntity = {QId: {} for QId in QIds}
+    retrieve_relation_List = set()
+    for (QId, relaJson), (pointed_relations, pointing_relations, selected) in zip(linked, selections):
+        retrieve_relation_List.update(selected)
+        InfoByEntity[QId]['label'] = itemInfo[QId]['text']
+        InfoByEntity[QId]['definition'] = itemInfo[QId]['definition']
+        InfoByEntity[QId]['pointed_relations'] = pointed_relations
+        InfoByEntity[QId]['pointing_relations'] = pointing_relations
+        print(f"Linking {len(pointed_relations)+len(pointing_relations)} relations!")
+    try:
+        answersInfo = await evidence.relation_values_async(InfoByEntity)
+    except Exception as e:
+        answersInfo = InfoByEntity
+        print(e)
+    myInfoBox.addGraph(json_array=relationTriples(answersInfo, itemInfo))
     return retrieve_relation_List
 
 if __name__ == '__main__':
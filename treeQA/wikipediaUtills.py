@@ -1,4 +1,4 @@
-from concurrent.futures import as_completed, ThreadPoolExecutor
+from concurrent.futures import as_completed
 
 import numpy as np
 import wikipediaapi
@@ -13,6 +13,9 @@ import nltk
 from transformers import GPT2TokenizerFast
 
 from embedding.embeddingModel import getEmbeddings
+from treeQA.ioCassette import cassette_call
+from treeQA.sharedExecutors import get_executor
+from treeQA.tracing import span, set_attributes
 from treeQA_Config import PersistentClient_Path, chroma_collection_name
 from treeQA.tree_class.embeddingModels import treeQAEmbeddings
 
@@ -39,7 +42,10 @@ def get_article_sections(title):
     """
     获取维基百科文章内容并按章节提取。
     """
+    return cassette_call("wikipedia", {"title": title}, lambda: _get_article_sections(title))
 
+
+def _get_article_sections(title):
     page = wiki_wiki.page(title)
     if not page.exists():
         print(f"Article '{title}' does not exist.")
@@ -72,6 +78,8 @@ def get_article_sections(title):
     for section in page.sections:
         extract_sections(section, sections=sections)
 
+    set_attributes({"wikipedia.sections": len(sections),
+                    "wikipedia.bytes": sum(len(section["content"].encode("utf-8")) for section in sections)})
     return sections
 
 
@@ -151,16 +159,15 @@ def embed_and_store(sections, article_title):
         batches.append(batch_documents)
 
 
-    with ThreadPoolExecutor() as executor:
-        futures = {executor.submit(getEmbeddings, batch): batch for batch in batches}
-        embeddings_list = []
-        for future in as_completed(futures):
-            batch = futures[future]
-            try:
-                embeddings = future.result()
-                embeddings_list.extend(embeddings)
-            except Exception as e:
-                print(f"Error generating embeddings for batch: {e}")
+    futures = {get_executor("embedding").submit(getEmbeddings, batch): batch for batch in batches}
+    embeddings_list = []
+    for future in as_completed(futures):
+        batch = futures[future]
+        try:
+            embeddings = future.result()
+            embeddings_list.extend(embeddings)
+        except Exception as e:
+            print(f"Error generating embeddings for batch: {e}")
 
     # Now, insert all data into the collection in batches
     embeddings_index = 0
@@ -228,51 +235,57 @@ def getWikipediaResultByNV(article_name, query , top_k=3):
 
 
 
-def embed_and_query_direct(article_name, query, top_k):
+def embed_article_chunks(article_name):
+    """获取文章、切分成块并计算 embedding，返回 (chunks, chunk_embeddings)，失败时返回 ([], None)。"""
     if article_name:
         print(f"Find article {article_name}.")
     # 1. Fetch article
     sections = get_article_sections(article_name)
     if not sections:
         print(f"Article '{article_name}' not found or has no content.")
-        return []
+        return [], None
 
     # 2. Split into chunks
     all_chunks_data = []
     all_chunk_texts = []
     #print(f"Splitting article '{article_name}' into chunks...")
-    for idx, section in enumerate(sections):
-        split_texts = split_text_by_tokens(section, max_tokens=100) # Use existing function
-        for part_idx, part_text in enumerate(split_texts):
-            all_chunks_data.append({
-                "article_title": article_name,
-                "title": section['title'],
-                "content": part_text,
-                # Optional: Add an ID if needed later, though not strictly necessary for direct query
-                "id": f"{article_name}_{idx}_{part_idx}"
-            })
-            all_chunk_texts.append(part_text)
+    with span("wikipedia.split_chunks", {"wikipedia.title": article_name}) as split_span:
+        for idx, section in enumerate(sections):
+            split_texts = split_text_by_tokens(section, max_tokens=100) # Use existing function
+            for part_idx, part_text in enumerate(split_texts):
+                all_chunks_data.append({
+                    "article_title": article_name,
+                    "title": section['title'],
+                    "content": part_text,
+                    # Optional: Add an ID if needed later, though not strictly necessary for direct query
+                    "id": f"{article_name}_{idx}_{part_idx}"
+                })
+                all_chunk_texts.append(part_text)
+        split_span.set_attribute("wikipedia.chunks", len(all_chunk_texts))
     #print(f"Generated {len(all_chunk_texts)} chunks.")
 
     if not all_chunk_texts:
         print("No text chunks generated.")
-        return []
+        return [], None
 
-    # 3. Embed chunks and query
+    # 3. Embed chunks
     chunk_embeddings = getEmbeddings(all_chunk_texts) # Adapt if using class methods
-    query_embedding = getEmbeddings([query])[0]       # Adapt if using class methods
+    if not chunk_embeddings:
+        print("Failed to generate embeddings.")
+        return [], None
+    return all_chunks_data, np.array(chunk_embeddings)
 
-    if not chunk_embeddings or query_embedding is None:
-         print("Failed to generate embeddings.")
-         return []
 
+def query_article_chunks(chunks, chunk_embeddings, query_embedding, top_k):
+    """按与 query_embedding 的余弦相似度返回 top_k 个文本块。"""
+    if not chunks or chunk_embeddings is None or query_embedding is None:
+        return []
     # Ensure embeddings are in the correct format for cosine_similarity (e.g., 2D numpy arrays)
-    chunk_embeddings_np = np.array(chunk_embeddings)
     query_embedding_np = np.array(query_embedding).reshape(1, -1)
 
     # 4. Calculate cosine similarities
     #print("Calculating similarities...")
-    similarities = cosine_similarity(query_embedding_np, chunk_embeddings_np).flatten()
+    similarities = cosine_similarity(query_embedding_np, chunk_embeddings).flatten()
 
     # 5. Get top-k results
     # Get indices sorted by similarity (highest first)
@@ -286,15 +299,23 @@ def embed_and_query_direct(article_name, query, top_k):
     results = []
     for i in top_k_indices:
         results.append({
-            "id": all_chunks_data[i]["id"],
-            "title": all_chunks_data[i]["title"],
-            "content": all_chunks_data[i]["content"],
+            "id": chunks[i]["id"],
+            "title": chunks[i]["title"],
+            "content": chunks[i]["content"],
             "similarity": float(similarities[i]) # Add similarity score
         })
 
     return results
 
-# New main function for direct query
+
+def embed_and_query_direct(article_name, query, top_k):
+    chunks, chunk_embeddings = embed_article_chunks(article_name)
+    if not chunks:
+        return []
+    query_embedding = getEmbeddings([query])[0]       # Adapt if using class methods
+    return query_article_chunks(chunks, chunk_embeddings, query_embedding, top_k)
+
+
 def getWikipediaResultDirect(article_name, query, top_k=3):
     """
     Fetches, embeds, and queries a Wikipedia article directly without storing in DB.
@@ -17,12 +17,52 @@ nv_embed_v2_url = 'http://server_address:port/embeddings'
 # ----------------For LLM model config,state it here----------------------
 # ----deepseekV3-chat/qwen2.5-instruct-14b/gpt3.5-turbo----------
 model_name = "deepseekV3-chat"
+# Per-stage routing: each pipeline stage may use its own model, max_tokens and timeout (seconds).
+# None falls back to model_name above, the model's default max_tokens and llm_timeout.
+stage_models = {
+    "tree_construction": {"model": None, "max_tokens": None, "timeout": None},
+    "fact_check": {"model": None, "max_tokens": None, "timeout": None},
+    "new_clue": {"model": None, "max_tokens": None, "timeout": None},
+    "subtree_fix": {"model": None, "max_tokens": None, "timeout": None},
+    "entity_extract": {"model": None, "max_tokens": None, "timeout": None},
+    "entity_filter": {"model": None, "max_tokens": None, "timeout": None},
+    "entity_select": {"model": None, "max_tokens": None, "timeout": None},
+    "relation_selection": {"model": None, "max_tokens": None, "timeout": None},
+    "final_answer": {"model": None, "max_tokens": None, "timeout": None},
+}
 # If you use qwen2.5-instruct-14b,you need to set aliApiKey,https://help.aliyun.com/en/model-studio/developer-reference/get-api-key
 aliApiKey = "sk-########################"
 # If you use gpt3.5turbo,you need to set openaiApiKey,https://platform.openai.com/account/api-keys
 openaiApiKey = ""
 # If you use deepseekV3,you need to set deepseekApiKey,https://platform.deepseek.com/
 deepseekApiKey = "sk-#####################"
+# Shared LLM HTTP clients: one pooled client per provider, reused across threads.
+llm_timeout = 120.0  # seconds per request (read/write/pool)
+llm_connect_timeout = 10.0
+llm_max_connections = 50
+llm_max_keepalive_connections = 20
+llm_keepalive_expiry = 60.0  # seconds an idle connection is kept open
+llm_max_retries = 2  # retries of connection errors, timeouts and 5xx (done by the rate limiter loop, not the SDK)
+# Persistent LLM response cache (SQLite), keyed by model, prompts and sampling params.
+llm_cache_enabled = False
+llm_cache_path = "cache/llm_responses.sqlite"
+llm_cache_max_entries = 200000  # least recently used entries are evicted beyond this; None for unlimited
+llm_cache_ttl = None  # seconds; None keeps entries forever
+llm_cache_report_tokens = True  # cached replies report the token counts of the original call
+# Coalesce identical LLM calls that are in flight at the same time into one upstream request.
+llm_single_flight = True
+# Max in-flight requests per provider for getModelResponseAsync (per event loop).
+llm_async_concurrency = {"deepseek": 64, "dashscope": 32, "openai": 64, "default": 32}
+# Process-wide rate limits per provider (requests / tokens per minute); None disables a limit.
+llm_rate_limits = {
+    "deepseek": {"rpm": None, "tpm": None},
+    "dashscope": {"rpm": None, "tpm": None},
+    "openai": {"rpm": None, "tpm": None},
+}
+llm_expected_completion_tokens = 256  # completion size assumed when reserving tokens before a call
+llm_rate_limit_max_retries = 6  # retries on HTTP 429 before the error is raised
+llm_backoff_base = 1.0  # seconds; jittered exponential backoff when no Retry-After is sent
+llm_backoff_max = 60.0
 
 # Get article chunks by nv-embed-v2/text-embedding-3-small
 RetrieveModelName = "nv-embed-v2"
@@ -31,8 +71,93 @@ Chroma_store = False
 PersistentClient_Path = "path_to_chroma"
 chroma_collection_name = "wikipediaNV"# You can set any name you like, but chroma_collection_name needs to correspond to the retrieval model.
 
+# Compact Wikidata property index (one "PID<TAB>label" line per property), compiled from treeQA/wikidata_props.json on
+# first use and rebuilt when the JSON is newer. Each process loads it once and shares it read-only between threads.
+property_index_path = "cache/wikidata_props.tsv"
+
+# Batched SPARQL: relation discovery for up to sparql_relation_batch_size entities is one query per direction, and the
+# values of up to sparql_value_batch_size selected (entity, relation, direction) pairs are one query, split back per
+# entity afterwards. A failed value batch falls back to one query per pair.
+sparql_relation_batch_size = 20
+sparql_value_batch_size = 50
+
 # Use ELTop_k, RLTop_k to set the top k of the entity and relation linking results for graph search.
 ELTop_k = 2
 RLTop_k = 1
 # Get top_k of text blocks to self-adaptive
 article_top_k = 2
+
+# Stream the logic-tree JSON and start retrieval/fact-checking of each node as soon as it is complete.
+stream_tree_construction = False
+# Nodes verified concurrently per tree. A node's children are scheduled only after it has been checked (and its
+# subtree possibly rewritten); sibling subtrees run in parallel. 1 keeps the original sequential pre-order walk.
+verify_parallelism = 1
+# Retrieve evidence for all nodes of a tree in one batch before verification: entities are extracted in a single LLM
+# call and each distinct entity label, QID, relation and Wikipedia article is fetched once. False retrieves per node.
+batch_retrieval = False
+
+# Per-question budgets (None for unlimited): total LLM tokens and wall-clock seconds, tree construction included.
+question_token_budget = None
+question_time_budget = None
+# Fractions of the budget used at which verification degrades: skip new-clue retries, then skip nodes deeper than
+# budget_priority_depth (1 = only the root's direct sub-questions are still checked), then stop verification and go
+# straight to the final answer.
+budget_degrade_thresholds = (0.5, 0.75, 0.9)
+budget_priority_depth = 1
+
+# Token cap of the compact logic-tree summary given to the final-answer prompt (one line per node: sub-question,
+# corrected answer, verification status and the shortest supporting evidence). None sends the full tree instead.
+final_answer_context_tokens = 1500
+
+# How a retrieval round picks its entities. "two_step": LLM entity extraction, Wikidata search of the extracted names,
+# then an LLM filter over all candidates (two serial LLM calls). "fused": one structured LLM call over the entity-linking
+# candidates that returns the selected QIDs plus names of missing entities, whose top Wikidata hit is added.
+entity_selection_mode = "two_step"
+
+# Speculative prefetch: as soon as entity candidates are known, fetch the Wikipedia article (title only with Chroma) and
+# all relations of the top speculative_prefetch_candidates per query while the entity-filter LLM call is running.
+# Prefetches of candidates the filter rejects are cancelled if they have not started yet, otherwise only cached.
+speculative_prefetch = False
+speculative_prefetch_candidates = 3
+
+# Sub-questions in one tree whose question and answer word sets both have a Jaccard similarity of at least this value
+# are treated as near-duplicates and share one verification. None only shares verifications of identical nodes.
+duplicate_question_threshold = 0.9
+
+# Checkpoint each dataset question's tree state after construction, after every verified node and after verification,
+# so a restarted run resumes a question from its last completed node. Checkpoints are keyed by dataset, item id, question
+# and the model/retrieval settings, and are removed once a question is answered. Single-question runs are not checkpointed.
+checkpoint_enabled = False
+checkpoint_path = "cache/checkpoints.sqlite"
+
+# OpenTelemetry tracing: spans for each question stage, tree step, node verification, getQueryInfo step and external
+# call (LLM, SPARQL/Wikidata, Wikipedia, embeddings, entity linking) with token, byte, cache-hit and retry attributes.
+# "console" prints finished spans, "file" appends one JSON span per line to tracing_file_path, "off" disables tracing.
+tracing_exporter = "off"
+tracing_file_path = "cache/traces.jsonl"
+tracing_service_name = "treeQA"
+
+# Record/replay of all external I/O (LLM, SPARQL/Wikidata, Wikipedia, embeddings, entity linking).
+# "record": call live services and append every request/response pair to io_cassette_path.
+# "replay": serve responses from io_cassette_path without network access. "off" disables the layer.
+io_cassette_mode = "off"
+io_cassette_path = "cassettes/run.jsonl.gz"
+# Replay latency: None for none, a number of seconds per call, or "recorded" to wait as long as the original call took.
+io_cassette_latency = None
+
+# Async pipeline (python inference.py dataset ... --async_pipeline): all questions run as coroutines on one shared
+# event loop per process. async_max_questions bounds the questions in flight; blocking retrieval calls without an async
+# client go to the shared executors below, other blocking work (cache, checkpoints) to a pool of async_blocking_workers.
+async_max_questions = 64
+async_blocking_workers = 8
+
+# Process-wide thread pools per backend. All retrieval code (threaded and async) submits its blocking calls to these,
+# so the sizes bound the concurrent calls to each service across all questions. "verification" runs the node tasks of
+# verify_parallelism > 1 and "prefetch" the background node verifications of stream_tree_construction, for all trees;
+# they are separate from the retrieval pools their tasks wait on. Queue depth, peak queue depth and average queue wait
+# of each pool are printed at the end of a run.
+executor_workers = {"llm": 16, "wikidata": 8, "wikipedia": 8, "embedding": 4, "entity_linking": 4,
+                    "verification": 16, "prefetch": 16}
+
+# Offline batch mode (python inference.py batch ...): threads used by the local stand-in that executes the batch request file.
+batch_local_workers = 8